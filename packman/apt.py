@@ -1,13 +1,62 @@
 import utils
 import logger
+import retrieve
+import cache
+import metadata
+import mirror
+import codes
 
+import glob
+import hashlib
+import platform
 import re
 import urllib2
 import os
 import sh
+import sys
+import tempfile
+
+APT_LISTS_PATH = '/var/lib/apt/lists'
+APT_SOURCES_LIST = '/etc/apt/sources.list'
+APT_SOURCES_LIST_D = '/etc/apt/sources.list.d'
+APT_PREFERENCES_D = '/etc/apt/preferences.d'
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+# apt-get fails if another apt-get is running, so the runs of packages
+# handled concurrently are serialized by this lock.
+APT_GET_LOCK = os.path.expanduser('~/.packman/locks/apt-get.lock')
+# files which determine what apt-get update retrieves
+APT_SOURCES = [
+    APT_SOURCES_LIST,
+    os.path.join(APT_SOURCES_LIST_D, '*'),
+    '/etc/apt/trusted.gpg',
+    '/etc/apt/trusted.gpg.d/*',
+]
+# packages in local repos (e.g. a mirror) are preferred over packages in
+# other repos, but are never downgraded to
+MIRROR_PREFERENCES = '''Package: *
+Pin: origin ""
+Pin-Priority: 990
+'''
+# apt's configuration while a mirror is used alone (see
+# `Handler.use_mirror`). its package lists are kept apart from the
+# lists of the configured repos.
+MIRROR_APT_PATH = os.path.join(metadata.DEFAULT_STATE_PATH, 'apt-mirror')
+MIRROR_APT_CONF = '''Dir::Etc::SourceList "{0}/sources.list";
+Dir::Etc::SourceParts "{0}/sources.list.d";
+Dir::State::Lists "{0}/lists";
+'''
+# apt-get download --print-uris prints: 'url' file_name size checksum
+PRINTED_URI = re.compile(r"^'(\S+)' \S+ \d+ ?(?:SHA256:(\w+))?")
 
 lgr = logger.init()
 
+# the installed packages, keyed by the state of the dpkg status file
+# they were read from
+_installed = {}
+
+# the mirror used in this run (see `Handler.use_mirror`)
+_mirror = {}
+
 
 class Handler(utils.Handler):
     def dpkg_name(self, dir):
@@ -19,6 +68,43 @@ class Handler(utils.Handler):
         lgr.debug('Renaming deb files...')
         return sh.dpkg_name('{0}/*.deb'.format(dir))
 
+    def installed_packages(self):
+        """returns the installed packages
+
+        the dpkg status file is only read again when it changes (i.e.
+        when packages were installed or removed).
+
+        :rtype: `set` of package names (also in the forms name:arch and
+         name=version)
+        """
+        try:
+            st = os.stat(DPKG_STATUS_PATH)
+        except OSError:
+            return set()
+        state = (st.st_mtime, st.st_size)
+        if state not in _installed:
+            _installed.clear()
+            _installed[state] = self._read_status()
+        return _installed[state]
+
+    def _read_status(self):
+        lgr.debug('Reading installed packages from {0}'.format(
+            DPKG_STATUS_PATH))
+        installed = set()
+        with open(DPKG_STATUS_PATH) as f:
+            for stanza in f.read().split('\n\n'):
+                fields = dict(
+                    line.split(': ', 1) for line in stanza.splitlines()
+                    if ': ' in line and not line[0].isspace())
+                if not fields.get('Status', '').endswith(' installed'):
+                    continue
+                name = fields.get('Package')
+                installed.update([
+                    name,
+                    '{0}:{1}'.format(name, fields.get('Architecture')),
+                    '{0}={1}'.format(name, fields.get('Version'))])
+        return installed
+
     def check_if_package_is_installed(self, package):
         """checks if a package is installed
 
@@ -26,33 +112,200 @@ class Handler(utils.Handler):
         :rtype: `bool` representing whether package is installed or not
         """
         lgr.debug('Checking if {0} is installed'.format(package))
-        o = sh.dpkg('-s', package)
-
-        if not o.exit_code:
+        if package in self.installed_packages():
             lgr.debug('{0} is installed'.format(package))
             return True
         else:
-            lgr.error('{0} is not installed'.format(package))
+            lgr.debug('{0} is not installed'.format(package))
             return False
 
-    def download(self, reqs, sources_path):
+    def missing_packages(self, packages):
+        """returns the packages which aren't installed
+
+        :param list packages: packages to check
+        :rtype: `list` of packages
+        """
+        installed = self.installed_packages()
+        missing = [p for p in packages if p not in installed]
+        if len(missing) < len(packages):
+            lgr.debug('Already installed: {0}'.format(', '.join(
+                p for p in packages if p in installed)))
+        return missing
+
+    def _apt_get(self, action, packages, *args, **kwargs):
+        """runs a single apt-get transaction on a list of packages
+
+        apt-get reads the dpkg status database and the package lists every
+        time it runs, so all packages are handled in one run. if it fails,
+        each package is retried on its own to find which of them failed.
+
+        :param string action: apt-get action (e.g. install, purge)
+        :param list packages: packages to handle
+        :param args: additional apt-get arguments
+        :param kwargs: additional apt-get options
+        """
+        def run(packages):
+            with utils.flock(APT_GET_LOCK):
+                o = getattr(sh.apt_get, action)(
+                    '-y', *(list(args) + list(packages)), _iter=True,
+                    **kwargs)
+                for line in o:
+                    lgr.debug(line.rstrip())
+
+        if not packages:
+            return
+        try:
+            run(packages)
+            return
+        except sh.ErrorReturnCode as ex:
+            if len(packages) == 1:
+                lgr.error('Failed to {0} {1} ({2})'.format(
+                    action, packages[0], ex.stderr.strip()))
+                sys.exit(codes.mapping['apt_get_failed'])
+            lgr.warning('Failed to {0} {1}. Retrying each package on its '
+                        'own...'.format(action, ', '.join(packages)))
+        failed = []
+        for package in packages:
+            try:
+                run([package])
+            except sh.ErrorReturnCode as ex:
+                lgr.error('Failed to {0} {1} ({2})'.format(
+                    action, package, ex.stderr.strip()))
+                failed.append(package)
+        if failed:
+            sys.exit(codes.mapping['apt_get_failed'])
+
+    def _query(self, query, packages, action):
+        """runs an apt query (e.g. apt-cache depends) on a list of packages
+
+        if it fails, each package is queried on its own to find which of
+        them failed.
+
+        :param query: function which runs the query on a list of packages
+        :param list packages: packages to query
+        :param string action: description of the query for error messages
+        :rtype: the query's output
+        """
+        try:
+            return query(packages)
+        except sh.ErrorReturnCode as ex:
+            if len(packages) == 1:
+                lgr.error('Failed to {0} {1} ({2})'.format(
+                    action, packages[0], ex.stderr.strip()))
+                sys.exit(codes.mapping['apt_get_failed'])
+            lgr.warning('Failed to {0} {1}. Retrying each package on its '
+                        'own...'.format(action, ', '.join(packages)))
+        failed = []
+        for package in packages:
+            try:
+                query([package])
+            except sh.ErrorReturnCode as ex:
+                lgr.error('Failed to {0} {1} ({2})'.format(
+                    action, package, ex.stderr.strip()))
+                failed.append(package)
+        if not failed:
+            lgr.error('Failed to {0} {1}'.format(action, ', '.join(packages)))
+        sys.exit(codes.mapping['apt_get_failed'])
+
+    def _lists_state(self):
+        """returns a hash of the state of the local package indexes
+
+        the hash changes whenever the indexes are updated.
+        """
+        state = hashlib.sha256()
+        lists = os.path.join(MIRROR_APT_PATH, 'lists') \
+            if _mirror.get('alone') else APT_LISTS_PATH
+        for index in sorted(glob.glob(os.path.join(lists, '*_Packages*'))):
+            st = os.stat(index)
+            state.update('{0} {1} {2}\n'.format(
+                index, st.st_size, st.st_mtime))
+        return state.hexdigest()
+
+    def dependencies(self, reqs):
+        """returns a list of packages and all of their dependencies
+
+        the dependencies are resolved from the package indexes, regardless
+        of which packages are installed on the local machine.
+
+        :param list reqs: packages to resolve
+        :rtype: `list` of package names
+        """
+        o = self._query(lambda packages: sh.apt_cache.depends(
+            '--recurse', '--no-recommends', '--no-suggests',
+            '--no-conflicts', '--no-breaks', '--no-replaces',
+            '--no-enhances', *packages), reqs, 'resolve the dependencies of')
+        # packages are listed at the beginning of a line, followed by
+        # their indented dependencies. virtual packages are listed as
+        # <package> along with the packages which provide them.
+        return sorted(set(
+            line.strip() for line in o
+            if line.strip() and not line[0].isspace() and
+            not line.startswith('<')))
+
+    def closure(self, reqs):
+        """returns the sources of a list of packages and all of their
+        dependencies
+
+        the closure is cached per distro, list of packages and state of
+        the package indexes.
+
+        :param list reqs: packages to resolve
+        :rtype: `list` of dicts containing the `url` and `sha256` of each
+         package
+        """
+        key = hashlib.sha256('\n'.join([
+            'apt', ' '.join(platform.dist()), platform.machine(),
+            self._lists_state()] + sorted(reqs))).hexdigest()
+        c = cache.Handler()
+        sources = c.closure(key)
+        if sources is not None:
+            lgr.debug('Using cached dependency closure of {0}'.format(
+                ', '.join(reqs)))
+            return sources
+        lgr.info('Resolving dependencies of {0}...'.format(', '.join(reqs)))
+        packages = self.dependencies(reqs)
+        sources = []
+        o = self._query(lambda packages: sh.apt_get.download(
+            '--print-uris', *packages), packages, 'find the uri of')
+        for line in o:
+            match = PRINTED_URI.search(line)
+            if match:
+                sources.append({'url': match.group(1),
+                                'sha256': match.group(2)})
+        lgr.debug('{0} packages resolved.'.format(len(sources)))
+        c.set_closure(key, sources)
+        return sources
+
+    def download(self, reqs, sources_path, resolve=False):
         """downloads component requirements
 
+        if `resolve` is set, the requirements and all of their dependencies
+        are downloaded (concurrently) whether or not they are installed on
+        the local machine. else, apt-get decides which dependencies are
+        missing and downloads them along with the requirements.
+
         :param list reqs: list of requirements to download
         :param sources_path: path to download requirements to
+        :param bool resolve: whether to download the full dependency closure
         """
-        for req in reqs:
-            # TODO: (TEST) add an is-package-installed check. if it is
-            # TODO: (TEST) run apt-get install --reinstall instead of apt-get
-            # TODO: (TEST) install.
-            # TODO: (IMPRV) try http://askubuntu.com/questions/219828/getting-deb-package-dependencies-for-an-offline-ubuntu-computer-through-windows  # NOQA
-            # TODO: (IMPRV) for downloading requirements
-            lgr.debug('Downloading {0} to {1}...'.format(req, sources_path))
-            o = sh.apt_get.install('-y', req, '-d', o='dir::cache={0}'.format(
-                sources_path), _iter=True)
-            for line in o:
-                lgr.debug(line)
-            sh.rm('{0}/*.bin'.format(sources_path))
+        if reqs and resolve:
+            # debs are downloaded into sources_path/archives
+            retrieve.Handler().downloads(self.closure(reqs), sources_path)
+            return
+        # TODO: (TEST) add an is-package-installed check. if it is
+        # TODO: (TEST) run apt-get install --reinstall instead of apt-get
+        # TODO: (TEST) install.
+        # TODO: (IMPRV) try http://askubuntu.com/questions/219828/getting-deb-package-dependencies-for-an-offline-ubuntu-computer-through-windows  # NOQA
+        # TODO: (IMPRV) for downloading requirements
+        # apt-get doesn't download packages which are already installed
+        reqs = self.missing_packages(reqs)
+        if not reqs:
+            return
+        lgr.debug('Downloading {0} to {1}...'.format(
+            ', '.join(reqs), sources_path))
+        self._apt_get('install', reqs, '-d', o='dir::cache={0}'.format(
+            sources_path))
+        sh.rm('{0}/*.bin'.format(sources_path))
 
     def autoremove(self, pkg):
         """autoremoves package dependencies
@@ -60,24 +313,119 @@ class Handler(utils.Handler):
         :param string pkg: package to remove
         """
         lgr.debug('Removing unnecessary dependencies...')
-        return sh.apt_get.autoremove('-y', pkg)
+        with utils.flock(APT_GET_LOCK):
+            return sh.apt_get.autoremove('-y', pkg)
+
+    def _configured_repos(self, exclude=None):
+        """returns the repos configured in the apt sources files
 
-    def add_src_repos(self, source_repos):
+        :param string exclude: sources file to ignore
+        :rtype: `set` of repo lines
+        """
+        repos = set()
+        for sources_file in [APT_SOURCES_LIST] + sorted(glob.glob(
+                os.path.join(APT_SOURCES_LIST_D, '*.list'))):
+            if sources_file == exclude or not os.path.isfile(sources_file):
+                continue
+            with open(sources_file) as f:
+                for line in f:
+                    line = ' '.join(line.split('#')[0].split())
+                    if line:
+                        repos.add(line)
+        return repos
+
+    def add_src_repos(self, source_repos, name='packman'):
         """adds a list of source repos to the apt repo
 
+        the repos are written (at once) to a sources file of their own under
+        sources.list.d. repos which are already configured in another
+        sources file are omitted.
+
         :param list source_repos: repos to add to sources list
+        :param string name: name of the package the repos are added for
+        :rtype: `bool` representing whether the sources changed
         """
-        def add(source_repo, f, apt_file):
-            if not re.search(source_repo, f.read()):
-                lgr.debug('Adding source repository {0}'.format(source_repo))
-                sh.sed('-i', "2i {0}".format(source_repo), apt_file)
-            else:
+        sources_file = os.path.join(
+            APT_SOURCES_LIST_D, 'packman-{0}.list'.format(name))
+        configured = self._configured_repos(exclude=sources_file)
+        repos = []
+        for source_repo in source_repos:
+            source_repo = ' '.join(source_repo.split())
+            if source_repo in configured or source_repo in repos:
                 lgr.debug('Repo {0} already added.'.format(source_repo))
+            else:
+                lgr.debug('Adding source repository {0}'.format(source_repo))
+                repos.append(source_repo)
+        try:
+            with open(sources_file) as f:
+                current = f.read()
+        except IOError:
+            current = None
+        content = ''.join('{0}\n'.format(repo) for repo in repos)
+        if not repos:
+            if current is None:
+                return False
+            lgr.debug('Removing {0}'.format(sources_file))
+            os.remove(sources_file)
+            return True
+        if content == current:
+            return False
+        lgr.debug('Writing {0}'.format(sources_file))
+        self.mkdir(APT_SOURCES_LIST_D)
+        fd, tmp = tempfile.mkstemp(dir=APT_SOURCES_LIST_D, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, sources_file)
+        return True
 
-        apt_file = '/etc/apt/sources.list'
-        for source_repo in source_repos:
-            with open(apt_file) as f:
-                add(source_repo, f, apt_file)
+    def _write_file(self, path, content):
+        # returns whether the file changed
+        if os.path.isfile(path):
+            with open(path) as f:
+                if f.read() == content:
+                    return False
+        self.mkdir(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        return True
+
+    def use_mirror(self, path, alone=False):
+        """uses a packman mirror (see `mirror.Handler`) in this run
+
+        the mirror is added to the apt sources and its packages are pinned
+        so that they're preferred over the packages in other repos.
+
+        if `alone` is set, the mirror is used instead of the configured
+        repos: the apt sources are left untouched, and apt reads a sources
+        list (and keeps package lists) of its own which only contains the
+        mirror. apt-get update then only reads the mirror, so nothing
+        is retrieved over the network.
+
+        :param string path: the mirror's path
+        :param bool alone: whether to use the mirror alone
+        :rtype: `bool` representing whether the sources changed
+        """
+        m = mirror.Handler(path)
+        m.validate('Packages')
+        repo = 'deb [trusted=yes] file:{0} ./'.format(m.path)
+        _mirror.update({'path': m.path, 'alone': alone})
+        if alone:
+            lgr.info('Using mirror {0} instead of the apt sources'.format(
+                m.path))
+            self.mkdir(os.path.join(MIRROR_APT_PATH, 'sources.list.d'))
+            self.mkdir(os.path.join(MIRROR_APT_PATH, 'lists', 'partial'))
+            conf = os.path.join(MIRROR_APT_PATH, 'apt.conf')
+            self._write_file(conf, MIRROR_APT_CONF.format(MIRROR_APT_PATH))
+            # apt-get and apt-cache (in this process and in the processes
+            # of all packages) read their configuration from it
+            os.environ['APT_CONFIG'] = conf
+            return self._write_file(os.path.join(
+                MIRROR_APT_PATH, 'sources.list'), '{0}\n'.format(repo))
+        lgr.info('Using mirror {0}'.format(m.path))
+        pinned = self._write_file(os.path.join(
+            APT_PREFERENCES_D, 'packman-mirror'), MIRROR_PREFERENCES)
+        return self.add_src_repos([repo], 'mirror') or pinned
 
     def add_ppa_repos(self, source_ppas):
         """adds a list of ppa repos to the apt repo
@@ -87,8 +435,6 @@ class Handler(utils.Handler):
         for source_ppa in source_ppas:
             lgr.debug('Adding ppa repository {0}'.format(source_ppa))
             sh.add_apt_repository('-y', source_ppa)
-        if source_ppas:
-            self.update()
 
     def add_keys(self, key_files, sources_path):
         """adds a list of keys to the local repo
@@ -96,7 +442,8 @@ class Handler(utils.Handler):
         :param string key_files: key files paths
         """
         for key in key_files:
-            key_file = urllib2.unquote(key).decode('utf8').split('/')[-1]
+            key_file = urllib2.unquote(
+                retrieve.source_url(key)).decode('utf8').split('/')[-1]
             self.add_key(os.path.join(sources_path, key_file))
 
     def add_key(self, key_file):
@@ -111,22 +458,45 @@ class Handler(utils.Handler):
         """runs apt-get update
         """
         lgr.debug('Updating local apt repo')
-        return sh.apt_get.update()
+        with utils.flock(APT_GET_LOCK):
+            return sh.apt_get.update()
+
+    def refresh(self, ttl=None, changed=False):
+        """runs apt-get update if the repo sources changed since it last
+        ran or if the package indexes expired
+
+        :param int ttl: seconds after which the package indexes expire
+        :param bool changed: whether the repo sources are known to
+         have changed
+        :rtype: `bool` representing whether apt-get update ran
+        """
+        if not _mirror:
+            return metadata.Handler('apt', APT_SOURCES).refresh(
+                self.update, ttl, changed)
+        # the package lists are refreshed whenever the mirror is indexed
+        index = os.path.join(_mirror['path'], 'Packages')
+        if _mirror['alone']:
+            return metadata.Handler('apt-mirror', [os.path.join(
+                MIRROR_APT_PATH, 'sources.list'), index]).refresh(
+                    self.update, ttl, changed)
+        return metadata.Handler('apt', APT_SOURCES + [index]).refresh(
+            self.update, ttl, changed)
 
     def install(self, packages):
         """apt-get installs a list of packages
 
         :param list packages: packages to install
         """
-        for package in packages:
-            lgr.debug('Installing {0}'.format(package))
-            sh.apt_get.install('-y', package)
+        packages = self.missing_packages(packages)
+        if packages:
+            lgr.debug('Installing {0}'.format(', '.join(packages)))
+        self._apt_get('install', packages)
 
     def purge(self, packages):
         """completely purges a list of packages from the local repo
 
         :param list packages: packages name to purge
         """
-        for package in packages:
-            lgr.debug('Attemping to purge {0}'.format(package))
-            sh.apt_get.purge('-y', package)
+        if packages:
+            lgr.debug('Attemping to purge {0}'.format(', '.join(packages)))
+        self._apt_get('purge', packages)
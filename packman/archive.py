@@ -0,0 +1,101 @@
+import utils
+import logger
+import codes
+
+import os
+import sys
+import tarfile
+import time
+
+# package types which are written without fpm
+ARCHIVE_TYPES = ('tar', 'tar.gz')
+# the compression level of gzip's command line default
+COMPRESS_LEVEL = 6
+# fpm keeps a tarball's scripts under this directory
+SCRIPTS_DIR = '.scripts'
+
+lgr = logger.init()
+
+
+def supports(input_type, output_type):
+    """returns whether a package can be written without fpm
+
+    :param string input_type: the package's source package type
+    :param string output_type: the package's destination package type
+    :rtype: `bool`
+    """
+    return input_type == 'dir' and output_type in ARCHIVE_TYPES
+
+
+class Handler(utils.Handler):
+    """writes tar and tar.gz packages of a directory without fpm
+
+    the sources are walked once and are written (and compressed) to the
+    package in a single pass. the package has the same layout as the one
+    fpm creates: the sources under their full path (relative to /) and
+    the after install script under `.scripts`.
+    """
+    def __init__(self, name, input_type, output_type, source):
+        self.name = name
+        self.output_type = output_type
+        self.source = os.path.abspath(source)
+        self.output = '{0}.{1}'.format(name, output_type)
+
+    def _add_scripts(self, tar, **fpm_params):
+        scripts = [(s, fpm_params[s]) for s in
+                   ('before_install', 'after_install') if fpm_params.get(s)]
+        if not scripts:
+            return
+        scripts_dir = tarfile.TarInfo('./{0}'.format(SCRIPTS_DIR))
+        scripts_dir.type = tarfile.DIRTYPE
+        scripts_dir.mode = 0o755
+        scripts_dir.mtime = time.time()
+        tar.addfile(scripts_dir)
+        for name, script in scripts:
+            info = tar.gettarinfo(script, './{0}/{1}'.format(
+                SCRIPTS_DIR, name))
+            info.mode = 0o755
+            with open(script, 'rb') as f:
+                tar.addfile(info, f)
+
+    def execute(self, **fpm_params):
+        """writes the package to the current directory
+
+        accepts the same params as `fpm.Handler.execute`, of which `force`
+        and the install scripts apply to tarballs.
+
+        :rtype: `bool` representing whether the package was created
+        """
+        if os.path.isfile(self.output):
+            if fpm_params.get('force'):
+                self.rm(self.output)
+            else:
+                lgr.error('{0} already exists and overwrite '
+                          'is false.'.format(self.output))
+                sys.exit(codes.mapping['targz_exists'
+                                       if self.output_type == 'tar.gz'
+                                       else 'failed_create_package'])
+        lgr.debug('Writing {0} from {1}'.format(self.output, self.source))
+        # the package is only created once it was completely written
+        tmp = '.{0}.tmp'.format(self.output)
+        try:
+            if self.output_type == 'tar.gz':
+                tar = tarfile.open(tmp, 'w:gz', compresslevel=COMPRESS_LEVEL)
+            else:
+                tar = tarfile.open(tmp, 'w')
+            try:
+                tar.add('/', arcname='.', recursive=False)
+                parent = '/'
+                for part in self.source.strip('/').split('/')[:-1]:
+                    parent = os.path.join(parent, part)
+                    tar.add(parent, arcname='.' + parent, recursive=False)
+                tar.add(self.source, arcname='.' + self.source)
+                self._add_scripts(tar, **fpm_params)
+            finally:
+                tar.close()
+        except (IOError, OSError, tarfile.TarError) as ex:
+            lgr.error('Failed to write {0} ({1})'.format(self.output, ex))
+            self.rm(tmp)
+            return False
+        os.rename(tmp, self.output)
+        return True
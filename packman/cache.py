@@ -0,0 +1,365 @@
+import utils
+import logger
+
+import hashlib
+import json
+import os
+import sh
+import tempfile
+import time
+
+DEFAULT_CACHE_PATH = os.path.expanduser('~/.packman/cache')
+DEFAULT_MAX_CACHE_SIZE = 5 * 1024 * 1024 * 1024
+# partial downloads which weren't resumed for this long are pruned
+PARTIAL_MAX_AGE = 24 * 60 * 60
+
+lgr = logger.init()
+
+
+def key(url, etag=None, last_modified=None):
+    """returns the cache key of a url's content
+
+    as the same url might serve different content over time, the validators
+    the server sent along with the content are part of the key.
+
+    :param string url: url the content was downloaded from
+    :param string etag: the ETag header the server sent
+    :param string last_modified: the Last-Modified header the server sent
+    :rtype: `string` cache key
+    """
+    return hashlib.sha256('\n'.join(
+        [url, etag or '', last_modified or ''])).hexdigest()
+
+
+def digest_key(sha256):
+    """returns the cache key of content with a known sha256
+
+    :param string sha256: the content's sha256
+    :rtype: `string` cache key
+    """
+    return 'sha256-{0}'.format(sha256)
+
+
+class Handler(utils.Handler):
+    """a content addressed cache of downloaded files
+
+    files are stored under `objects` by their sha256 so that identical
+    files downloaded from different urls are only stored once. each entry
+    under `entries` maps a cache key to an object and records when it was
+    last used. the validators (ETag, Last-Modified) of the latest content
+    downloaded from each url are kept under `urls` so that it can be
+    revalidated with a conditional request. when the cache grows beyond
+    `max_size`, the least recently used objects are removed, along with
+    partial downloads which were never completed.
+
+    the dependency closures resolved for lists of distro packages are kept
+    under `closures` so that they don't have to be resolved again.
+    """
+    def __init__(self, path=None, max_size=None):
+        self.path = path or DEFAULT_CACHE_PATH
+        self.max_size = DEFAULT_MAX_CACHE_SIZE if max_size is None \
+            else max_size
+        self.objects_path = os.path.join(self.path, 'objects')
+        self.entries_path = os.path.join(self.path, 'entries')
+        self.urls_path = os.path.join(self.path, 'urls')
+        self.closures_path = os.path.join(self.path, 'closures')
+        self.tmp_path = os.path.join(self.path, 'tmp')
+
+    def _object(self, sha256):
+        return os.path.join(self.objects_path, sha256[:2], sha256)
+
+    def _entry(self, key):
+        return os.path.join(self.entries_path, '{0}.json'.format(key))
+
+    def _url(self, url):
+        return os.path.join(self.urls_path, '{0}.json'.format(
+            hashlib.sha256(url).hexdigest()))
+
+    def _write(self, path, data):
+        # files are written atomically as several packages might
+        # use the cache at the same time.
+        self.mkdir(os.path.dirname(path))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+
+    def _write_entry(self, key, entry):
+        self._write(self._entry(key), entry)
+
+    def partial(self, key):
+        """returns the path of a cache key's partial download
+
+        a file downloaded to it can later be moved into the cache by
+        `store`. as the content of a key never changes, an interrupted
+        download can be resumed from where it stopped.
+        """
+        self.mkdir(self.tmp_path)
+        return os.path.join(self.tmp_path, '{0}.part'.format(key))
+
+    def lock(self, key, blocking=True):
+        """locks a cache key so that the same content isn't downloaded
+        concurrently by several packages.
+
+        :param bool blocking: whether to wait for the lock. if not, the
+         context yields whether the key was locked.
+        """
+        return utils.flock(os.path.join(
+            self.tmp_path, '{0}.lock'.format(key)), blocking)
+
+    def get(self, key):
+        """returns a cache entry
+
+        :param string key: cache key
+        :rtype: `dict` representing the entry or `None` if not cached
+        """
+        try:
+            with open(self._entry(key)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        obj = self._object(entry['sha256'])
+        if not os.path.isfile(obj) or os.path.getsize(obj) != entry['size']:
+            lgr.debug('Cached file for {0} is missing or damaged.'.format(
+                entry.get('url')))
+            self.rm(self._entry(key))
+            return None
+        return entry
+
+    def fetch(self, key, destination, sha256=None):
+        """copies a cached file to a destination
+
+        the file is reflinked where the filesystem supports it. it is never
+        hardlinked, as changing the file at its destination (e.g. rendering
+        a config into it) would change the cached file as well.
+
+        :param string key: cache key
+        :param string destination: path to link the cached file to
+        :param string sha256: if supplied, the cached file is only used
+         if it has this checksum
+        :rtype: `bool` representing whether the file was cached
+        """
+        entry = self.get(key)
+        if not entry or (sha256 and not entry['sha256'] == sha256):
+            return False
+        lgr.debug('Using cached {0}'.format(entry.get('url')))
+        try:
+            self.link(self._object(entry['sha256']), destination,
+                      hardlink=False)
+            os.chmod(destination, 0o644)
+        except (OSError, sh.ErrorReturnCode):
+            # the object was pruned in the meantime
+            return False
+        entry['accessed'] = time.time()
+        self._write_entry(key, entry)
+        return True
+
+    def store(self, key, source, sha256, **metadata):
+        """moves a file into the cache
+
+        the file is also stored under its digest key (see `digest_key`)
+        so that it can later be found by its checksum alone.
+
+        :param string key: cache key
+        :param string source: file to move. must reside in the cache's
+         temporary directory (see `partial`)
+        :param string sha256: the file's sha256
+        :param dict metadata: additional data to store in the entry
+        """
+        obj = self._object(sha256)
+        self.mkdir(os.path.dirname(obj))
+        if os.path.isfile(obj):
+            os.remove(source)
+        else:
+            # cached files must never change
+            os.chmod(source, 0o444)
+            os.rename(source, obj)
+        entry = dict(metadata)
+        entry.update({
+            'sha256': sha256,
+            'size': os.path.getsize(obj),
+            'accessed': time.time(),
+        })
+        self._write_entry(key, entry)
+        if not key == digest_key(sha256):
+            self._write_entry(digest_key(sha256), entry)
+
+    def validators(self, url):
+        """returns the validators of the latest cached content of a url
+
+        :param string url: url to return the validators for
+        :rtype: `dict` containing the entry's `key`, `etag` and
+         `last_modified` or `None` if the url's content isn't cached
+        """
+        try:
+            with open(self._url(url)) as f:
+                validators = json.load(f)
+        except (IOError, ValueError):
+            return None
+        return validators if self.get(validators['key']) else None
+
+    def set_validators(self, url, key, etag=None, last_modified=None):
+        """sets the latest cached content of a url
+
+        :param string url: url the content was downloaded from
+        :param string key: the content's cache key
+        :param string etag: the ETag header the server sent
+        :param string last_modified: the Last-Modified header the server sent
+        """
+        self._write(self._url(url), {
+            'key': key,
+            'etag': etag,
+            'last_modified': last_modified,
+        })
+
+    def closure(self, key):
+        """returns a cached dependency closure
+
+        :param string key: the closure's key
+        :rtype: `list` of sources (see `set_closure`) or `None` if
+         the closure isn't cached
+        """
+        try:
+            with open(os.path.join(
+                    self.closures_path, '{0}.json'.format(key))) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def set_closure(self, key, sources):
+        """caches a dependency closure
+
+        :param string key: the closure's key
+        :param list sources: the sources (urls or dicts containing a `url`
+         and a `sha256`) of all packages in the closure
+        """
+        self._write(os.path.join(
+            self.closures_path, '{0}.json'.format(key)), sources)
+
+    def entries(self):
+        """returns all cache entries (except for the entries stored under
+        digest keys)
+
+        :rtype: `list` of (key, entry) tuples
+        """
+        return [(k, e) for k, e in self._entries()
+                if not k == digest_key(e['sha256'])]
+
+    def _entries(self):
+        if not os.path.isdir(self.entries_path):
+            return []
+        entries = []
+        for entry_file in sorted(os.listdir(self.entries_path)):
+            if not entry_file.endswith('.json'):
+                continue
+            entry_key = os.path.splitext(entry_file)[0]
+            entry = self.get(entry_key)
+            if entry:
+                entries.append((entry_key, entry))
+        return entries
+
+    def _partials(self):
+        if not os.path.isdir(self.tmp_path):
+            return []
+        partials = []
+        for name in sorted(os.listdir(self.tmp_path)):
+            # segmented downloads are assembled in <key>.part.segments
+            if '.part' not in name:
+                continue
+            path = os.path.join(self.tmp_path, name)
+            try:
+                partials.append((name.split('.')[0], path,
+                                 os.path.getsize(path),
+                                 os.path.getmtime(path)))
+            except OSError:
+                continue
+        return partials
+
+    def size(self):
+        """returns the size of all cached files in bytes
+        """
+        return sum(dict((e['sha256'], e['size'])
+                        for _, e in self.entries()).values())
+
+    def prune(self, max_size=None):
+        """removes the least recently used files until the cache
+        is no larger than `max_size`
+
+        partial downloads count towards the cache's size. those which
+        weren't resumed for `PARTIAL_MAX_AGE` (e.g. as the url's content
+        has changed since) are always removed. partial downloads which are
+        in progress are never removed.
+
+        :param int max_size: max cache size in bytes. if omitted, the
+         cache's `max_size` is used.
+        :rtype: `int` number of removed files
+        """
+        max_size = self.max_size if max_size is None else max_size
+        entries = self._entries()
+        # an object might be used by several entries (urls)
+        objects = {}
+        for _, entry in entries:
+            _, accessed = objects.get(entry['sha256'], (0, 0))
+            objects[entry['sha256']] = (
+                entry['size'], max(accessed, entry['accessed']))
+        total = sum(size for size, _ in objects.values())
+        stale = time.time() - PARTIAL_MAX_AGE
+        removed_partials = 0
+        for partial_key, path, size, modified in self._partials():
+            total += size
+            objects[path] = (size, modified)
+            if modified < stale and self._remove_partial(partial_key, path):
+                removed_partials += 1
+                total -= size
+                del objects[path]
+        removed = set()
+        for name, (size, _) in sorted(
+                objects.items(), key=lambda o: o[1][1]):
+            if total <= max_size:
+                break
+            if name.startswith(self.tmp_path):
+                if not self._remove_partial(
+                        os.path.basename(name).split('.')[0], name):
+                    continue
+                removed_partials += 1
+            else:
+                lgr.debug('Removing {0} from cache'.format(name))
+                self.rm(self._object(name))
+                removed.add(name)
+            total -= size
+        for entry_key, entry in entries:
+            if entry['sha256'] in removed:
+                self.rm(self._entry(entry_key))
+        if removed and os.path.isdir(self.urls_path):
+            for url_file in os.listdir(self.urls_path):
+                url_file = os.path.join(self.urls_path, url_file)
+                try:
+                    with open(url_file) as f:
+                        url_key = json.load(f)['key']
+                except (IOError, ValueError, KeyError):
+                    continue
+                if not os.path.isfile(self._entry(url_key)):
+                    self.rm(url_file)
+        return len(removed) + removed_partials
+
+    def _remove_partial(self, key, path):
+        with self.lock(key, blocking=False) as locked:
+            if not locked:
+                return False
+            lgr.debug('Removing partial download {0}'.format(path))
+            self.rm(path)
+            return True
+
+    def ls(self):
+        """logs the cached files, most recently used first
+        """
+        entries = sorted(self.entries(), key=lambda e: -e[1]['accessed'])
+        for _, entry in entries:
+            lgr.info('{0}  {1:>10.2f} MB  {2}  {3}'.format(
+                entry['sha256'][:12], entry['size'] / 1024.0 / 1024.0,
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(entry['accessed'])),
+                entry.get('url')))
+        lgr.info('{0} entries, {1:.2f} MB (max {2:.2f} MB) in {3}'.format(
+            len(entries), self.size() / 1024.0 / 1024.0,
+            self.max_size / 1024.0 / 1024.0, self.path))
@@ -39,5 +39,21 @@ mapping = {
     'could_not_write_to_file': 38,
     'failed_to_download_gem': 39,
     'overriding_modules_import_error': 40,
+    'jobs_must_be_positive': 41,
+    'package_action_failed': 42,
+    'cyclic_package_dependencies': 43,
+    'after_must_be_list': 44,
+    'queue_depth_must_be_positive': 45,
+    'max_size_must_be_a_number': 46,
+    'invalid_checksums_manifest': 47,
+    'source_url_missing': 48,
+    'apt_get_failed': 49,
+    'yum_failed': 50,
+    'failed_to_refresh_metadata': 51,
+    'mirror_not_found': 52,
+    'invalid_python_modules_format': 53,
+    'failed_to_resolve_node_package': 54,
+    'mirror_not_supported_by_distro': 55,
+    'max_age_must_be_a_number': 56,
 
 }
@@ -18,6 +18,7 @@ PARAM_OVERWRITE_OUTPUT = 'overwrite_package'  # an optional bool representing wh
 PARAM_OVERWRITE_SOURCES = 'overwrite_sources'  # an optional bool representing whether to overwrite sources when retrieving package sources
 PARAM_CONFIG_TEMPLATE_CONFIG = 'config_templates'  # an optional {dict} of config files and templates
 PARAM_PYTHON_MODULES = 'python_modules'  # an optional [list] of python modules to install into a virtualenv
+PARAM_PYTHON_MODULES_FORMAT = 'python_modules_format'  # an optional 'string' representing the format to download python modules in: 'wheel' (default. wheels where available), 'sdist' or 'wheelhouse' (wheels are built for all modules)
 PARAM_RUBY_GEMS = 'ruby_gems'  # an optional [list] of ruby gems to download
 PARAM_VIRTUALENV = 'virtualenv'  # an optional {dict} containing a venv path and a [list] of modules to install
 PARAM_NODE_PACKAGES = 'node_packages'  # an optional [list] of node packages to download
@@ -25,9 +26,13 @@ PARAM_SOURCE_URLS = 'source_urls'  # an optional 'string' representing the sourc
 PARAM_SOURCE_REPOS = 'source_repos'  # an optional 'string' representing repos to add to the repos list
 PARAM_SOURCE_PPAS = 'source_ppas'  # an optional 'string' representing a ppa repository to add
 PARAM_SOURCE_KEYS = 'source_keys'  # an optional 'string' representing a key to download
+PARAM_METADATA_TTL = 'metadata_ttl'  # an optional 'int' representing the number of seconds after which the repos' metadata is refreshed even if no repos or keys were added
+PARAM_SOURCES_MANIFEST = 'sources_manifest'  # an optional 'string' representing a sha256sum formatted file containing the checksums of the sources to download
 PARAM_REQS = 'requires'  # an optional [list] of requirements to download from the local distributions repos
+PARAM_RESOLVE_REQS = 'resolve_requires'  # an optional bool representing whether to download the full dependency closure of the requirements (rather than only what's missing on the local machine)
 PARAM_PREREQS = 'prereqs'  # an optional [list] of prerequirements to install from before retrieving the sources or packgaging
 PARAM_KEEP_SOURCES = 'keep_sources'  # an optional 'bool' representing whether to keep the retrieved sources after packaging
+PARAM_AFTER = 'after'  # an optional [list] of packages which must be handled before this package (packages it `depends` on are handled before it anyway)
 
 # packman configuration files generation params
 PARAM_CONFIG_TEMPLATE_DIR = 'template_dir'  # an optional 'dict' containing config for generating config files from a templates directory
@@ -0,0 +1,201 @@
+import utils
+import logger
+
+import glob
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import time
+
+INDEX_PATH = os.path.expanduser('~/.packman/index')
+# files modified this recently are always hashed again
+RACY_INTERVAL = 2
+
+lgr = logger.init()
+
+
+def _index_file(path):
+    return os.path.join(INDEX_PATH, '{0}.json'.format(
+        hashlib.sha256(os.path.abspath(path)).hexdigest()))
+
+
+def _load_index(path):
+    try:
+        with open(_index_file(path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_index(path, index):
+    index_file = _index_file(path)
+    utils.Handler().mkdir(INDEX_PATH)
+    # several packages might be packed at the same time
+    fd, tmp = tempfile.mkstemp(dir=INDEX_PATH)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp, index_file)
+
+
+def tree_hash(path, index=True):
+    """returns a hash of a directory tree
+
+    the hash covers the relative path, type and mode of every file and
+    directory in the tree and the content of every file (or the target of
+    every symlink), so that it changes whenever anything fpm would package
+    changes.
+
+    the hash of every file is kept in an index (under `INDEX_PATH`) along
+    with its size, mtime and inode. a file is only read again if any of
+    them changed, so hashing an unchanged tree only requires stat calls.
+
+    :param string path: directory to hash
+    :param bool index: whether to use the index
+    :rtype: `string` sha256 hex digest
+    """
+    previous = _load_index(path) if index else {}
+    current = {}
+    # a file modified right after it was hashed might keep the same mtime.
+    # the hashes of recently modified files are therefore not kept.
+    racy = time.time() - RACY_INTERVAL
+    tree = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            full_path = os.path.join(root, name)
+            relative_path = os.path.relpath(full_path, path)
+            st = os.lstat(full_path)
+            tree.update('{0}\0{1:o}\0'.format(relative_path, st.st_mode))
+            if stat.S_ISLNK(st.st_mode):
+                tree.update(os.readlink(full_path))
+            elif stat.S_ISREG(st.st_mode):
+                file_stat = [st.st_size, st.st_mtime, st.st_ino]
+                entry = previous.get(relative_path)
+                if entry and entry[:3] == file_stat:
+                    sha256 = entry[3]
+                else:
+                    sha256 = file_hash(full_path)
+                if st.st_mtime < racy:
+                    current[relative_path] = file_stat + [sha256]
+                tree.update(sha256)
+            tree.update('\0')
+    if index and not current == previous:
+        _save_index(path, current)
+    return tree.hexdigest()
+
+
+def file_hash(path):
+    """returns the sha256 of a file's content
+
+    :param string path: file to hash
+    :rtype: `string` sha256 hex digest
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Handler(utils.Handler):
+    """keeps a build fingerprint next to each package's output
+
+    the fingerprint covers everything a package is built from: its config,
+    its bootstrap script and its sources (including the configs rendered
+    into them). if the fingerprint hasn't changed since the package was
+    last built and all of its output files still exist, the package
+    doesn't have to be built again.
+    """
+    def __init__(self, package_path, name):
+        """
+        :param string package_path: directory the package is created in
+        :param string name: the package's name
+        """
+        self.package_path = package_path
+        self.name = name
+        self.path = os.path.join(
+            package_path, '.{0}.fingerprint'.format(name))
+
+    def compute(self, package, sources_path, bootstrap_script=None):
+        """returns a package's build fingerprint
+
+        :param dict package: the package's config
+        :param string sources_path: the package's sources path
+        :param string bootstrap_script: path to the package's bootstrap
+         script, if it has one
+        :rtype: `string` sha256 hex digest
+        """
+        fingerprint = hashlib.sha256()
+        fingerprint.update(json.dumps(package, sort_keys=True, default=str))
+        fingerprint.update('\0')
+        if bootstrap_script and os.path.isfile(bootstrap_script):
+            fingerprint.update(file_hash(bootstrap_script))
+        fingerprint.update('\0')
+        fingerprint.update(tree_hash(sources_path))
+        return fingerprint.hexdigest()
+
+    def outputs(self):
+        """returns the files in the package path which might be
+        the package's output
+
+        :rtype: `dict` mapping file names to their (mtime, size, inode)
+        """
+        outputs = {}
+        for f in glob.glob(os.path.join(
+                self.package_path, '{0}*'.format(self.name))):
+            st = os.stat(f)
+            if stat.S_ISREG(st.st_mode):
+                outputs[os.path.basename(f)] = \
+                    (st.st_mtime, st.st_size, st.st_ino)
+        return outputs
+
+    def matches(self, fingerprint):
+        """returns whether the package was already built from
+        the same fingerprint
+
+        :param string fingerprint: the package's current fingerprint
+        :rtype: `bool`
+        """
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if not saved.get('fingerprint') == fingerprint:
+            lgr.debug('{0} changed since it was last built.'.format(
+                self.name))
+            return False
+        missing = [o for o in saved.get('outputs', []) if not os.path.isfile(
+            os.path.join(self.package_path, o))]
+        if not saved.get('outputs') or missing:
+            lgr.debug('Outputs of {0} are missing: {1}'.format(
+                self.name, missing))
+            return False
+        return True
+
+    def save(self, fingerprint, before):
+        """saves the fingerprint the package was built from
+
+        :param string fingerprint: the package's fingerprint
+        :param dict before: the package path's `outputs` before the package
+         was built. files which were created or changed since are recorded
+         as the build's outputs.
+        """
+        outputs = sorted(name for name, st in self.outputs().items()
+                         if not before.get(name) == st)
+        lgr.debug('Saving fingerprint of {0} (outputs: {1})'.format(
+            self.name, outputs))
+        with open(self.path, 'w') as f:
+            json.dump({
+                'fingerprint': fingerprint,
+                'outputs': outputs,
+                'created': time.time(),
+            }, f)
+
+    def remove(self):
+        """removes the saved fingerprint so that the package is
+        built again
+        """
+        self.rm(self.path)
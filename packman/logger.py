@@ -78,3 +78,29 @@ def init(base_level=DEFAULT_BASE_LOGGING_LEVEL,
                  ' verify your logger config'
                  ' and permissions to write to {0} ({1})'
                  .format(log_file, e))
+
+
+class PrefixFilter(logging.Filter):
+    """prepends a prefix to every message passing through a logger
+    """
+    def __init__(self, prefix):
+        logging.Filter.__init__(self)
+        self.prefix = prefix
+
+    def filter(self, record):
+        record.msg = '[{0}] {1}'.format(self.prefix, record.msg)
+        return True
+
+
+def set_prefix(lgr, prefix=None):
+    """sets (or clears) the prefix of all messages logged by `lgr`
+
+    this is used to tell apart the output of packages handled concurrently.
+
+    :param logger lgr: logger to set the prefix for
+    :param string prefix: prefix to set. if omitted, the prefix is removed.
+    """
+    for f in [f for f in lgr.filters if isinstance(f, PrefixFilter)]:
+        lgr.removeFilter(f)
+    if prefix:
+        lgr.addFilter(PrefixFilter(prefix))
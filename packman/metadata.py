@@ -0,0 +1,97 @@
+import utils
+import logger
+import codes
+
+import glob
+import hashlib
+import json
+import os
+import sh
+import sys
+import time
+
+DEFAULT_STATE_PATH = os.path.expanduser('~/.packman/metadata')
+# seconds after which the repos' metadata is refreshed even if
+# the sources didn't change
+DEFAULT_METADATA_TTL = 60 * 60
+
+lgr = logger.init()
+
+
+def sources_state(sources):
+    """returns a hash of the content of a set of repo source files
+
+    :param list sources: paths (or glob patterns) of the source files
+    :rtype: `string` sha256 hex digest
+    """
+    state = hashlib.sha256()
+    for pattern in sources:
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    state.update('{0}\0{1}\0'.format(path, f.read()))
+    return state.hexdigest()
+
+
+class Handler(utils.Handler):
+    """refreshes the local repos' metadata only when it's required
+
+    the metadata is refreshed if the repo sources (e.g. sources.list, keys)
+    changed since it was last refreshed or if it is older than the TTL.
+    the time and sources of the last refresh are kept on disk, so all
+    packages handled in a run (and later runs) share them.
+    """
+    def __init__(self, name, sources, path=None):
+        """
+        :param string name: name of the package manager (e.g. apt)
+        :param list sources: paths (or glob patterns) of the files which
+         configure the package manager's repos
+        :param string path: where to keep the state of the last refresh
+        """
+        self.name = name
+        self.sources = sources
+        self.path = path or DEFAULT_STATE_PATH
+        self.state_file = os.path.join(self.path, '{0}.json'.format(name))
+
+    def _lock(self):
+        # packages handled concurrently must not refresh at the same time
+        return utils.flock(os.path.join(
+            self.path, '{0}.lock'.format(self.name)))
+
+    def _state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def refresh(self, update, ttl=None, changed=False):
+        """refreshes the repos' metadata if the sources changed or the
+        metadata expired
+
+        :param update: function which refreshes the metadata
+        :param int ttl: seconds after which the metadata expires
+        :param bool changed: whether the caller knows that the sources
+         changed (in which case the metadata is always refreshed)
+        :rtype: `bool` representing whether the metadata was refreshed
+        """
+        ttl = DEFAULT_METADATA_TTL if ttl is None else ttl
+        with self._lock():
+            state = self._state()
+            sources = sources_state(self.sources)
+            age = time.time() - state.get('refreshed', 0)
+            if not changed and state.get('sources') == sources and \
+                    age < ttl:
+                lgr.debug('{0} metadata is up to date (refreshed {1:.0f}s '
+                          'ago).'.format(self.name, age))
+                return False
+            lgr.info('Refreshing {0} metadata...'.format(self.name))
+            try:
+                update()
+            except sh.ErrorReturnCode as ex:
+                lgr.error('Failed to refresh {0} metadata ({1})'.format(
+                    self.name, ex.stderr.strip()))
+                sys.exit(codes.mapping['failed_to_refresh_metadata'])
+            with open(self.state_file, 'w') as f:
+                json.dump({'sources': sources, 'refreshed': time.time()}, f)
+            return True
@@ -0,0 +1,96 @@
+import utils
+import logger
+import codes
+
+import gzip
+import os
+import sh
+import sys
+
+DEFAULT_MIRROR_PATH = os.path.expanduser('~/.packman/mirror')
+ARCHIVE_EXTENSIONS = ('.deb', '.rpm')
+
+lgr = logger.init()
+
+
+class Handler(utils.Handler):
+    """a local flat repo of all debs and rpms retrieved by packages
+
+    the archives packman downloads to each package's `sources_path/archives`
+    are copied into the mirror, which is then indexed so that apt or yum
+    can install and download packages from it along with (or instead of)
+    the upstream repos.
+    """
+    def __init__(self, path=None):
+        self.path = os.path.abspath(path or DEFAULT_MIRROR_PATH)
+
+    def add(self, sources_path):
+        """adds the archives retrieved for a package to the mirror
+
+        archives which are already in the mirror are skipped.
+
+        :param string sources_path: the package's sources path
+        :rtype: `list` of added archives
+        """
+        archives_path = os.path.join(sources_path, 'archives')
+        if not os.path.isdir(archives_path):
+            lgr.debug('No archives found in {0}'.format(sources_path))
+            return []
+        self.mkdir(self.path)
+        added = []
+        for archive in sorted(os.listdir(archives_path)):
+            if not os.path.splitext(archive)[1] in ARCHIVE_EXTENSIONS:
+                continue
+            source = os.path.join(archives_path, archive)
+            destination = os.path.join(self.path, archive)
+            if os.path.isfile(destination) and \
+                    os.path.getsize(destination) == os.path.getsize(source):
+                continue
+            lgr.debug('Adding {0} to mirror'.format(archive))
+            # the archive is copied, so that changing it in the sources dir
+            # doesn't change the mirror's copy
+            self.link(source, destination, hardlink=False)
+            added.append(archive)
+        return added
+
+    def archives(self, extension):
+        """returns the archives in the mirror
+
+        :param string extension: archive type (.deb or .rpm)
+        :rtype: `list` of archive names
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(a for a in os.listdir(self.path)
+                      if os.path.splitext(a)[1] == extension)
+
+    def index(self):
+        """generates the mirror's indexes (Packages for debs and repodata
+        for rpms)
+        """
+        if self.archives('.deb'):
+            lgr.info('Indexing {0} debs in {1}...'.format(
+                len(self.archives('.deb')), self.path))
+            with utils.chdir(self.path):
+                packages = str(sh.dpkg_scanpackages('.', '/dev/null'))
+            with open(os.path.join(self.path, 'Packages'), 'w') as f:
+                f.write(packages)
+            with gzip.open(os.path.join(self.path, 'Packages.gz'), 'w') as f:
+                f.write(packages)
+        if self.archives('.rpm'):
+            lgr.info('Indexing {0} rpms in {1}...'.format(
+                len(self.archives('.rpm')), self.path))
+            if os.path.isdir(os.path.join(self.path, 'repodata')):
+                sh.createrepo('--update', self.path)
+            else:
+                sh.createrepo(self.path)
+
+    def validate(self, index):
+        """exits if the mirror wasn't indexed
+
+        :param string index: the index apt or yum requires (e.g. Packages)
+        """
+        if not os.path.exists(os.path.join(self.path, index)):
+            lgr.error('{0} is not a packman mirror. Run pkm mirror to '
+                      'create it.'.format(self.path))
+            sys.exit(codes.mapping['mirror_not_found'])
@@ -0,0 +1,218 @@
+import logger
+import utils
+import retrieve
+import codes
+
+import json
+import os
+import re
+import sh
+import sys
+import tempfile
+
+# a local cache of all downloaded node package tarballs, shared by all
+# packages (a tarball's content never changes for a given version)
+DEFAULT_NODE_CACHE_PATH = os.path.expanduser('~/.packman/node')
+DEFAULT_REGISTRY = 'https://registry.npmjs.org'
+DEFAULT_RESOLVE_WORKERS = 4
+# the metadata of an exact version never changes, so it's cached
+EXACT_VERSION = re.compile(r'^\d+\.\d+\.\d+(-[0-9A-Za-z.-]+)?$')
+# dependencies with other specs (e.g. git urls) aren't in the registry
+REGISTRY_SPEC = re.compile(r'^[\w.*^~<>=| +-]*$')
+
+lgr = logger.init()
+
+# the packages resolved by this process, keyed by their specs
+# (e.g. express@^4)
+_resolved = {}
+
+
+def split_package(package):
+    """returns a package's name and version spec
+
+    :param string package: package (e.g. express, express@^4.0.0,
+     @scope/name@1.0.0)
+    :rtype: `tuple` of the package's name and version spec (`latest`
+     if omitted)
+    """
+    # the name of a scoped package starts with an @ as well
+    at = package.find('@', 1)
+    if at == -1:
+        return package, 'latest'
+    return package[:at], package[at + 1:] or 'latest'
+
+
+def tarball_url(name, version, registry=DEFAULT_REGISTRY):
+    """returns the url of a package's tarball in a registry
+
+    :param string name: the package's name
+    :param string version: the package's exact version
+    :param string registry: the registry's url
+    """
+    return '{0}/{1}/-/{2}-{3}.tgz'.format(
+        registry, name, name.split('/')[-1], version)
+
+
+def tarball_name(name, version):
+    """returns the file name of a package's tarball (as created by
+    `npm pack`)
+    """
+    return '{0}-{1}.tgz'.format(
+        name.lstrip('@').replace('/', '-'), version)
+
+
+def _metadata_path(cache_path, name, version):
+    return os.path.join(cache_path, 'metadata', '{0}@{1}.json'.format(
+        name.replace('/', '%2F'), version))
+
+
+class Handler(utils.Handler):
+    """Node operations handler
+
+    all packages and their dependencies (recursively) are resolved
+    (concurrently, a level of the dependency tree at a time) to their
+    exact versions, which are downloaded (concurrently) to a local tarball
+    cache and linked from it to the sources path.
+
+    the metadata of exact versions is kept in the tarball cache, so it's
+    only retrieved once for all packages and runs. version ranges are
+    resolved again by every package (as new versions might match them),
+    but only once per package.
+    """
+    def registry(self):
+        """returns the configured npm registry
+        """
+        try:
+            registry = str(sh.npm('config', 'get', 'registry')).strip()
+        except sh.ErrorReturnCode:
+            registry = None
+        return (registry or DEFAULT_REGISTRY).rstrip('/')
+
+    def resolve(self, package, registry=DEFAULT_REGISTRY, cache_path=None):
+        """resolves a package to its exact version
+
+        :param string package: package to resolve
+        :param string registry: the registry's url
+        :param string cache_path: path of the local tarball cache
+        :rtype: `tuple` of the package's name, version, tarball url and
+         dependencies (a `list` of packages)
+        """
+        if package in _resolved:
+            return _resolved[package]
+        cache_path = cache_path or DEFAULT_NODE_CACHE_PATH
+        name, spec = split_package(package)
+        if EXACT_VERSION.match(spec):
+            try:
+                with open(_metadata_path(cache_path, name, spec)) as f:
+                    metadata = json.load(f)
+                _resolved[package] = (
+                    name, spec, metadata['tarball'], metadata['dependencies'])
+                return _resolved[package]
+            except (IOError, ValueError, KeyError):
+                pass
+        lgr.debug('Resolving node package {0}'.format(package))
+        try:
+            o = sh.npm('view', package, 'name', 'version', 'dist.tarball',
+                       'dependencies', '--json')
+            view = json.loads(str(o) or 'null')
+        except (sh.ErrorReturnCode, ValueError) as ex:
+            lgr.error('Failed to resolve node package {0} ({1})'.format(
+                package, getattr(ex, 'stderr', ex)))
+            sys.exit(codes.mapping['failed_to_resolve_node_package'])
+        # npm lists all versions matching a range (the latest last)
+        if isinstance(view, list):
+            view = view[-1] if view else None
+        if not view:
+            lgr.error('No version of node package {0} was found.'.format(
+                package))
+            sys.exit(codes.mapping['failed_to_resolve_node_package'])
+        version = view['version']
+        tarball = view.get('dist.tarball') or \
+            tarball_url(name, version, registry)
+        dependencies = sorted('{0}@{1}'.format(n, s) for n, s in
+                              (view.get('dependencies') or {}).items())
+        metadata_file = _metadata_path(cache_path, name, version)
+        self.mkdir(os.path.dirname(metadata_file))
+        # written atomically as several packages might resolve it at once
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(metadata_file))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'tarball': tarball, 'dependencies': dependencies}, f)
+        os.rename(tmp, metadata_file)
+        _resolved[package] = (name, version, tarball, dependencies)
+        return _resolved[package]
+
+    def resolve_tree(self, packages, registry=DEFAULT_REGISTRY,
+                     cache_path=None):
+        """resolves a list of packages and all of their dependencies
+
+        :param list packages: packages to resolve
+        :param string registry: the registry's url
+        :param string cache_path: path of the local tarball cache
+        :rtype: `list` of (name, version, tarball url) tuples, each exact
+         version listed once
+        """
+        resolved = []
+        specs = []
+        for package in packages:
+            if package not in specs:
+                specs.append(package)
+        seen = set(specs)
+        while specs:
+            results = utils.concurrently(
+                lambda package: self.resolve(package, registry, cache_path),
+                specs, DEFAULT_RESOLVE_WORKERS)
+            specs = []
+            for name, version, url, dependencies in results:
+                if (name, version, url) in resolved:
+                    continue
+                resolved.append((name, version, url))
+                for dependency in dependencies:
+                    if dependency in seen:
+                        continue
+                    seen.add(dependency)
+                    if REGISTRY_SPEC.match(split_package(dependency)[1]):
+                        specs.append(dependency)
+                    else:
+                        lgr.warning('Dependency {0} of {1}@{2} is not in '
+                                    'the registry and is skipped.'.format(
+                                        dependency, name, version))
+        return resolved
+
+    def get_packages(self, packages, dir, cache_path=None,
+                     workers=retrieve.DEFAULT_DOWNLOAD_WORKERS):
+        """downloads a list of node package tarballs along with the
+        tarballs of all of their dependencies
+
+        :param list packages: packages to download
+        :param string dir: directory to download the tarballs to
+        :param string cache_path: path of the local tarball cache
+        :param int workers: number of concurrent downloads
+        """
+        if not packages:
+            return
+        cache_path = cache_path or DEFAULT_NODE_CACHE_PATH
+        registry = self.registry()
+        tarballs = []
+        for name, version, url in self.resolve_tree(
+                packages, registry, cache_path):
+            # scoped packages are cached under their scope
+            cached = os.path.join(
+                cache_path, name.split('/')[0] if '/' in name else '',
+                url.split('/')[-1])
+            tarball = (tarball_name(name, version), cached, url)
+            if tarball not in tarballs:
+                tarballs.append(tarball)
+        missing = {}
+        for _, cached, url in tarballs:
+            if not os.path.isfile(cached):
+                missing.setdefault(os.path.dirname(cached), []).append(url)
+        for cache_dir, urls in missing.items():
+            lgr.debug('Downloading node packages {0}'.format(
+                ', '.join(u.split('/')[-1] for u in urls)))
+            self.mkdir(cache_dir)
+            retrieve.Handler().downloads(urls, dir=cache_dir, workers=workers)
+        self.mkdir(dir)
+        # the cached tarballs are copied, so that changing them in the
+        # sources dir doesn't change them for every other package
+        for name, cached, _ in tarballs:
+            self.link(cached, os.path.join(dir, name), hardlink=False)
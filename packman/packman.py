@@ -25,10 +25,16 @@ import python
 import yum
 import retrieve
 import apt
+import cache
 import ruby
+import node
 import templater
 import fpm
+import archive
+import fingerprint
+import mirror
 import codes
+from scheduler import Scheduler
 # import importlib
 
 import definitions as defs
@@ -105,8 +111,50 @@ def get_package_config(package_name, packages_dict=None,
         sys.exit(codes.mapping['no_config_found_for_package'])
 
 
+def _run_action(action, package, package_dict):
+    """runs `action` for a single package
+
+    if a pack.py or get.py files are present, and an action_package
+    function exists in the files, those functions will be used.
+    else, the base get and pack methods supplied with packman will be used.
+
+    :param string action: action to perform (get, pack)
+    :param string package: name of the package to perform `action` on
+    :param dict package_dict: the package's configuration
+    """
+    def import_overriding_methods(action):
+        lgr.debug('Importing overriding methods file...')
+        sys.path.append(os.getcwd())
+        return __import__(action)
+
+    def rename_package(package):
+        # this is meant to unify package names so that common
+        # dashes, hyphens, dots and case errors do not occur.
+        package_re = package.replace('-', '_')
+        package_re = package_re.replace('.', '')
+        package_re = package_re.lower()
+        return package_re
+
+    # looks for the overriding methods file in the current path
+    if os.path.isfile(os.path.join(
+            os.getcwd(), '{0}.py'.format(action))):
+        # TODO: allow sending parameters to the overriding methods
+        overr_methods = import_overriding_methods(action)
+        package = rename_package(package)
+        # if the method was found in the overriding file, run it.
+        if hasattr(overr_methods, '{0}_{1}'.format(action, package)):
+            getattr(overr_methods, '{0}_{1}'.format(action, package))()
+        # else run the default action method
+        else:
+            # TODO: check for bad action
+            globals()[action](package_dict)
+    else:
+        globals()[action](package_dict)
+
+
 def packman_runner(action, packages_file=None, packages=None,
-                   excluded=None, verbose=False):
+                   excluded=None, verbose=False, jobs=1, queue_depth=None,
+                   mirror_path=None, mirror_only=False):
     """logic for running packman. mainly called from the cli (pkm.py)
 
     if no `packages_file` is supplied, we will assume a local packages.yaml
@@ -121,12 +169,34 @@ def packman_runner(action, packages_file=None, packages=None,
     so for instance, if you have a package named `x`, and you want to write
     your own `get` function for it. Just write a get_x() function in get.py.
 
-    :param string action: action to perform (get, pack)
+    the `make` action gets and packs every package. a package is packed as
+    soon as it is retrieved, while the next packages are still being
+    retrieved.
+
+    packages are handled in dependency order: a package which `depends` on
+    another package (or lists it under `after`) will only be handled after
+    that package is done. if `jobs` is larger than 1, up to `jobs` packages
+    whose prerequisites are done will be handled concurrently, each in its
+    own process.
+
+    the `mirror` action adds the debs and rpms retrieved for every package
+    to a local mirror (at `mirror_path`) and indexes it. if a `mirror_path`
+    is supplied to get or make, the mirror is added to the repos so that
+    requirements are retrieved from it. if `mirror_only` is set, they're
+    retrieved from the mirror (which defaults to ~/.packman/mirror) alone.
+
+    :param string action: action to perform (get, pack, make, mirror)
     :param string packages_file: path to file containing package config
     :param string packages: comma delimited list of packages to perform
      `action` on.
     :param string excluded: comma delimited list of packages to exclude
     :param bool verbose: determines output verbosity level
+    :param int jobs: number of packages to handle concurrently
+    :param int queue_depth: (make only) max number of retrieved packages
+     which may wait to be packed before retrieval is paused
+    :param string mirror_path: path of a local mirror
+    :param bool mirror_only: whether to use the mirror instead of the
+     configured repos
     :rtype: `None`
     """
     def build_excluded_packages_list(excluded_packages):
@@ -146,25 +216,18 @@ def packman_runner(action, packages_file=None, packages=None,
                 sys.exit(codes.mapping['excluded_conflict'])
         # else iterate over all packages in packages file
         else:
-            package_list = [p for p in packages_dict.keys()]
+            package_list = sorted(packages_dict.keys())
             # and rewrite the list after removing excluded packages
             for xcld in xcluded_packages_list:
                 package_list = [pkg for pkg in package_list if pkg != xcld]
         return package_list
 
-    def import_overriding_methods(action):
-        lgr.debug('Importing overriding methods file...')
-        sys.path.append(os.getcwd())
-        return __import__(action)
-
-    def rename_package(package):
-        # this is meant to unify package names so that common
-        # dashes, hyphens, dots and case errors do not occur.
-        package_re = package.replace('-', '_')
-        package_re = package_re.replace('.', '')
-        package_re = package_re.lower()
-        return package_re
-
+    if jobs < 1:
+        lgr.error('The number of jobs must be at least 1.')
+        sys.exit(codes.mapping['jobs_must_be_positive'])
+    if queue_depth is not None and queue_depth < 1:
+        lgr.error('The queue depth must be at least 1.')
+        sys.exit(codes.mapping['queue_depth_must_be_positive'])
     utils.set_global_verbosity_level(verbose)
     packages_dict = _import_packages_dict(packages_file)
     xcluded_packages_list = build_excluded_packages_list(excluded)
@@ -175,6 +238,7 @@ def packman_runner(action, packages_file=None, packages=None,
     lgr.debug('Package list: {0}'.format(package_list))
     # if at least 1 package exists
     if package_list:
+        package_dicts = []
         for package in package_list:
             package_dict = get_package_config(
                 package_name=package,
@@ -182,21 +246,34 @@ def packman_runner(action, packages_file=None, packages=None,
                 packages_file=packages_file)
             validate = Validate(package_dict)
             validate.validate_package_properties()
-            # looks for the overriding methods file in the current path
-            if os.path.isfile(os.path.join(
-                    os.getcwd(), '{0}.py'.format(action))):
-                # TODO: allow sending parameters to the overriding methods
-                overr_methods = import_overriding_methods(action)
-                package = rename_package(package)
-                # if the method was found in the overriding file, run it.
-                if hasattr(overr_methods, '{0}_{1}'.format(action, package)):
-                    getattr(overr_methods, '{0}_{1}'.format(action, package))()
-                # else run the default action method
-                else:
-                    # TODO: check for bad action
-                    globals()[action](package_dict)
-            else:
-                globals()[action](package_dict)
+            package_dicts.append((package, package_dict))
+        if action == 'mirror':
+            m = mirror.Handler(mirror_path)
+            for package, package_dict in package_dicts:
+                added = m.add(package_dict[defs.PARAM_SOURCES_PATH])
+                lgr.info('Added {0} archives of {1} to {2}'.format(
+                    len(added), package, m.path))
+            m.index()
+            return
+        if (mirror_path or mirror_only) and action in ('get', 'make'):
+            repo = yum.Handler() if CENTOS else apt.Handler() if DEBIAN \
+                else None
+            if not repo:
+                lgr.error('Mirrors are only supported on {0}.'.format(
+                    ', '.join(utils.SUPPORTED_DISTROS)))
+                sys.exit(codes.mapping['mirror_not_supported_by_distro'])
+            repo.use_mirror(mirror_path, mirror_only)
+        scheduler = Scheduler(package_dicts)
+        scheduler.run(
+            _run_action, ['get', 'pack'] if action == 'make' else [action],
+            dict((package, (package, package_dict))
+                 for package, package_dict in package_dicts),
+            jobs, queue_depth)
+        if action in ('get', 'make'):
+            # the download cache is only shrunk (and unused prebuilt
+            # virtualenvs removed) once all packages were retrieved
+            cache.Handler().prune()
+            python.Handler().prune_venvs()
     else:
         lgr.error('No packages to handle, Verify that your packages file '
                   'contains packages and that you did not exclude '
@@ -247,6 +324,7 @@ def get(package):
     retr = retrieve.Handler()
     py = python.Handler()
     rb = ruby.Handler()
+    nd = node.Handler()
 
     sources_path = c.get(defs.PARAM_SOURCES_PATH, None)
     handle_sources_path(
@@ -255,23 +333,33 @@ def get(package):
     # TODO: (TEST) raise on "command not supported by distro"
     # TODO: (FEAT) add support for building packages from source
     repo.install(c.get(defs.PARAM_PREREQS, []))
-    repo.add_src_repos(c.get(defs.PARAM_SOURCE_REPOS, []))
+    sources_changed = repo.add_src_repos(
+        c.get(defs.PARAM_SOURCE_REPOS, []), c.get(defs.PARAM_NAME))
     if c.get(defs.PARAM_SOURCE_PPAS, []) and not DEBIAN:
         lgr.error('ppas not supported by {0}'.format(utils.get_distro()))
         sys.exit(codes.mapping['ppa_not_supported_by_distro'])
     repo.add_ppa_repos(c.get(defs.PARAM_SOURCE_PPAS, []))
-    retr.downloads(c.get(defs.PARAM_SOURCE_KEYS, []), sources_path)
+    manifest = c.get(defs.PARAM_SOURCES_MANIFEST)
+    retr.downloads(c.get(defs.PARAM_SOURCE_KEYS, []), sources_path,
+                   manifest=manifest)
     repo.add_keys(c.get(defs.PARAM_SOURCE_KEYS, []), sources_path)
-    retr.downloads(c.get(defs.PARAM_SOURCE_URLS, []), sources_path)
-    repo.download(c.get(defs.PARAM_REQS, []), sources_path)
+    # the repos' metadata is only refreshed when requirements are downloaded
+    # and only if repos or keys were added (by any package) or if it expired
+    if c.get(defs.PARAM_REQS):
+        repo.refresh(c.get(defs.PARAM_METADATA_TTL), sources_changed)
+    retr.downloads(c.get(defs.PARAM_SOURCE_URLS, []), sources_path,
+                   manifest=manifest)
+    repo.download(c.get(defs.PARAM_REQS, []), sources_path,
+                  resolve=c.get(defs.PARAM_RESOLVE_REQS, False))
     if c.get(defs.PARAM_VIRTUALENV):
-        with utils.chdir(os.path.abspath(sources_path)):
-            py.make_venv(c['virtualenv']['path'])
-        py.install(c['virtualenv']['modules'], c['virtualenv']['path'],
-                   sources_path)
-    py.get_modules(c.get(defs.PARAM_PYTHON_MODULES, []), sources_path)
+        py.prebuilt_venv(os.path.join(
+            os.path.abspath(sources_path), c['virtualenv']['path']),
+            c['virtualenv']['modules'])
+    py.get_modules(c.get(defs.PARAM_PYTHON_MODULES, []), sources_path,
+                   format=c.get(defs.PARAM_PYTHON_MODULES_FORMAT,
+                                python.DEFAULT_MODULES_FORMAT))
     rb.get_gems(c.get(defs.PARAM_RUBY_GEMS, []), sources_path)
-    # nd.get_packages(c.get(defs.PARAM_NODE_PACKAGES, []), sources_path)
+    nd.get_packages(c.get(defs.PARAM_NODE_PACKAGES, []), sources_path)
     lgr.info('Package retrieval completed successfully!')
 
 
@@ -279,6 +367,7 @@ def pack(package):
     """creates a package according to the provided package configuration
     in packages.yaml
     uses fpm (https://github.com/jordansissel/fpm/wiki) to create packages.
+    tar and tar.gz packages of directories are written without fpm.
 
     .. note:: package params are defined in packages.yaml but can be passed
      directly to the pack function as a dict.
@@ -291,17 +380,13 @@ def pack(package):
     :rtype: `None`
     """
 
-    def handle_package_path(package_path, sources_path, name, overwrite):
+    def handle_package_path(package_path, sources_path):
         if not os.path.isdir(package_path):
             u.mkdir(package_path)
         if sources_path == package_path:
             lgr.error('Sources path and package paths must'
                       ' be different to avoid conflicts!')
             sys.exit(codes.mapping['sources_and_package_paths_identical'])
-        if overwrite:
-            lgr.info('Overwrite enabled. Removing {0}/{1}* '
-                     'before packaging'.format(package_path, name))
-            u.rm('{0}/{1}*'.format(package_path, name))
 
     def set_dst_pkg_type():
         lgr.debug('Destination package type omitted')
@@ -318,6 +403,11 @@ def pack(package):
         lgr.debug('Converting tar to tar.gz...')
         sh.gzip(tar_file)
 
+    def handle_sources_removal(keep_sources, sources_path):
+        if not keep_sources:
+            lgr.debug('Removing sources...')
+            utils.Handler().rmdir(sources_path)
+
     # you can send the package dict directly, or retrieve it from
     # the packages.yaml file by sending its name
     c = package if isinstance(package, dict) else get_package_config(package)
@@ -338,9 +428,7 @@ def pack(package):
     u = utils.Handler()
     templates = templater.Handler()
 
-    handle_package_path(
-        package_path, sources_path, name,
-        c.get(defs.PARAM_OVERWRITE_OUTPUT, False))
+    handle_package_path(package_path, sources_path)
 
     lgr.info('Generating package scripts and config files...')
     if c.get(defs.PARAM_CONFIG_TEMPLATE_CONFIG, False):
@@ -362,6 +450,21 @@ def pack(package):
     # is supplied, the assumption is that packages are only being downloaded
     # so if there's a source package type...
     if not os.listdir(sources_path) == []:
+        # the package is only built again if anything it's built from
+        # changed since it was last built.
+        build = fingerprint.Handler(os.path.abspath(package_path), name)
+        current_fingerprint = build.compute(c, sources_path, bootstrap_script)
+        if build.matches(current_fingerprint):
+            lgr.info('{0} is up to date. Skipping packaging.'.format(name))
+            handle_sources_removal(
+                c.get(defs.PARAM_KEEP_SOURCES, True), sources_path)
+            return
+        build.remove()
+        if c.get(defs.PARAM_OVERWRITE_OUTPUT, False):
+            lgr.info('Overwrite enabled. Removing {0}/{1}* '
+                     'before packaging'.format(package_path, name))
+            u.rm('{0}/{1}*'.format(package_path, name))
+        outputs = build.outputs()
         fpm_params = {
             'version': c.get(defs.PARAM_VERSION, False),
             'force': c.get(defs.PARAM_OVERWRITE_OUTPUT, True),
@@ -376,13 +479,16 @@ def pack(package):
         # the cwd.
         with utils.chdir(os.path.abspath(package_path)):
             for dst_pkg_type in dst_pkg_types:
-                packager = fpm.Handler(
+                # tarballs of directories are written without fpm
+                native = archive.supports(src_pkg_type, dst_pkg_type)
+                handler = archive.Handler if native else fpm.Handler
+                packager = handler(
                     name, src_pkg_type, dst_pkg_type, sources_path)
                 result = packager.execute(**fpm_params)
                 if not result:
                     lgr.error('Failed to create package.')
                     sys.exit(codes.mapping['failed_create_package'])
-            if dst_pkg_type == "tar.gz":
+            if dst_pkg_type == "tar.gz" and not native:
                 tar_file = '{0}.tar'.format(name)
                 targz_file = tar_file + '.gz'
                 if os.path.isfile(targz_file):
@@ -393,14 +499,12 @@ def pack(package):
                                   'is false.'.format(targz_file))
                         sys.exit(codes.mapping['targz_exists'])
                 convert_tar_to_targz(tar_file)
+        build.save(current_fingerprint, outputs)
     else:
         lgr.error('Sources directory is empty. Nothing to package.')
         sys.exit(codes.mapping['sources_empty'])
     lgr.info('Package creation completed successfully!')
-
-    if not c.get(defs.PARAM_KEEP_SOURCES, True):
-        lgr.debug('Removing sources...')
-        u.rmdir(sources_path)
+    handle_sources_removal(c.get(defs.PARAM_KEEP_SOURCES, True), sources_path)
 
 
 class Validate():
@@ -412,6 +516,14 @@ class Validate():
         if defs.PARAM_DESTINATION_PACKAGE_TYPES in self.package:
             self.destination_package_types(
                 self.package[defs.PARAM_DESTINATION_PACKAGE_TYPES])
+        if defs.PARAM_AFTER in self.package:
+            self.after(self.package[defs.PARAM_AFTER])
+
+    def after(self, packages):
+        if not isinstance(packages, list):
+            lgr.error('{0} key must be of type "list".'.format(
+                defs.PARAM_AFTER))
+            sys.exit(codes.mapping['after_must_be_list'])
 
     def destination_package_types(self, package_types):
         if not isinstance(package_types, list):
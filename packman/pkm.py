@@ -17,21 +17,46 @@
 """Script to run packman via command line
 
 Usage:
-    pkm get [--packages=<list> --packages-file=<path> --exclude=<list> -v]
-    pkm pack [--packages=<list> --packages-file=<path> --exclude=<list> -v]
-    pkm make [--packages=<list> --packages-file=<path> --exclude=<list> -v]
+    pkm get [--packages=<list> --packages-file=<path> --exclude=<list>]
+            [--jobs=<n> --mirror=<path> --mirror-only -v]
+    pkm pack [--packages=<list> --packages-file=<path> --exclude=<list>]
+             [--jobs=<n> -v]
+    pkm make [--packages=<list> --packages-file=<path> --exclude=<list>]
+             [--jobs=<n> --queue-depth=<n> --mirror=<path> --mirror-only -v]
+    pkm mirror [--packages=<list> --packages-file=<path> --exclude=<list>]
+               [--mirror=<path> -v]
+    pkm cache ls [-v]
+    pkm cache prune [--max-size=<mb> -v]
+    pkm venvs prune [--max-age=<days> -v]
     pkm --version
 
 Arguments:
     pack     Creates packages configured in packages file
     get      Retrives resources for package configured in packages file
-    make     Gets AND (yeah!) Packs.. don't ya kno!
+    make     Gets AND (yeah!) Packs.. don't ya kno! each package is packed
+             as soon as it is retrieved.
+    mirror   Adds the debs and rpms retrieved for packages to a local
+             mirror and indexes it
+    cache    Lists (ls) or shrinks (prune) the download cache
+    venvs    Removes (prune) prebuilt virtualenvs which weren't used for
+             a while
 
 Options:
     -h --help                   Show this screen.
     -c --packages=<list>        Comma Separated list of package names
     -x --exclude=<list>         Comma Separated list of excluded packages
     -f --packages-file=<path> packages file path
+    -j --jobs=<n>               Number of packages to handle concurrently
+                                [default: 1]
+    -q --queue-depth=<n>        Max number of retrieved packages waiting to be
+                                packed [default: 2]
+    -m --max-size=<mb>          Max size of the download cache in MB
+    -a --max-age=<days>         Days since a prebuilt virtualenv was last used
+                                after which it's removed (defaults to 30)
+    -r --mirror=<path>          Local mirror path (for mirror, defaults to
+                                ~/.packman/mirror)
+    -o --mirror-only            Retrieve distro packages from the mirror alone
+                                instead of from the configured repos
     -v --verbose                a LOT of output
     --version                   Display current version of package and exit
 
@@ -43,6 +68,10 @@ from packman import logger
 from packman.packman import packman_runner
 from packman.utils import check_distro
 from packman import utils
+from packman import codes
+from packman import cache
+from packman import python
+import sys
 
 lgr = logger.init()
 
@@ -59,30 +88,77 @@ def ver_check():
     return version
 
 
+def _int_option(o, option, error_code):
+    try:
+        return int(o.get(option) or 1)
+    except ValueError:
+        lgr.error('{0} must be an integer.'.format(option))
+        sys.exit(codes.mapping[error_code])
+
+
+def _jobs(o):
+    return _int_option(o, '--jobs', 'jobs_must_be_positive')
+
+
 def pkm_run(o):
     if o['pack']:
         packman_runner('pack',
                        o.get('--packages-file'),
                        o.get('--packages'),
                        o.get('--exclude'),
-                       o.get('--verbose'))
+                       o.get('--verbose'),
+                       _jobs(o))
     elif o['get']:
         packman_runner('get',
                        o.get('--packages-file'),
                        o.get('--packages'),
                        o.get('--exclude'),
-                       o.get('--verbose'))
+                       o.get('--verbose'),
+                       _jobs(o),
+                       mirror_path=o.get('--mirror'),
+                       mirror_only=o.get('--mirror-only'))
     elif o['make']:
-        packman_runner('get',
+        packman_runner('make',
                        o.get('--packages-file'),
                        o.get('--packages'),
                        o.get('--exclude'),
-                       o.get('--verbose'))
-        packman_runner('pack',
+                       o.get('--verbose'),
+                       _jobs(o),
+                       _int_option(o, '--queue-depth',
+                                   'queue_depth_must_be_positive'),
+                       o.get('--mirror'),
+                       o.get('--mirror-only'))
+    elif o['mirror']:
+        packman_runner('mirror',
                        o.get('--packages-file'),
                        o.get('--packages'),
                        o.get('--exclude'),
-                       o.get('--verbose'))
+                       o.get('--verbose'),
+                       mirror_path=o.get('--mirror'))
+    elif o['cache']:
+        c = cache.Handler()
+        if o['ls']:
+            c.ls()
+        elif o['prune']:
+            max_size = o.get('--max-size')
+            try:
+                max_size = None if max_size is None \
+                    else int(float(max_size) * 1024 * 1024)
+            except ValueError:
+                lgr.error('--max-size must be a number.')
+                sys.exit(codes.mapping['max_size_must_be_a_number'])
+            lgr.info('Removed {0} files from the cache.'.format(
+                c.prune(max_size)))
+    elif o['venvs']:
+        max_age = o.get('--max-age')
+        try:
+            max_age = None if max_age is None \
+                else int(float(max_age) * 24 * 60 * 60)
+        except ValueError:
+            lgr.error('--max-age must be a number.')
+            sys.exit(codes.mapping['max_age_must_be_a_number'])
+        lgr.info('Removed {0} prebuilt virtualenvs.'.format(
+            python.Handler().prune_venvs(max_age)))
 
 
 def pkm(test_options=None):
@@ -5,60 +5,235 @@ import re
 import sh
 import sys
 import codes
+import hashlib
+import json
 import os
+import tempfile
+import time
+
+MODULES_FORMATS = ('wheel', 'sdist', 'wheelhouse')
+DEFAULT_MODULES_FORMAT = 'wheel'
+# a local index of all downloaded modules which pip uses as find-links
+DEFAULT_MODULES_CACHE_PATH = os.path.expanduser('~/.packman/pip')
+MODULE_ARCHIVE_EXTENSIONS = ('.whl', '.tar.gz', '.tgz', '.tar.bz2', '.zip')
+# prebuilt virtualenvs, keyed by their python version and modules
+DEFAULT_VENVS_PATH = os.path.expanduser('~/.packman/venvs')
+# prebuilt virtualenvs which weren't used for this long are pruned
+DEFAULT_VENVS_MAX_AGE = 30 * 24 * 60 * 60
+# pip reports the modules it couldn't find with this message
+MISSING_MODULE = re.compile(r'No matching distribution found for (\S+)')
 
 lgr = logger.init()
 
 
+def _module_name(module):
+    """returns a module's normalized name (without its version, extras
+    and environment markers)
+    """
+    return re.split(r'[<>=!~\[;@ ]', module.strip(), 1)[0] \
+        .lower().replace('_', '-')
+
+
+def venv_key(venv_dir, modules):
+    """returns the key of a prebuilt virtualenv
+
+    :param string venv_dir: the (bare) virtualenv the modules are to be
+     installed in
+    :param list modules: the files of the exact module versions (and
+     their dependencies) to install in it
+    :rtype: `string` sha256 hex digest of the version of the virtualenv's
+     python, the virtualenv version and the set of module files
+    """
+    python = str(sh.Command(os.path.join(venv_dir, 'bin', 'python'))(
+        '-c', 'import sys, platform; '
+        'sys.stdout.write(sys.version + platform.machine())'))
+    return hashlib.sha256(json.dumps([
+        python, str(sh.virtualenv('--version')).strip(),
+        sorted(set(modules))])).hexdigest()
+
+
 class Handler(utils.Handler):
     """Python operations handler
     """
-    def install(self, modules, venv=False, sources_path=False, timeout='45'):
+    def _pip(self, pip, args):
+        # returns a stream of the command
+        o = pip(*args, _iter=True)
+        # this is where the command is actually executed
+        for line in o:
+            lgr.debug(line.rstrip())
+
+    def install(self, modules, venv=False, sources_path=False, timeout='45',
+                cache_path=None):
         """pip installs a list of modules
 
+        all modules are installed by a single pip run, after which they're
+        verified against a single `pip freeze`. the modules are installed
+        from the local modules cache. modules which aren't cached are
+        downloaded (to a directory of their own) and added to it first.
+
         :param list modules: python modules to ``pip install``
         :param string venv: (optional) if ommited, will use system python
          else, will use `venv` (for virtualenvs and such)
+        :param string cache_path: path of the local modules cache
         """
+        if not modules:
+            return
         # this allows us to use the 'virtualenv' feature.
         venv_path = os.path.join(sources_path, venv) if sources_path else venv
         pip = sh.Command('{0}/bin/pip'.format(venv_path)) \
             if venv else sh.Command('pip')
-        for module in modules:
-            lgr.debug('Installing module {0}'.format(module))
-            o = pip.install('--default-timeout', timeout, module, _iter=True)
+        cache_path = cache_path or DEFAULT_MODULES_CACHE_PATH
+        self.mkdir(cache_path)
+        lgr.debug('Installing modules {0}'.format(', '.join(modules)))
+        local = ('--no-index', '--find-links', cache_path) + tuple(modules)
+        try:
+            self._pip(pip, ('install',) + local)
+        except sh.ErrorReturnCode:
+            lgr.debug('Not all modules are cached. Downloading them...')
+            # other runs install from the cache, so the modules are only
+            # added to it once they're fully downloaded
+            downloads = tempfile.mkdtemp(prefix='.modules-')
             try:
-                for line in o:
-                    lgr.debug(line)
-                if not self.check_module_installed(module, venv_path):
-                    lgr.error('Module {0} could not be installed.'.format(
-                        module))
-                    sys.exit(codes.mapping['module_could_not_be_installed'])
-            except:
-                lgr.error('Module {0} could not be installed.'.format(module))
+                self._pip(pip, ('download', '--dest', downloads,
+                                '--find-links', cache_path,
+                                '--default-timeout', timeout) +
+                          tuple(modules))
+                self.cache_modules(downloads, cache_path)
+                self._pip(pip, ('install',) + local)
+            except sh.ErrorReturnCode as ex:
+                missing = MISSING_MODULE.findall(ex.stderr)
+                lgr.error('Modules {0} could not be installed.'.format(
+                    ', '.join(missing or modules)))
                 sys.exit(codes.mapping['module_could_not_be_installed'])
+            finally:
+                self.rmdir(downloads)
+        installed = self.installed_modules(venv_path)
+        # modules installed from urls or paths can't be verified by name
+        missing = [m for m in modules if '/' not in m and
+                   _module_name(m) not in installed]
+        if missing:
+            lgr.error('Modules {0} could not be installed.'.format(
+                ', '.join(missing)))
+            sys.exit(codes.mapping['module_could_not_be_installed'])
 
     @retry(retries=3, delay_multiplier=1)
-    def get_modules(self, modules, dir, venv=False, timeout='45'):
+    def get_modules(self, modules, dir, venv=False, timeout='45',
+                    format=DEFAULT_MODULES_FORMAT, cache_path=None):
         """downloads python modules
 
+        all modules (and their dependencies) are resolved and downloaded
+        by a single pip run. they're resolved from the local modules cache
+        alone first, so that the index is only used if some of them (or
+        the required versions) aren't cached yet. pip downloads them to a
+        directory of its own, so that only the modules it downloaded (and
+        not other archives in `dir`) are added to the cache before they're
+        moved to `dir`.
+
         :param list modules: python modules to download
         :param string dir: dir to download modules to
         :param string venv: (optional) if ommited, will use system python
          else, will use `dir` (for virtualenvs and such)
+        :param string format: `wheel` to download wheels where available
+         (and sdists otherwise), `sdist` to only download sdists or
+         `wheelhouse` to build wheels of all modules so that they never
+         have to be built where they're installed.
+        :param string cache_path: path of the local modules cache
         """
+        if not modules:
+            return
+        if format not in MODULES_FORMATS:
+            lgr.error('Python modules format must be one of: {0}'.format(
+                ', '.join(MODULES_FORMATS)))
+            sys.exit(codes.mapping['invalid_python_modules_format'])
         pip = sh.Command('{0}/bin/pip'.format(venv)) \
             if venv else sh.Command('pip')
-        for module in modules:
-            # returns a stream of the command
-            o = pip.install(
-                '--no-use-wheel', '--download', dir, module, _iter=True)
+        lgr.debug('Downloading modules {0} to {1} ({2})'.format(
+            ', '.join(modules), dir, format))
+        self.mkdir(dir)
+        # created under `dir` so that the modules are moved, not copied
+        downloads = tempfile.mkdtemp(prefix='.modules-', dir=dir)
+        if format == 'wheelhouse':
+            args = ('wheel', '--wheel-dir', downloads)
+        elif format == 'sdist':
+            args = ('download', '--dest', downloads, '--no-binary', ':all:')
+        else:
+            args = ('download', '--dest', downloads)
+        cache_path = cache_path or DEFAULT_MODULES_CACHE_PATH
+        self.mkdir(cache_path)
+        try:
             try:
-                # this is where the command is actually executed
-                for line in o:
-                    lgr.debug(line)
-            except:
-                sys.exit(codes.mapping['failed_to_download_module'])
+                self._pip(pip, args + ('--no-index', '--find-links',
+                                       cache_path) + tuple(modules))
+            except sh.ErrorReturnCode:
+                lgr.debug('Not all modules are cached. Using the index...')
+                try:
+                    self._pip(pip, args + ('--find-links', cache_path,
+                                           '--default-timeout', timeout) +
+                              tuple(modules))
+                except sh.ErrorReturnCode as ex:
+                    missing = MISSING_MODULE.findall(ex.stderr)
+                    lgr.error('Failed to download modules{0}.'.format(
+                        ' ({0})'.format(', '.join(missing))
+                        if missing else ''))
+                    sys.exit(codes.mapping['failed_to_download_module'])
+            self.cache_modules(downloads, cache_path)
+            for module in os.listdir(downloads):
+                os.rename(os.path.join(downloads, module),
+                          os.path.join(dir, module))
+        finally:
+            self.rmdir(downloads)
+
+    def cache_modules(self, dir, cache_path=None):
+        """adds the modules in a directory to the local modules cache
+
+        modules which are already cached are skipped. the modules are
+        copied to a temporary name first and renamed, so that pip never
+        finds a partially written module in the cache.
+
+        :param string dir: directory containing downloaded modules
+        :param string cache_path: path of the local modules cache
+        :rtype: `list` of added modules
+        """
+        cache_path = cache_path or DEFAULT_MODULES_CACHE_PATH
+        if os.path.abspath(dir) == os.path.abspath(cache_path):
+            return []
+        self.mkdir(cache_path)
+        added = []
+        for module in sorted(os.listdir(dir)):
+            source = os.path.join(dir, module)
+            destination = os.path.join(cache_path, module)
+            if not module.endswith(MODULE_ARCHIVE_EXTENSIONS) or \
+                    not os.path.isfile(source) or \
+                    os.path.isfile(destination):
+                continue
+            lgr.debug('Adding {0} to the modules cache'.format(module))
+            tmp = os.path.join(cache_path, '.{0}.tmp'.format(module))
+            self.link(source, tmp, hardlink=False)
+            os.rename(tmp, destination)
+            added.append(module)
+        return added
+
+    def installed_modules(self, venv=False):
+        """returns the installed modules
+
+        :param string venv: (optional) if ommited, will use system python
+         else, will use `venv` (for virtualenvs and such)
+        :rtype: `dict` mapping (normalized) module names to their versions
+        """
+        pip = sh.Command('{0}/bin/pip'.format(venv)) \
+            if venv else sh.Command('pip')
+        installed = {}
+        for line in pip.freeze():
+            line = line.strip()
+            if '#egg=' in line:
+                # editable installs (-e git+https://...#egg=name)
+                installed[_module_name(line.split('#egg=')[-1])] = None
+            elif '==' in line:
+                name, version = line.split('==', 1)
+                installed[_module_name(name)] = version
+            elif ' @ ' in line:
+                installed[_module_name(line.split(' @ ')[0])] = None
+        return installed
 
     def check_module_installed(self, name, venv=False):
         """checks to see that a module is installed
@@ -67,20 +242,14 @@ class Handler(utils.Handler):
         :param string venv: (optional) if ommited, will use system python
          else, will use `venv` (for virtualenvs and such)
         """
-        pip = sh.Command('{0}/bin/pip'.format(venv)) \
-            if venv else sh.Command('pip')
         lgr.debug('Checking whether {0} is installed'.format(name))
-        installed_modules = pip.freeze()
-        if re.search(r'{0}'.format(name.lower()) + '==',
-                     str(installed_modules).lower()):
+        if _module_name(name) in self.installed_modules(venv):
             lgr.debug('Module {0} is installed'.format(name))
             return True
         else:
             lgr.debug('Module {0} is not installed'.format(name))
             return False
 
-    # TODO: (FEAT) support virtualenv --relocate OR
-    # TODO: (FEAT) support whack http://mike.zwobble.org/2013/09/relocatable-python-virtualenvs-using-whack/ # NOQA
     def make_venv(self, venv_dir):
         """creates a virtualenv
 
@@ -88,3 +257,117 @@ class Handler(utils.Handler):
         """
         lgr.debug('Creating virtualenv in {0}'.format(venv_dir))
         return sh.virtualenv(venv_dir)
+
+    def prebuilt_venv(self, venv_dir, modules, timeout='45',
+                      venvs_path=None):
+        """creates a virtualenv containing a list of modules
+
+        the modules (and their dependencies) are first resolved to the
+        exact module files pip would install in the virtualenv (see
+        `get_modules`). the virtualenv is only built (and its modules
+        installed) once per python version the virtualenv runs and set of
+        module files. a snapshot of it is then kept under `venvs_path` and
+        later virtualenvs are copied from it (reflinked, where the
+        filesystem supports it) and relocated to their path. snapshots
+        which aren't used are removed by `prune_venvs`.
+
+        :param string venv_dir: venv path to create
+        :param list modules: python modules to install in the venv
+        :param string venvs_path: path of the prebuilt virtualenvs
+        :rtype: `bool` representing whether the venv was prebuilt
+        """
+        venv_dir = os.path.abspath(venv_dir)
+        venvs_path = venvs_path or DEFAULT_VENVS_PATH
+        self.make_venv(venv_dir)
+        downloads = tempfile.mkdtemp()
+        try:
+            self.get_modules(modules, downloads, venv=venv_dir,
+                             timeout=timeout)
+            snapshot = os.path.join(venvs_path, venv_key(
+                venv_dir, os.listdir(downloads)))
+            if os.path.isfile(os.path.join(snapshot, 'origin')):
+                lgr.info('Restoring prebuilt virtualenv to {0}'.format(
+                    venv_dir))
+                # the snapshot's last use (see `prune_venvs`)
+                os.utime(os.path.join(snapshot, 'origin'), None)
+                with open(os.path.join(snapshot, 'origin')) as f:
+                    origin = f.read()
+                self.rmdir(venv_dir)
+                sh.cp('-a', '--reflink=auto',
+                      os.path.join(snapshot, 'venv'), venv_dir)
+                if not origin == venv_dir:
+                    self.relocate_venv(venv_dir, origin)
+                return True
+            # exactly the resolved module files are installed
+            self.install(modules, venv_dir, cache_path=downloads)
+        finally:
+            self.rmdir(downloads)
+        lgr.debug('Saving a snapshot of {0}'.format(venv_dir))
+        self.mkdir(venvs_path)
+        # several packages might prebuild the same venv at the same time
+        tmp = tempfile.mkdtemp(dir=venvs_path)
+        sh.cp('-a', '--reflink=auto', venv_dir, os.path.join(tmp, 'venv'))
+        with open(os.path.join(tmp, 'origin'), 'w') as f:
+            f.write(venv_dir)
+        try:
+            os.rename(tmp, snapshot)
+        except OSError:
+            self.rmdir(tmp)
+        return False
+
+    def prune_venvs(self, max_age=None, venvs_path=None):
+        """removes the prebuilt virtualenvs which weren't used for a while
+
+        :param int max_age: seconds since a snapshot was last used (built
+         or restored) after which it's removed. defaults to
+         `DEFAULT_VENVS_MAX_AGE`.
+        :param string venvs_path: path of the prebuilt virtualenvs
+        :rtype: `int` number of removed virtualenvs
+        """
+        max_age = DEFAULT_VENVS_MAX_AGE if max_age is None else max_age
+        venvs_path = venvs_path or DEFAULT_VENVS_PATH
+        if not os.path.isdir(venvs_path):
+            return 0
+        removed = 0
+        for key in sorted(os.listdir(venvs_path)):
+            origin = os.path.join(venvs_path, key, 'origin')
+            try:
+                used = os.path.getmtime(origin)
+            except OSError:
+                # a snapshot which is being saved
+                continue
+            if time.time() - used >= max_age:
+                lgr.debug('Removing prebuilt virtualenv {0}'.format(key))
+                self.rmdir(os.path.join(venvs_path, key))
+                removed += 1
+        return removed
+
+    def relocate_venv(self, venv_dir, origin):
+        """relocates a virtualenv copied from another path
+
+        the absolute paths of the original virtualenv are replaced in its
+        scripts (shebangs, activate scripts), .pth and .egg-link files
+        and symlinks.
+
+        :param string venv_dir: path of the copied venv
+        :param string origin: path of the original venv
+        """
+        lgr.debug('Relocating virtualenv {0} to {1}'.format(
+            origin, venv_dir))
+        bin_dir = os.path.join(venv_dir, 'bin')
+        for root, dirs, files in os.walk(venv_dir):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    target = os.readlink(path)
+                    if target == origin or \
+                            target.startswith(origin + os.sep):
+                        os.remove(path)
+                        os.symlink(venv_dir + target[len(origin):], path)
+                elif name in files and (root == bin_dir or name.endswith(
+                        ('.pth', '.egg-link'))):
+                    with open(path, 'rb') as f:
+                        content = f.read()
+                    if origin in content:
+                        with open(path, 'wb') as f:
+                            f.write(content.replace(origin, venv_dir))
@@ -1,53 +1,467 @@
 import utils
+import cache
 from utils import retry
 import sys
 import logger
 import os
 import codes
 import requests
+import threading
+import time
+import urllib
+import urlparse
+import hashlib
+import socket
+from multiprocessing.pool import ThreadPool
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+
+DEFAULT_DOWNLOAD_WORKERS = 8
+DEFAULT_CONNECTIONS_PER_HOST = 4
+DEFAULT_SEGMENTS = 4
+# files smaller than this are never downloaded in segments
+SEGMENTED_DOWNLOAD_MIN_SIZE = 64 * 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+REQUEST_TIMEOUT = 60
 
 lgr = logger.init()
 
+_session = None
+_session_lock = threading.Lock()
+_host_slots = {}
 
-def download_file(url, destination):
-    """downloads a file to a destination
+
+def get_session():
+    """returns a requests session shared by all downloads in this process
+
+    the session keeps connections alive and pools up to
+    `DEFAULT_CONNECTIONS_PER_HOST` connections per host.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=DEFAULT_CONNECTIONS_PER_HOST)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def _host_slot(url):
+    """returns a semaphore limiting the concurrent connections to
+    the url's host
+    """
+    host = urlparse.urlparse(url).netloc
+    with _session_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(
+                DEFAULT_CONNECTIONS_PER_HOST)
+        return _host_slots[host]
+
+
+class _Slot():
+    """a host slot which is released at most once
+    """
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.semaphore.acquire()
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.semaphore.release()
+
+
+def _stream(r, f, sha256=None, decode=True):
+    """writes a response's body to a file
+
+    the chunk size starts small and grows as long as chunks keep arriving
+    quickly so that fast links aren't bound by the per chunk overhead.
+
+    :param bool decode: whether to decode the body according to its
+     Content-Encoding. byte ranges refer to the body as it was sent, so
+     ranged responses must be written as is.
+    :rtype: `int` number of bytes written
     """
+    chunk_size = MIN_CHUNK_SIZE
+    written = 0
+    while True:
+        start = time.time()
+        chunk = r.raw.read(chunk_size, decode_content=decode)
+        if not chunk:
+            return written
+        f.write(chunk)
+        if sha256:
+            sha256.update(chunk)
+        written += len(chunk)
+        if chunk_size < MAX_CHUNK_SIZE and time.time() - start < 0.1:
+            chunk_size *= 2
+
+
+def _truncated(r, written):
+    """returns whether fewer bytes were written than the response announced
+
+    a connection which was closed early just ends the body, so a cut off
+    download can only be told apart by its Content-Length (which doesn't
+    apply to a decoded body).
+    """
+    length = r.headers.get('content-length')
+    if not length or not r.headers.get(
+            'content-encoding', 'identity') == 'identity':
+        return False
+    return written < int(length)
+
+
+def _hash_file(path, sha256):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MAX_CHUNK_SIZE), ''):
+            sha256.update(chunk)
+
+
+def _download_segment(url, output, start, end, validator):
+    with _host_slot(url):
+        r = get_session().get(url, stream=True, timeout=REQUEST_TIMEOUT,
+                              headers={
+                                  'Range': 'bytes={0}-{1}'.format(start, end),
+                                  'If-Range': validator,
+                                  'Accept-Encoding': 'identity'})
+        if not r.status_code == 206:
+            lgr.error('Could not download bytes {0}-{1} of {2}'.format(
+                start, end, url))
+            return False
+        with open(output, 'r+b') as f:
+            f.seek(start)
+            return _stream(r, f, decode=False) == end - start + 1
+
+
+def _download_segments(url, output, length, validator, segments):
+    """downloads a file in several concurrent segments
+
+    the file is assembled in a separate file so that a failed segmented
+    download is never mistaken for a partial download to be resumed.
+    """
+    lgr.debug('Downloading {0} in {1} segments'.format(url, segments))
+    assembled = output + '.segments'
+    with open(assembled, 'wb') as f:
+        f.truncate(length)
+    size = -(-length // segments)
+    ranges = [(start, min(start + size, length) - 1)
+              for start in range(0, length, size)]
+    pool = ThreadPool(processes=len(ranges))
+    try:
+        results = pool.map(lambda r: _download_segment(
+            url, assembled, r[0], r[1], validator), ranges)
+    finally:
+        pool.close()
+        pool.join()
+    if not all(results):
+        os.remove(assembled)
+        return False
+    os.rename(assembled, output)
+    return True
+
+
+def _copy_file(url, destination, sha256):
+    # local files (e.g. the packages of a mirror) aren't cached
+    path = urllib.url2pathname(urlparse.urlparse(url).path)
+    if not os.path.isfile(path):
+        lgr.error('Could not find file: {0}'.format(url))
+        return False
+    if sha256:
+        digest = hashlib.sha256()
+        _hash_file(path, digest)
+        if not digest.hexdigest() == sha256:
+            lgr.error('Checksum mismatch for {0} (expected sha256 {1} '
+                      'but got {2})'.format(url, sha256, digest.hexdigest()))
+            return False
+    utils.Handler().link(path, destination, hardlink=False)
+    return True
+
+
+def _cut_off(url, output):
+    # the partial download is kept so that the next attempt resumes it
+    lgr.error('Download of {0} was cut off after {1} bytes'.format(
+        url, os.path.getsize(output)))
+    return False
+
+
+def _download_file(url, destination, segments, sha256, stats):
     destination = destination if destination else url.split('/')[-1]
-    r = requests.get(url, stream=True)
-    if not r.status_code == 200:
-        lgr.error('Could not download file: {0}'.format(url))
+    if urlparse.urlparse(url).scheme == 'file':
+        return _copy_file(url, destination, sha256)
+    c = cache.Handler()
+    # a file with a known checksum doesn't have to be requested at all
+    if sha256 and c.fetch(cache.digest_key(sha256), destination):
+        lgr.debug('Using cached {0} (sha256: {1})'.format(url, sha256))
+        stats['cached'] = True
+        return True
+    validators = c.validators(url)
+    # the file is requested as is, so that the byte ranges of a resumed or
+    # segmented download match the bytes written.
+    headers = {'Accept-Encoding': 'identity'}
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    # the slot is held as long as the file is being downloaded from the host
+    slot = _Slot(_host_slot(url))
+    try:
+        r = get_session().get(url, stream=True, timeout=REQUEST_TIMEOUT,
+                              headers=headers)
+        if r.status_code == 304:
+            lgr.debug('{0} was not modified.'.format(url))
+            if c.fetch(validators['key'], destination, sha256):
+                stats['cached'] = True
+                return True
+            # the cached file was removed since it was revalidated
+            # (or it doesn't match the expected checksum)
+            r.close()
+            r = get_session().get(url, stream=True, timeout=REQUEST_TIMEOUT,
+                                  headers={'Accept-Encoding': 'identity'})
+        if not r.status_code == 200:
+            lgr.error('Could not download file: {0}'.format(url))
+            return False
+        etag = r.headers.get('etag')
+        last_modified = r.headers.get('last-modified')
+        validator = etag or last_modified
+        if not validator and not sha256:
+            # without validators or a checksum, the file can't be cached
+            with open(destination, 'wb') as f:
+                written = _stream(r, f)
+            stats['transferred'] += written
+            if _truncated(r, written):
+                lgr.error('Download of {0} was cut off after {1} '
+                          'bytes'.format(url, written))
+                os.remove(destination)
+                return False
+            return True
+        cache_key = cache.key(url, etag, last_modified)
+        with c.lock(cache_key):
+            # the same file might have been downloaded in the meantime
+            if c.fetch(cache_key, destination, sha256):
+                r.close()
+                stats['cached'] = True
+                if validator:
+                    c.set_validators(url, cache_key, etag, last_modified)
+                return True
+            output = c.partial(cache_key)
+            length = int(r.headers.get('content-length') or 0)
+            # an encoded file (which the server sent although it was asked
+            # not to) is decoded while it is written, so its byte ranges
+            # don't match the bytes written.
+            ranges = validator and r.headers.get(
+                'content-encoding', 'identity') == 'identity'
+            # without validators, a partial download can't be resumed safely
+            offset = os.path.getsize(output) \
+                if ranges and os.path.isfile(output) else 0
+            if length and offset > length:
+                offset = 0
+            digest = hashlib.sha256()
+            if offset and offset == length:
+                r.close()
+                _hash_file(output, digest)
+            elif offset:
+                r.close()
+                lgr.debug('Resuming download of {0} from byte {1}'.format(
+                    url, offset))
+                r = get_session().get(
+                    url, stream=True, timeout=REQUEST_TIMEOUT, headers={
+                        'Range': 'bytes={0}-'.format(offset),
+                        'If-Range': validator,
+                        'Accept-Encoding': 'identity'})
+                if r.status_code == 206 and r.headers.get(
+                        'content-encoding', 'identity') == 'identity':
+                    _hash_file(output, digest)
+                    mode = 'ab'
+                elif r.status_code == 200:
+                    mode = 'wb'
+                else:
+                    lgr.error('Could not download file: {0}'.format(url))
+                    if r.status_code == 206:
+                        # an encoded range can't be appended to the
+                        # decoded partial download
+                        os.remove(output)
+                    return False
+                with open(output, mode) as f:
+                    written = _stream(r, f, digest, decode=mode == 'wb')
+                stats['transferred'] += written
+                if _truncated(r, written):
+                    return _cut_off(url, output)
+            elif ranges and segments > 1 and \
+                    length >= SEGMENTED_DOWNLOAD_MIN_SIZE and \
+                    r.headers.get('accept-ranges') == 'bytes':
+                r.close()
+                # each segment takes a slot of its own. holding this one
+                # while waiting for the segments could leave them no slots.
+                slot.release()
+                # segments are written out of order so the file can only be
+                # hashed once all of them are downloaded.
+                if not _download_segments(
+                        url, output, length, validator, segments):
+                    return False
+                stats['transferred'] += length
+                _hash_file(output, digest)
+            else:
+                with open(output, 'wb') as f:
+                    written = _stream(r, f, digest)
+                stats['transferred'] += written
+                if _truncated(r, written):
+                    return _cut_off(url, output)
+            if sha256 and not digest.hexdigest() == sha256:
+                lgr.error('Checksum mismatch for {0} (expected sha256 {1} '
+                          'but got {2})'.format(
+                              url, sha256, digest.hexdigest()))
+                os.remove(output)
+                return False
+            c.store(cache_key, output, digest.hexdigest(), url=url,
+                    etag=etag, last_modified=last_modified)
+    finally:
+        slot.release()
+    if validator:
+        c.set_validators(url, cache_key, etag, last_modified)
+    if not c.fetch(cache_key, destination):
+        lgr.error('Could not retrieve {0} from cache'.format(url))
         return False
-    with open(destination, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-                f.flush()
     return True
 
 
+def download_file(url, destination, segments=DEFAULT_SEGMENTS, sha256=None,
+                  stats=None):
+    """downloads a file to a destination
+
+    files served along with an ETag or a Last-Modified header are stored
+    in the download cache and are copied to the destination. if the url's
+    content was cached before, it is revalidated with a conditional request
+    and is only downloaded again if it was modified.
+
+    a download which was cut off is kept so that the next attempt resumes
+    it. large files are downloaded in `segments` concurrent segments if the
+    server supports ranged requests.
+
+    if `sha256` is supplied, the file is verified while it is downloaded and
+    a cached file with the same checksum is used without any request.
+
+    :param dict stats: (optional) the number of bytes actually transferred
+     is added to its `transferred` key and its `cached` key is set if the
+     file was retrieved from the cache.
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault('transferred', 0)
+    stats.setdefault('cached', False)
+    try:
+        return _download_file(url, destination, segments, sha256, stats)
+    except (requests.exceptions.RequestException,
+            urllib3_exceptions.HTTPError, socket.error) as ex:
+        lgr.error('Failed to download {0} ({1})'.format(url, ex))
+        return False
+
+
+def source_url(source):
+    """returns the url of a source
+
+    :param string|dict source: url or a dict containing a `url` and
+     optionally its `sha256`
+    """
+    return source['url'] if isinstance(source, dict) else source
+
+
+def read_manifest(manifest):
+    """reads a checksums manifest
+
+    the manifest is in the format of `sha256sum`'s output. each line
+    contains a sha256 followed by a url or a file name.
+
+    :param string manifest: path to the manifest file
+    :rtype: `dict` mapping urls and file names to their sha256
+    """
+    checksums = {}
+    try:
+        with open(manifest) as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    sha256, name = line.split(None, 1)
+                    checksums[name.strip().lstrip('*')] = sha256.lower()
+    except (IOError, ValueError) as ex:
+        lgr.error('Could not read checksums manifest {0} ({1})'.format(
+            manifest, ex))
+        sys.exit(codes.mapping['invalid_checksums_manifest'])
+    return checksums
+
+
 class Handler(utils.Handler):
-    def downloads(self, urls, dir=False):
+    def downloads(self, urls, dir=False, workers=DEFAULT_DOWNLOAD_WORKERS,
+                  manifest=None):
         """wgets a list of urls to a destination directory
 
+        up to `workers` urls are downloaded concurrently (while no more than
+        `DEFAULT_CONNECTIONS_PER_HOST` are downloaded from the same host).
+
+        each url can be given along with its expected checksum
+        (e.g. {url: http://x/y.tar.gz, sha256: 12ab...}) or have its checksum
+        listed in `manifest`.
+
         :param list urls: a list of urls to download
         :param string dir: download to dir...
+        :param int workers: number of concurrent downloads
+        :param string manifest: path to a checksums manifest
         """
-        for source_url in urls:
-            url_ext = os.path.splitext(source_url)[1]
+        if not urls:
+            return
+        checksums = read_manifest(manifest) if manifest else {}
+        downloads = []
+        for source in urls:
+            if isinstance(source, dict) and not source.get('url'):
+                lgr.error('Source {0} must contain a url.'.format(source))
+                sys.exit(codes.mapping['source_url_missing'])
+            url = source_url(source)
+            sha256 = source.get('sha256') if isinstance(source, dict) \
+                else None
+            sha256 = sha256 or checksums.get(url) or \
+                checksums.get(url.split('/')[-1])
+            url_ext = os.path.splitext(url)[1]
             # if the source file is an rpm or deb, we want to download
             # it to the archives folder. yes, it's a dreadful solution...
             if url_ext in ('.rpm', '.deb'):
                 lgr.debug('The file is a {0} file. we\'ll download it '
                           'to the archives folder'.format(url_ext))
                 self.mkdir(os.path.join(dir, 'archives'))
-                self.download(source_url, dir=os.path.join(dir, 'archives'))
+                downloads.append(
+                    (url, os.path.join(dir, 'archives'), sha256))
             else:
-                self.download(source_url, dir=dir)
+                downloads.append((url, dir, sha256))
+
+        start = time.time()
+        results = utils.concurrently(lambda d: self.download(
+            d[0], dir=d[1], sha256=d[2]), downloads, workers)
+        elapsed = time.time() - start
+        # files retrieved from the cache (or which weren't modified) aren't
+        # transferred, so they don't count towards the throughput
+        cached = len([r for r in results if r['cached']])
+        size = sum(r['transferred'] for r in results) / 1024.0 / 1024.0
+        lgr.info('Downloaded {0} files ({1:.2f} MB) in {2:.2f}s '
+                 '({3:.2f} MB/s), {4} retrieved from cache'.format(
+                     len(results) - cached, size, elapsed,
+                     size / elapsed if elapsed else 0, cached))
+
+    def download(self, url, dir=False, file=False, sha256=None):
+        """downloads a url to a directory or a file
+
+        :param string url: url to download
+        :param string dir: directory to download to
+        :param string file: file to download to
+        :param string sha256: expected sha256 of the file
+        :rtype: `dict` containing the number of bytes `transferred` (by all
+         attempts) and whether the file was retrieved from the cache
+         (`cached`)
+        """
+        stats = {}
 
-    def download(self, url, dir=False, file=False):
         @retry(retries=3, delay_multiplier=1)
         def _download(url, destination):
-            if not download_file(url, destination):
+            if not download_file(url, destination, sha256=sha256,
+                                 stats=stats):
                 sys.exit(codes.mapping['failed_to_download_file'])
 
         if (file and dir) or (not file and not dir):
@@ -59,3 +473,4 @@ class Handler(utils.Handler):
             destination = os.path.join(dir, url.split('/')[-1])
         lgr.debug('Downloading {0} to {1}'.format(url, destination))
         _download(url, destination)
+        return stats
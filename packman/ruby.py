@@ -1,28 +1,107 @@
 import logger
+import utils
+import retrieve
+import codes
+
+import os
 import sh
 import sys
-import codes
+
+# a local cache of all downloaded .gem files, shared by all packages
+DEFAULT_GEMS_CACHE_PATH = os.path.expanduser('~/.packman/gems')
+DEFAULT_GEMS_SOURCE = 'https://rubygems.org'
+# `gem install --explain` lists the gems it would install under this line
+GEMS_TO_INSTALL = 'Gems to install:'
 
 lgr = logger.init()
 
 
-class Handler():
-    def get_gems(self, gems, dir, rbenv=False):
+class Handler(utils.Handler):
+    """Ruby operations handler
+
+    the whole list of gems (along with their dependencies) is resolved by
+    a single gem run. the resolved .gem files are then downloaded
+    concurrently to a local gem cache (unless they're already cached)
+    and are installed from it by a single gem run.
+    """
+    def _gem(self, rbenv=False):
+        return sh.Command('{0}/bin/gem'.format(rbenv)) \
+            if rbenv else sh.Command('gem')
+
+    def sources(self, rbenv=False):
+        """returns the configured gem sources
+
+        :rtype: `list` of source urls
+        """
+        try:
+            o = self._gem(rbenv).sources('--list')
+        except sh.ErrorReturnCode:
+            return [DEFAULT_GEMS_SOURCE]
+        sources = [s.strip().rstrip('/') for s in str(o).splitlines()
+                   if s.strip().startswith('http')]
+        return sources or [DEFAULT_GEMS_SOURCE]
+
+    def resolve(self, gems, dir, rbenv=False):
+        """returns the gems which have to be installed to a directory to
+        install a list of gems
+
+        :param list gems: gems to resolve
+        :param string dir: directory the gems are to be installed to
+        :rtype: `list` of the gems' full names (e.g. rake-10.4.2)
+        """
+        lgr.debug('Resolving gems {0}'.format(', '.join(gems)))
+        try:
+            o = self._gem(rbenv).install(
+                '--explain', '--install-dir', dir, *gems)
+        except sh.ErrorReturnCode as ex:
+            lgr.error('Failed to resolve gems ({0})'.format(
+                ex.stderr.strip()))
+            sys.exit(codes.mapping['failed_to_download_gem'])
+        lines = str(o).splitlines()
+        if GEMS_TO_INSTALL not in lines:
+            return []
+        return [line.strip() for line in
+                lines[lines.index(GEMS_TO_INSTALL) + 1:] if line.strip()]
+
+    def get_gems(self, gems, dir, rbenv=False, cache_path=None,
+                 workers=retrieve.DEFAULT_DOWNLOAD_WORKERS):
         """downloads a list of ruby gems
 
         :param list gems: gems to download
         :param string dir: directory to download gems to
+        :param string cache_path: path of the local gem cache
+        :param int workers: number of concurrent downloads
         """
-        gem = sh.Command('{0}/bin/gem'.format(rbenv)) \
-            if rbenv else sh.Command('gem')
-        for gem in gems:
-            lgr.debug('Downloading gem {0}'.format(gem))
-            # TODO: (TEST) add support for ruby in different environments
-            o = gem.install('--no-ri', '--no-rdoc', '--install-dir',
-                            dir, gem, _iter=True)
-            try:
-                # this is where the command is actually executed
-                for line in o:
-                    lgr.debug(line)
-            except:
-                sys.exit(codes.mapping['failed_to_download_gem'])
+        if not gems:
+            return
+        gem = self._gem(rbenv)
+        cache_path = cache_path or DEFAULT_GEMS_CACHE_PATH
+        self.mkdir(cache_path)
+        full_names = self.resolve(gems, dir, rbenv)
+        if not full_names:
+            lgr.debug('Gems {0} are already installed'.format(
+                ', '.join(gems)))
+            return
+        gem_files = [os.path.join(cache_path, '{0}.gem'.format(n))
+                     for n in full_names]
+        missing = [os.path.basename(f) for f in gem_files
+                   if not os.path.isfile(f)]
+        if missing:
+            source = self.sources(rbenv)[0]
+            lgr.debug('Downloading gems {0}'.format(', '.join(missing)))
+            retrieve.Handler().downloads(
+                ['{0}/downloads/{1}'.format(source, f) for f in missing],
+                dir=cache_path, workers=workers)
+        lgr.debug('Installing gems {0}'.format(', '.join(full_names)))
+        # TODO: (TEST) add support for ruby in different environments
+        o = gem.install('--local', '--ignore-dependencies', '--no-ri',
+                        '--no-rdoc', '--install-dir', dir, *gem_files,
+                        _iter=True)
+        try:
+            # this is where the command is actually executed
+            for line in o:
+                lgr.debug(line.rstrip())
+        except sh.ErrorReturnCode as ex:
+            lgr.error('Failed to install gems ({0})'.format(
+                ex.stderr.strip()))
+            sys.exit(codes.mapping['failed_to_download_gem'])
@@ -0,0 +1,283 @@
+import logger
+import utils
+import codes
+import definitions as defs
+
+import multiprocessing
+import Queue
+import time
+import sys
+import os
+
+lgr = logger.init()
+
+
+def _execute(func, package, args, cwd):
+    """runs `func(*args)` for a single package inside a worker process
+
+    each package gets its own log prefix and starts from the directory
+    packman was invoked from, so that the `chdir` calls made by one package
+    can never affect another.
+
+    :param func: function to run
+    :param string package: name of the package `func` handles
+    :param tuple args: arguments to call `func` with
+    :param string cwd: directory to run `func` from
+    :rtype: `tuple` (package, exit code, duration in seconds)
+    """
+    logger.set_prefix(lgr, package)
+    start = time.time()
+    try:
+        with utils.chdir(cwd):
+            _, code = utils.catch_exit(func)(*args)
+    except Exception as ex:
+        lgr.error('Failed to handle {0} ({1})'.format(package, ex))
+        code = codes.mapping['package_action_failed']
+    finally:
+        logger.set_prefix(lgr)
+    return package, code, time.time() - start
+
+
+class Scheduler():
+    """runs a set of stages per package, starting each as soon as its
+    prerequisites are done.
+
+    a package is a prerequisite of another if the other package `depends`
+    on it (by its key or its name) or explicitly lists it under `after`.
+    packages which aren't handled in the current run are ignored.
+    """
+    def __init__(self, packages):
+        """
+        :param list packages: (package, package_dict) tuples. their order
+         is used to break ties between packages which are ready to run.
+        """
+        self.order = [package for package, _ in packages]
+        self.graph = self._build_graph(packages)
+        self.topological = self._sort()
+        self.stages = []
+        self.durations = {}
+
+    def _build_graph(self, packages):
+        """returns a dict mapping each package to its prerequisites
+        """
+        names = {}
+        for package, package_dict in packages:
+            if package_dict.get(defs.PARAM_NAME):
+                names[package_dict[defs.PARAM_NAME]] = package
+        for package, _ in packages:
+            names[package] = package
+
+        graph = {}
+        for package, package_dict in packages:
+            graph[package] = set()
+            for dependency in package_dict.get(defs.PARAM_DEPENDS) or []:
+                # fpm dependencies might contain version constraints
+                prereq = names.get(str(dependency).split(' ')[0])
+                if prereq and prereq != package:
+                    graph[package].add(prereq)
+            for prereq in package_dict.get(defs.PARAM_AFTER) or []:
+                if prereq not in names:
+                    lgr.debug('{0} is not handled in this run. {1} will not '
+                              'wait for it.'.format(prereq, package))
+                elif names[prereq] != package:
+                    graph[package].add(names[prereq])
+        lgr.debug('Package graph: {0}'.format(graph))
+        return graph
+
+    def _sort(self):
+        """returns the packages in a deterministic topological order
+        """
+        position = dict((p, i) for i, p in enumerate(self.order))
+        remaining = dict((p, set(prereqs)) for p, prereqs
+                         in self.graph.items())
+        ordered = []
+        while remaining:
+            ready = [p for p, prereqs in remaining.items() if not prereqs]
+            if not ready:
+                lgr.error('Packages {0} depend on each other.'.format(
+                    ', '.join(sorted(remaining))))
+                sys.exit(codes.mapping['cyclic_package_dependencies'])
+            package = min(ready, key=position.get)
+            ordered.append(package)
+            del remaining[package]
+            for prereqs in remaining.values():
+                prereqs.discard(package)
+        lgr.debug('Packages will be handled in order: {0}'.format(ordered))
+        return ordered
+
+    def _prereqs(self, node):
+        """returns the nodes which must be done before a node is started
+
+        a node is a (package, stage) tuple. a package's stage must wait for
+        its previous stage and for the same stage of the package's
+        prerequisites.
+        """
+        package, stage = node
+        prereqs = set((p, stage) for p in self.graph[package])
+        if stage > 0:
+            prereqs.add((package, stage - 1))
+        return prereqs
+
+    def _nodes(self, stages):
+        # ordering by stage and then by package keeps the nodes
+        # topologically ordered
+        return [(package, stage) for stage in range(len(stages))
+                for package in self.topological]
+
+    def run(self, func, stages, args, jobs=1, queue_depth=None):
+        """calls `func` for every stage of every package once all of its
+        prerequisites are done.
+
+        when there's more than one stage, each stage gets its own workers
+        so that a package's stage runs while the previous stage of the next
+        package is still running.
+
+        :param func: a module level function to call for each package and
+         stage. it is called with the stage followed by the package's args.
+        :param list stages: stages to run for each package (e.g. get, pack)
+        :param dict args: maps each package to the arguments `func`
+         should be called with
+        :param int jobs: number of packages to handle concurrently
+         in each stage
+        :param int queue_depth: max number of packages done with a stage
+         that may wait for the next stage to start. if omitted, a stage
+         never waits for the next one.
+        """
+        self.stages = stages
+        if len(self.order) > 1 and (jobs > 1 or len(stages) > 1):
+            self._run_concurrently(
+                func, args, min(jobs, len(self.order)), queue_depth)
+        else:
+            for package in self.topological:
+                for stage, name in enumerate(stages):
+                    start = time.time()
+                    func(name, *args[package])
+                    self.durations[(package, stage)] = time.time() - start
+        self.report()
+
+    def _run_concurrently(self, func, args, jobs, queue_depth):
+        lgr.info('Handling {0} packages using {1} workers per stage...'
+                 .format(len(self.order), jobs))
+        cwd = os.getcwd()
+        last = len(self.stages) - 1
+        done = Queue.Queue()
+        nodes = self._nodes(self.stages)
+        reversed_nodes = sorted(nodes, key=lambda n: -n[1])
+        pending = set(nodes)
+        running = set()
+        finished = set()
+        # nodes which failed or whose prerequisites failed
+        blocked = set()
+        failed = []
+        # packages which are done with a stage and wait for the next one
+        buffered = [set() for _ in self.stages]
+
+        def can_start(node):
+            package, stage = node
+            if len([n for n in running if n[1] == stage]) >= jobs:
+                return False
+            if queue_depth and stage < last and \
+                    len(buffered[stage]) >= queue_depth:
+                return False
+            return self._prereqs(node) <= finished
+
+        pools = [multiprocessing.Pool(processes=jobs) for _ in self.stages]
+        try:
+            while pending or running:
+                # later stages are considered first as starting them
+                # makes room for earlier stages
+                for node in [n for n in reversed_nodes if n in pending]:
+                    package, stage = node
+                    if self._prereqs(node) & blocked:
+                        lgr.error('Skipping {0} of {1} since a previous '
+                                  'step failed.'.format(
+                                      self.stages[stage], package))
+                        pending.remove(node)
+                        blocked.add(node)
+                        if stage > 0:
+                            buffered[stage - 1].discard(package)
+                    elif can_start(node):
+                        lgr.info('Starting {0} of {1}...'.format(
+                            self.stages[stage], package))
+                        pending.remove(node)
+                        running.add(node)
+                        if stage > 0:
+                            buffered[stage - 1].discard(package)
+                        pools[stage].apply_async(
+                            _execute, (func, package, (
+                                self.stages[stage],) + args[package], cwd),
+                            callback=lambda result, node=node: done.put(
+                                (node, result)))
+                if not running:
+                    break
+                try:
+                    node, (package, code, duration) = done.get(timeout=1)
+                except Queue.Empty:
+                    continue
+                stage = node[1]
+                running.remove(node)
+                self.durations[node] = duration
+                if code:
+                    lgr.error('Failed to {0} {1}.'.format(
+                        self.stages[stage], package))
+                    failed.append((node, code))
+                    blocked.add(node)
+                else:
+                    lgr.info('Finished {0} of {1} ({2:.2f}s).'.format(
+                        self.stages[stage], package, duration))
+                    finished.add(node)
+                    # the next stage might have been skipped already
+                    if stage < last and (package, stage + 1) in pending:
+                        buffered[stage].add(package)
+        finally:
+            for pool in pools:
+                pool.close()
+                pool.join()
+        if failed:
+            lgr.error('Failed packages: {0}'.format(
+                ', '.join(n[0] for n, _ in failed)))
+        # nothing is left running to make room for the pending nodes
+        stuck = [p for p in self.topological
+                 if any(n[0] == p for n in pending)]
+        if stuck:
+            lgr.error('Could not handle packages: {0}'.format(
+                ', '.join(stuck)))
+        if failed:
+            sys.exit(failed[0][1])
+        if stuck:
+            sys.exit(codes.mapping['package_action_failed'])
+
+    def critical_path(self):
+        """returns the chain of package stages which determined the total
+        run time (as each one of them had to wait for the previous one).
+
+        :rtype: `tuple` (list of (package, stage) tuples, duration in seconds)
+        """
+        finish = {}
+        previous = {}
+        nodes = [n for n in self._nodes(self.stages) if n in self.durations]
+        for node in nodes:
+            prereqs = [n for n in nodes
+                       if n in self._prereqs(node) and n in finish]
+            before = max(prereqs, key=finish.get) if prereqs else None
+            finish[node] = self.durations[node] + \
+                (finish[before] if before else 0)
+            previous[node] = before
+        if not finish:
+            return [], 0
+        node = max(nodes, key=finish.get)
+        duration = finish[node]
+        path = []
+        while node:
+            path.insert(0, node)
+            node = previous[node]
+        return path, duration
+
+    def report(self):
+        """logs the critical path of the run
+        """
+        path, duration = self.critical_path()
+        if path:
+            lgr.info('Critical path: {0} ({1:.2f}s)'.format(' -> '.join(
+                '{0}:{1}'.format(p, self.stages[s]) for p, s in path),
+                duration))
@@ -16,12 +16,22 @@
 import packman.logger as logger
 import packman.packman as packman
 import packman.python as py
+import packman.ruby as rb
+import packman.node as node
 import packman.fpm as fpm
+import packman.archive as archive
 import packman.retrieve as retr
 import packman.utils as utils
 import packman.templater as templater
 import packman.codes as codes
 import packman.definitions as defs
+import packman.scheduler as scheduler
+import packman.cache as cache
+import packman.fingerprint as fingerprint
+import packman.apt as apt
+import packman.yum as yum
+import packman.metadata as metadata
+import packman.mirror as mirror
 
 import sys
 import sh
@@ -32,6 +42,14 @@ from testfixtures import log_capture
 import logging
 from platform import dist
 import shutil
+import hashlib
+import tarfile
+import json
+import time
+import threading
+import SocketServer
+import SimpleHTTPServer
+import StringIO
 
 
 TEST_DIR = '{0}/test_dir'.format(os.path.expanduser("~"))
@@ -51,6 +69,91 @@ MOCK_TEMPLATE_CONTENTS = 'TEST={{ test_template_parameter }}'
 MOCK_PACKAGES_FILE = 'packages.yaml'
 MOCK_PACKAGES_CONTENTS = '''PACKAGES = {'test_component':'x'}'''
 MOCK_PACKAGES_DICT = {'test_component': 'x'}
+MOCK_LAST_MODIFIED = 'Thu, 01 Jan 1970 00:00:00 GMT'
+MOCK_APT_DEPENDS = [
+    'curl\n',
+    '  Depends: libcurl3\n',
+    '  Depends: libc6\n',
+    'libcurl3\n',
+    '  Depends: libc6\n',
+    '  Depends: <libssl>\n',
+    '    libssl1.0.0\n',
+    '<libssl>\n',
+    'libc6\n',
+]
+MOCK_DPKG_STATUS = '''Package: make
+Status: install ok installed
+Architecture: amd64
+Version: 3.81-8.2ubuntu3
+Description: utility for directing compilation
+ Status: not a field
+
+Package: curl
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 7.35.0-1ubuntu2
+'''
+MOCK_APT_PRINTED_URIS = [
+    "'http://archive.ubuntu.com/pool/main/c/curl/curl.deb' curl.deb 1 "
+    "SHA256:{0}\n".format('ab' * 32),
+    "'http://archive.ubuntu.com/pool/main/g/glibc/libc6.deb' libc6.deb 2 "
+    "MD5Sum:{0}\n".format('cd' * 16),
+]
+MOCK_RUNNER_PACKAGES_CONTENTS = '''packages:
+    package_a:
+        name: package_a
+    package_b:
+        name: package_b
+    package_c:
+        name: package_c
+        depends:
+            - package_a
+'''
+MOCK_RUNNER_GET_CONTENTS = '''import os
+import sys
+
+
+def get_package_a():
+    open('package_a', 'w').close()
+
+
+def get_package_b():
+    open('package_b', 'w').close()
+
+
+def get_package_c():
+    if not os.path.isfile('package_a'):
+        sys.exit(98)
+    open('package_c', 'w').close()
+'''
+MOCK_RUNNER_PACK_CONTENTS = '''import os
+import sys
+
+
+def pack(package):
+    if not os.path.isfile(package):
+        sys.exit(97)
+    open(package + '.pkg', 'w').close()
+
+
+def pack_package_a():
+    pack('package_a')
+
+
+def pack_package_b():
+    pack('package_b')
+
+
+def pack_package_c():
+    if not os.path.isfile('package_a.pkg'):
+        sys.exit(96)
+    pack('package_c')
+'''
+
+TEST_SERVED_DIR = '{0}/test_served_dir'.format(os.path.expanduser("~"))
+TEST_CACHE_DIR = '{0}/test_cache_dir'.format(os.path.expanduser("~"))
+TEST_VENVS_DIR = '{0}/test_venvs_dir'.format(os.path.expanduser("~"))
+TEST_INDEX_DIR = '{0}/test_index_dir'.format(os.path.expanduser("~"))
 
 HIDE_LEVEL = 'everything'
 
@@ -78,6 +181,83 @@ def dir(func):
     return execution_handler
 
 
+class LocalRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    # status codes of all responses sent
+    sent = []
+    # number of bytes cut off the body of the next full response
+    truncate = 0
+
+    def translate_path(self, path):
+        return os.path.join(TEST_SERVED_DIR, path.split('?')[0].lstrip('/'))
+
+    def send_response(self, code, *args):
+        LocalRequestHandler.sent.append(code)
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(
+            self, code, *args)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        with open(path, 'rb') as f:
+            content = f.read()
+        last_modified = self.date_time_string(os.stat(path).st_mtime)
+        if self.headers.get('If-Modified-Since') == last_modified:
+            self.send_response(304)
+            self.end_headers()
+            return None
+        start, end = 0, len(content) - 1
+        if self.headers.get('Range') and \
+                self.headers.get('If-Range') == last_modified:
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            start, end = int(first), int(last or end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if start == 0 and LocalRequestHandler.truncate:
+            end -= LocalRequestHandler.truncate
+            LocalRequestHandler.truncate = 0
+        return StringIO.StringIO(content[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+def served(func):
+    """serves TEST_SERVED_DIR over http while running `func`
+
+    the decorated function receives the server's base url.
+    """
+    @wraps(func)
+    def execution_handler(*args, **kwargs):
+        client = utils.Handler()
+        client.rmdir(TEST_SERVED_DIR)
+        client.mkdir(TEST_SERVED_DIR)
+        LocalRequestHandler.sent = []
+        LocalRequestHandler.truncate = 0
+        server = SocketServer.ThreadingTCPServer(
+            ('127.0.0.1', 0), LocalRequestHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            func(*(args + ('http://127.0.0.1:{0}'.format(
+                server.server_address[1]),)), **kwargs)
+        finally:
+            server.shutdown()
+            server.server_close()
+            client.rmdir(TEST_SERVED_DIR)
+    return execution_handler
+
+
 def venv(func):
     @wraps(func)
     def execution_handler(*args, **kwargs):
@@ -133,6 +313,139 @@ class TestBaseMethods(testtools.TestCase):
         self.assertEqual(
             ex.message, codes.mapping['cannot_access_config_file'])
 
+    @log_capture()
+    def test_logger_prefix(self, capture):
+        lgr = logger.init(base_level=logging.DEBUG)
+        logger.set_prefix(lgr, 'test_package')
+        lgr.debug('TEST_LOGGER_OUTPUT')
+        logger.set_prefix(lgr)
+        lgr.debug('TEST_LOGGER_OUTPUT')
+        capture.check(
+            ('user', 'DEBUG', '[test_package] TEST_LOGGER_OUTPUT'),
+            ('user', 'DEBUG', 'TEST_LOGGER_OUTPUT'))
+
+
+class RunnerTest(testtools.TestCase):
+
+    def test_runner_jobs_less_than_one(self):
+        ex = self.assertRaises(
+            SystemExit, packman.packman_runner, 'get',
+            TEST_PACKAGES_FILE, jobs=0)
+        self.assertEqual(ex.message, codes.mapping['jobs_must_be_positive'])
+
+    def test_execute_in_worker_returns_exit_code(self):
+        package, code, _ = scheduler._execute(
+            packman.get, 'mock_package', ({},), os.getcwd())
+        self.assertEqual(package, 'mock_package')
+        self.assertEqual(code, codes.mapping['sources_path_required'])
+
+    def test_scheduler_order(self):
+        s = scheduler.Scheduler([
+            ('package_a', {'name': 'a', 'depends': ['b (>= 1.0)', 'make']}),
+            ('package_b', {'name': 'b', 'after': ['package_c']}),
+            ('package_c', {'name': 'c'}),
+            ('package_d', {'name': 'd', 'after': ['package_x']})])
+        self.assertEqual(s.graph['package_a'], set(['package_b']))
+        self.assertEqual(s.graph['package_d'], set())
+        self.assertEqual(s.topological, [
+            'package_c', 'package_b', 'package_a', 'package_d'])
+
+    def test_scheduler_cyclic_dependencies(self):
+        ex = self.assertRaises(
+            SystemExit, scheduler.Scheduler, [
+                ('package_a', {'after': ['package_b']}),
+                ('package_b', {'after': ['package_a']})])
+        self.assertEqual(
+            ex.message, codes.mapping['cyclic_package_dependencies'])
+
+    def test_scheduler_critical_path(self):
+        s = scheduler.Scheduler([
+            ('package_a', {'after': ['package_b', 'package_c']}),
+            ('package_b', {}),
+            ('package_c', {})])
+        s.stages = ['get', 'pack']
+        s.durations = {
+            ('package_a', 0): 1, ('package_b', 0): 2, ('package_c', 0): 5,
+            ('package_a', 1): 1, ('package_b', 1): 7, ('package_c', 1): 1}
+        self.assertEqual(s.critical_path(), (
+            [('package_b', 0), ('package_b', 1), ('package_a', 1)], 10))
+
+    @dir
+    def test_runner_concurrent_jobs(self):
+        with open(os.path.join(TEST_DIR, MOCK_PACKAGES_FILE), 'w') as f:
+            f.write(MOCK_RUNNER_PACKAGES_CONTENTS)
+        with open(os.path.join(TEST_DIR, 'get.py'), 'w') as f:
+            f.write(MOCK_RUNNER_GET_CONTENTS)
+        with utils.chdir(TEST_DIR):
+            packman.packman_runner('get', jobs=2)
+        for package in ('package_a', 'package_b', 'package_c'):
+            self.assertTrue(os.path.isfile(os.path.join(TEST_DIR, package)))
+
+    @dir
+    def test_runner_make_pipeline(self):
+        with open(os.path.join(TEST_DIR, MOCK_PACKAGES_FILE), 'w') as f:
+            f.write(MOCK_RUNNER_PACKAGES_CONTENTS)
+        with open(os.path.join(TEST_DIR, 'get.py'), 'w') as f:
+            f.write(MOCK_RUNNER_GET_CONTENTS)
+        with open(os.path.join(TEST_DIR, 'pack.py'), 'w') as f:
+            f.write(MOCK_RUNNER_PACK_CONTENTS)
+        with utils.chdir(TEST_DIR):
+            packman.packman_runner('make', queue_depth=1)
+        for package in ('package_a', 'package_b', 'package_c'):
+            self.assertTrue(os.path.isfile(
+                os.path.join(TEST_DIR, package + '.pkg')))
+
+    def test_runner_mirror_on_unsupported_distro(self):
+        self.patch(packman, 'CENTOS', False)
+        self.patch(packman, 'DEBIAN', False)
+        ex = self.assertRaises(
+            SystemExit, packman.packman_runner, 'get',
+            TEST_PACKAGES_FILE, mirror_path=TEST_DIR)
+        self.assertEqual(
+            ex.message, codes.mapping['mirror_not_supported_by_distro'])
+
+    def test_runner_queue_depth_less_than_one(self):
+        ex = self.assertRaises(
+            SystemExit, packman.packman_runner, 'make',
+            TEST_PACKAGES_FILE, queue_depth=0)
+        self.assertEqual(
+            ex.message, codes.mapping['queue_depth_must_be_positive'])
+
+    @dir
+    def test_runner_failed_prerequisite(self):
+        with open(os.path.join(TEST_DIR, MOCK_PACKAGES_FILE), 'w') as f:
+            f.write(MOCK_RUNNER_PACKAGES_CONTENTS)
+        with open(os.path.join(TEST_DIR, 'get.py'), 'w') as f:
+            f.write(MOCK_RUNNER_GET_CONTENTS.replace(
+                "open('package_a', 'w').close()", "sys.exit(99)"))
+        with utils.chdir(TEST_DIR):
+            ex = self.assertRaises(
+                SystemExit, packman.packman_runner, 'get', jobs=2)
+        self.assertEqual(ex.message, 99)
+        self.assertTrue(os.path.isfile(os.path.join(TEST_DIR, 'package_b')))
+        self.assertFalse(os.path.isfile(os.path.join(TEST_DIR, 'package_c')))
+
+    @dir
+    def test_runner_skipped_pack_frees_queue(self):
+        with open(os.path.join(TEST_DIR, MOCK_PACKAGES_FILE), 'w') as f:
+            f.write(MOCK_RUNNER_PACKAGES_CONTENTS.replace(
+                'package_b', 'package_z'))
+        with open(os.path.join(TEST_DIR, 'get.py'), 'w') as f:
+            f.write(MOCK_RUNNER_GET_CONTENTS.replace(
+                'package_b', 'package_z'))
+        with open(os.path.join(TEST_DIR, 'pack.py'), 'w') as f:
+            f.write(MOCK_RUNNER_PACK_CONTENTS.replace(
+                'package_b', 'package_z').replace(
+                "pack('package_a')", "sys.exit(99)"))
+        with utils.chdir(TEST_DIR):
+            ex = self.assertRaises(
+                SystemExit, packman.packman_runner, 'make', queue_depth=1)
+        self.assertEqual(ex.message, 99)
+        self.assertTrue(os.path.isfile(
+            os.path.join(TEST_DIR, 'package_z.pkg')))
+        self.assertFalse(os.path.isfile(
+            os.path.join(TEST_DIR, 'package_c.pkg')))
+
 
 class UtilsHandlerTest(testtools.TestCase, utils.Handler):
 
@@ -144,6 +457,46 @@ class UtilsHandlerTest(testtools.TestCase, utils.Handler):
     def test_check_distro_success(self):
         utils.check_distro()
 
+    @dir
+    def test_link(self):
+        source = os.path.join(TEST_DIR, 'source')
+        destination = os.path.join(TEST_DIR, 'destination')
+        with open(source, 'w') as f:
+            f.write('x')
+        sh.touch(destination)
+        self.link(source, destination)
+        self.assertTrue(os.path.samefile(source, destination))
+        self.link(source, destination, hardlink=False)
+        self.assertFalse(os.path.samefile(source, destination))
+        with open(destination) as f:
+            self.assertEqual(f.read(), 'x')
+
+    @dir
+    def test_flock(self):
+        lock = os.path.join(TEST_DIR, 'locks', 'x.lock')
+        with utils.flock(lock):
+            with utils.flock(lock, blocking=False) as locked:
+                self.assertFalse(locked)
+        with utils.flock(lock, blocking=False) as locked:
+            self.assertTrue(locked)
+
+    def test_concurrently(self):
+        self.assertEqual(utils.concurrently(lambda i: i * 2, [1, 2, 3], 2),
+                         [2, 4, 6])
+
+    def test_concurrently_exits_after_all_calls(self):
+        called = []
+
+        def call(i):
+            called.append(i)
+            if i % 2:
+                sys.exit(i)
+
+        ex = self.assertRaises(
+            SystemExit, utils.concurrently, call, [1, 2, 3], 2)
+        self.assertEqual(ex.code, 1)
+        self.assertEqual(sorted(called), [1, 2, 3])
+
     def test_check_distro_fail(self):
         ex = self.assertRaises(
             SystemExit, utils.check_distro, supported='nodistro')
@@ -267,8 +620,50 @@ class UtilsHandlerTest(testtools.TestCase, utils.Handler):
     #     self.assertFalse(self.is_file('./' + TEST_FILE_NAME))
 
 
+class FakePip():
+    """records pip runs instead of running pip"""
+    runs = []
+    cached = True
+    # modules written to the destination of `pip download`
+    downloaded = []
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, *args, **kwargs):
+        FakePip.runs.append(args)
+        if 'download' in args and FakePip.downloaded:
+            dest = args[args.index('--dest') + 1]
+            for module in FakePip.downloaded:
+                open(os.path.join(dest, module), 'w').close()
+            FakePip.cached = True
+        if '--no-index' in args and not FakePip.cached:
+            raise sh.ErrorReturnCode_1('pip', '', 'not cached')
+        return iter([])
+
+    def install(self, *args, **kwargs):
+        return self('install', *args, **kwargs)
+
+    def freeze(self, *args, **kwargs):
+        self('freeze', *args, **kwargs)
+        return iter(['A==1.0\n', 'b-c==2.0\n'])
+
+
+class FakePipSh():
+    ErrorReturnCode = sh.ErrorReturnCode
+    Command = FakePip
+
+
 class PythonHandlerTest(testtools.TestCase, py.Handler, utils.Handler):
 
+    def setUp(self):
+        super(PythonHandlerTest, self).setUp()
+        self.patch(py, 'DEFAULT_MODULES_CACHE_PATH', TEST_CACHE_DIR)
+        self.addCleanup(self.rmdir, TEST_CACHE_DIR)
+        FakePip.runs = []
+        FakePip.cached = True
+        FakePip.downloaded = []
+
     def test_pip_existent_module(self):
         self.install([TEST_MODULE])
 
@@ -314,9 +709,318 @@ class PythonHandlerTest(testtools.TestCase, py.Handler, utils.Handler):
         self.assertEqual(
             ex.message, codes.mapping['failed_to_download_module'])
 
+    def test_get_modules_invalid_format(self):
+        ex = self.assertRaises(
+            SystemExit, self.get_modules, [TEST_MODULE], os.getcwd(),
+            format='egg')
+        self.assertEqual(
+            ex.message, codes.mapping['invalid_python_modules_format'])
+
+    def test_prebuilt_venv(self):
+        client = py.Handler()
+        client.install(['virtualenv'])
+        self.addCleanup(self.rmdir, TEST_VENVS_DIR)
+        self.addCleanup(self.rmdir, TEST_VENV)
+        self.addCleanup(self.rmdir, TEST_VENV + '_2')
+        self.assertFalse(self.prebuilt_venv(
+            TEST_VENV, [TEST_MODULE], venvs_path=TEST_VENVS_DIR))
+        self.assertTrue(self.prebuilt_venv(
+            TEST_VENV + '_2', [TEST_MODULE], venvs_path=TEST_VENVS_DIR))
+        self.assertEqual(len(os.listdir(TEST_VENVS_DIR)), 1)
+        self.rmdir(TEST_VENV)
+        with open(os.path.join(TEST_VENV + '_2', 'bin', 'pip')) as f:
+            self.assertIn(TEST_VENV + '_2', f.readline())
+        self.assertTrue(
+            self.check_module_installed(TEST_MODULE, TEST_VENV + '_2'))
+
+    def test_prune_venvs(self):
+        self.addCleanup(self.rmdir, TEST_VENVS_DIR)
+        for key in ('old', 'new', 'saving'):
+            self.mkdir(os.path.join(TEST_VENVS_DIR, key))
+        for key in ('old', 'new'):
+            sh.touch(os.path.join(TEST_VENVS_DIR, key, 'origin'))
+        old = time.time() - py.DEFAULT_VENVS_MAX_AGE - 1
+        os.utime(os.path.join(TEST_VENVS_DIR, 'old', 'origin'), (old, old))
+        self.assertEqual(self.prune_venvs(venvs_path=TEST_VENVS_DIR), 1)
+        self.assertEqual(sorted(os.listdir(TEST_VENVS_DIR)),
+                         ['new', 'saving'])
+        self.assertEqual(self.prune_venvs(0, venvs_path=TEST_VENVS_DIR), 1)
+        self.assertEqual(os.listdir(TEST_VENVS_DIR), ['saving'])
+
+    def test_relocate_venv(self):
+        self.addCleanup(self.rmdir, TEST_VENV + '_2')
+        bin_dir = os.path.join(TEST_VENV + '_2', 'bin')
+        self.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'pip'), 'w') as f:
+            f.write('#!{0}/bin/python\n'.format(TEST_VENV))
+        os.symlink(os.path.join(TEST_VENV, 'bin'),
+                   os.path.join(TEST_VENV + '_2', 'local'))
+        self.relocate_venv(TEST_VENV + '_2', TEST_VENV)
+        with open(os.path.join(bin_dir, 'pip')) as f:
+            self.assertEqual(f.read(), '#!{0}_2/bin/python\n'.format(
+                TEST_VENV))
+        self.assertEqual(os.readlink(os.path.join(
+            TEST_VENV + '_2', 'local')), bin_dir)
+
+    def _fixed_downloads_dir(self):
+        downloads = os.path.join(TEST_DIR, 'downloads')
+
+        def mkdtemp(**kwargs):
+            os.mkdir(downloads)
+            return downloads
+        self.patch(py.tempfile, 'mkdtemp', mkdtemp)
+        return downloads
+
+    @dir
+    def test_get_modules_in_single_run(self):
+        self.patch(py, 'sh', FakePipSh)
+        downloads = self._fixed_downloads_dir()
+        self.get_modules(['a', 'b'], TEST_DIR)
+        self.get_modules(['a', 'b'], TEST_DIR, format='wheelhouse')
+        self.assertEqual(FakePip.runs, [
+            ('download', '--dest', downloads, '--no-index', '--find-links',
+             TEST_CACHE_DIR, 'a', 'b'),
+            ('wheel', '--wheel-dir', downloads, '--no-index',
+             '--find-links', TEST_CACHE_DIR, 'a', 'b')])
+        self.assertFalse(os.path.exists(downloads))
+
+    @dir
+    def test_get_modules_not_cached(self):
+        self.patch(py, 'sh', FakePipSh)
+        downloads = self._fixed_downloads_dir()
+        FakePip.cached = False
+        self.get_modules(['a'], TEST_DIR)
+        self.assertEqual(FakePip.runs[1], (
+            'download', '--dest', downloads, '--find-links', TEST_CACHE_DIR,
+            '--default-timeout', '45', 'a'))
+
+    @dir
+    def test_get_modules_caches_only_modules(self):
+        self.patch(py, 'sh', FakePipSh)
+        sh.touch(os.path.join(TEST_DIR, 'jdk.tar.gz'))
+        self.get_modules(['a'], TEST_DIR)
+        self.assertEqual(os.listdir(TEST_CACHE_DIR), [])
+        self.assertEqual(os.listdir(TEST_DIR), ['jdk.tar.gz'])
+
+    @dir
+    def test_get_modules_to_cache(self):
+        self.get_modules([TEST_MODULE], TEST_DIR)
+        cached = os.listdir(TEST_CACHE_DIR)
+        self.assertTrue(len(cached) > 0)
+        self.assertEqual(self.cache_modules(TEST_DIR), [])
+        self.assertNotEqual(
+            os.stat(os.path.join(TEST_DIR, cached[0])).st_ino,
+            os.stat(os.path.join(TEST_CACHE_DIR, cached[0])).st_ino)
+
+    def test_install_modules_in_single_run(self):
+        self.patch(py, 'sh', FakePipSh)
+        self.install(['a==1.0', 'B_C>=2'])
+        self.assertEqual(FakePip.runs, [
+            ('install', '--no-index', '--find-links', TEST_CACHE_DIR,
+             'a==1.0', 'B_C>=2'),
+            ('freeze',)])
+
+    @dir
+    def test_install_modules_not_cached(self):
+        self.patch(py, 'sh', FakePipSh)
+        downloads = self._fixed_downloads_dir()
+        FakePip.cached = False
+        ex = self.assertRaises(SystemExit, self.install, ['a'])
+        self.assertEqual(
+            ex.message, codes.mapping['module_could_not_be_installed'])
+        self.assertEqual(FakePip.runs[1], (
+            'download', '--dest', downloads, '--find-links',
+            TEST_CACHE_DIR, '--default-timeout', '45', 'a'))
+        self.assertFalse(os.path.exists(downloads))
+
+    @dir
+    def test_install_caches_downloaded_modules(self):
+        self.patch(py, 'sh', FakePipSh)
+        downloads = self._fixed_downloads_dir()
+        FakePip.cached = False
+        FakePip.downloaded = ['a-1.0.tar.gz']
+        self.install(['a'])
+        self.assertEqual(os.listdir(TEST_CACHE_DIR), ['a-1.0.tar.gz'])
+        self.assertFalse(os.path.exists(downloads))
+
+    def test_install_modules_missing_after_install(self):
+        self.patch(py, 'sh', FakePipSh)
+        ex = self.assertRaises(SystemExit, self.install, ['a', 'd'])
+        self.assertEqual(
+            ex.message, codes.mapping['module_could_not_be_installed'])
+
+
+class FakeGem():
+    """records gem runs instead of running gem"""
+    runs = []
+
+    def __init__(self, path):
+        self.path = path
+
+    def install(self, *args, **kwargs):
+        FakeGem.runs.append(('install',) + args)
+        if '--explain' in args:
+            return 'Gems to install:\n  a-1.0\n  b-2.0-x86_64-linux\n'
+        return iter([])
+
+    def sources(self, *args, **kwargs):
+        return '*** CURRENT SOURCES ***\n\nhttp://gems.local/\n'
+
+
+class FakeGemSh():
+    ErrorReturnCode = sh.ErrorReturnCode
+    Command = FakeGem
+
+
+class RubyHandlerTest(testtools.TestCase, rb.Handler):
+
+    def setUp(self):
+        super(RubyHandlerTest, self).setUp()
+        self.patch(rb, 'sh', FakeGemSh)
+        self.addCleanup(self.rmdir, TEST_CACHE_DIR)
+        FakeGem.runs = []
+
+    def test_resolve(self):
+        self.assertEqual(self.resolve(['a', 'b'], TEST_DIR),
+                         ['a-1.0', 'b-2.0-x86_64-linux'])
+
+    def test_get_gems(self):
+        downloaded = []
+
+        def downloads(retriever, urls, dir, workers):
+            downloaded.extend(urls)
+            for url in urls:
+                open(os.path.join(dir, url.split('/')[-1]), 'w').close()
+
+        self.patch(retr.Handler, 'downloads', downloads)
+        self.get_gems(['a', 'b'], TEST_DIR, cache_path=TEST_CACHE_DIR)
+        self.get_gems(['a', 'b'], TEST_DIR, cache_path=TEST_CACHE_DIR)
+        # the gems are only downloaded once
+        self.assertEqual(downloaded, [
+            'http://gems.local/downloads/a-1.0.gem',
+            'http://gems.local/downloads/b-2.0-x86_64-linux.gem'])
+        self.assertEqual(FakeGem.runs[1], (
+            'install', '--local', '--ignore-dependencies', '--no-ri',
+            '--no-rdoc', '--install-dir', TEST_DIR,
+            os.path.join(TEST_CACHE_DIR, 'a-1.0.gem'),
+            os.path.join(TEST_CACHE_DIR, 'b-2.0-x86_64-linux.gem')))
+
+
+MOCK_NPM_VIEWS = {
+    'a@^1': [
+        {'name': 'a', 'version': '1.0.0',
+         'dist.tarball': 'http://npm.local/a/-/a-1.0.0.tgz'},
+        {'name': 'a', 'version': '1.1.0',
+         'dist.tarball': 'http://npm.local/a/-/a-1.1.0.tgz',
+         'dependencies': {'c': '^2', 'd': 'git+https://git.local/d.git'}}],
+    'a@1.1.0': {
+        'name': 'a', 'version': '1.1.0',
+        'dist.tarball': 'http://npm.local/a/-/a-1.1.0.tgz',
+        'dependencies': {'c': '^2', 'd': 'git+https://git.local/d.git'}},
+    '@s/b@2.0.0': {
+        'name': '@s/b', 'version': '2.0.0',
+        'dist.tarball': 'http://npm.local/@s/b/-/b-2.0.0.tgz',
+        'dependencies': {'a': '1.1.0'}},
+    'c@^2': {
+        'name': 'c', 'version': '2.1.0',
+        'dist.tarball': 'http://npm.local/c/-/c-2.1.0.tgz'},
+}
+
+
+def fake_npm(*args, **kwargs):
+    FakeNpmSh.runs.append(args)
+    if args[0] == 'config':
+        return 'http://npm.local/\n'
+    if args[1] not in MOCK_NPM_VIEWS:
+        raise sh.ErrorReturnCode_1('npm view', '', 'E404')
+    return json.dumps(MOCK_NPM_VIEWS[args[1]])
+
+
+class FakeNpmSh():
+    ErrorReturnCode = sh.ErrorReturnCode
+    runs = []
+    npm = staticmethod(fake_npm)
+    cp = staticmethod(sh.cp)
+
+
+class NodeHandlerTest(testtools.TestCase, node.Handler):
+
+    def setUp(self):
+        super(NodeHandlerTest, self).setUp()
+        self.patch(node, 'sh', FakeNpmSh)
+        self.patch(node, '_resolved', {})
+        self.patch(node, 'DEFAULT_NODE_CACHE_PATH', TEST_CACHE_DIR)
+        self.addCleanup(self.rmdir, TEST_CACHE_DIR)
+        FakeNpmSh.runs = []
+
+    def test_split_package(self):
+        self.assertEqual(node.split_package('a'), ('a', 'latest'))
+        self.assertEqual(node.split_package('a@^1'), ('a', '^1'))
+        self.assertEqual(node.split_package('@s/a@1.0.0'), ('@s/a', '1.0.0'))
+
+    def test_resolve(self):
+        self.assertEqual(self.resolve('a@^1'), (
+            'a', '1.1.0', 'http://npm.local/a/-/a-1.1.0.tgz',
+            ['c@^2', 'd@git+https://git.local/d.git']))
+        self.assertEqual(self.resolve('@s/b@2.0.0', 'http://npm.local'), (
+            '@s/b', '2.0.0', 'http://npm.local/@s/b/-/b-2.0.0.tgz',
+            ['a@1.1.0']))
+        self.resolve('a@^1')
+        # specs are only resolved once
+        self.assertEqual(len(FakeNpmSh.runs), 2)
+        # and the metadata of exact versions is kept on disk
+        self.patch(node, '_resolved', {})
+        self.assertEqual(self.resolve('a@1.1.0')[1:], (
+            '1.1.0', 'http://npm.local/a/-/a-1.1.0.tgz',
+            ['c@^2', 'd@git+https://git.local/d.git']))
+        self.assertEqual(len(FakeNpmSh.runs), 2)
+
+    def test_resolve_tree(self):
+        self.assertEqual(self.resolve_tree(['@s/b@2.0.0']), [
+            ('@s/b', '2.0.0', 'http://npm.local/@s/b/-/b-2.0.0.tgz'),
+            ('a', '1.1.0', 'http://npm.local/a/-/a-1.1.0.tgz'),
+            ('c', '2.1.0', 'http://npm.local/c/-/c-2.1.0.tgz')])
+
+    def test_resolve_missing_package(self):
+        ex = self.assertRaises(SystemExit, self.resolve, 'missing')
+        self.assertEqual(
+            ex.message, codes.mapping['failed_to_resolve_node_package'])
+
+    @dir
+    def test_get_packages(self):
+        downloaded = []
+
+        def downloads(retriever, urls, dir, workers):
+            downloaded.extend(urls)
+            for url in urls:
+                open(os.path.join(dir, url.split('/')[-1]), 'w').close()
+
+        self.patch(retr.Handler, 'downloads', downloads)
+        packages = ['a@^1', 'a@1.1.0', '@s/b@2.0.0', 'a@^1']
+        self.get_packages(packages, TEST_DIR, cache_path=TEST_CACHE_DIR)
+        self.get_packages(packages, TEST_DIR, cache_path=TEST_CACHE_DIR)
+        # identical versions are only downloaded once
+        self.assertEqual(sorted(downloaded), [
+            'http://npm.local/@s/b/-/b-2.0.0.tgz',
+            'http://npm.local/a/-/a-1.1.0.tgz',
+            'http://npm.local/c/-/c-2.1.0.tgz'])
+        self.assertEqual(sorted(os.listdir(TEST_DIR)),
+                         ['a-1.1.0.tgz', 'c-2.1.0.tgz', 's-b-2.0.0.tgz'])
+        cached = [os.path.join(root, name) for root, _, names in
+                  os.walk(TEST_CACHE_DIR) for name in names
+                  if name == 'a-1.1.0.tgz']
+        self.assertNotEqual(
+            os.stat(cached[0]).st_ino,
+            os.stat(os.path.join(TEST_DIR, 'a-1.1.0.tgz')).st_ino)
+
 
 class RetrieveHandlerTest(testtools.TestCase, retr.Handler, utils.Handler):
 
+    def setUp(self):
+        super(RetrieveHandlerTest, self).setUp()
+        self.patch(cache, 'DEFAULT_CACHE_PATH', TEST_CACHE_DIR)
+        self.addCleanup(self.rmdir, TEST_CACHE_DIR)
+
     @dir
     def test_download_file_to_dir(self):
         self.downloads([TEST_DL_FILE], dir=TEST_DIR)
@@ -338,6 +1042,244 @@ class RetrieveHandlerTest(testtools.TestCase, retr.Handler, utils.Handler):
         ex = self.assertRaises(SystemExit, self.download, TEST_DL_FILE)
         self.assertEqual(ex.message, codes.mapping['must_specify_file_or_dir'])
 
+    @dir
+    @served
+    def test_download_multiple_files_concurrently(self, url):
+        files = ['file_{0}'.format(i) for i in range(10)]
+        for f in files:
+            with open(os.path.join(TEST_SERVED_DIR, f), 'w') as served:
+                served.write(f * 1000)
+        self.downloads(['{0}/{1}'.format(url, f) for f in files],
+                       dir=TEST_DIR, workers=4)
+        for f in files:
+            with open(os.path.join(TEST_DIR, f)) as downloaded:
+                self.assertEqual(downloaded.read(), f * 1000)
+
+    @dir
+    @served
+    def test_download_multiple_files_one_missing(self, url):
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write('x')
+        ex = self.assertRaises(
+            SystemExit, self.downloads,
+            ['{0}/file'.format(url), '{0}/missing'.format(url)],
+            dir=TEST_DIR)
+        self.assertEqual(ex.message, codes.mapping['failed_to_download_file'])
+        self.assertTrue(os.path.isfile(os.path.join(TEST_DIR, 'file')))
+
+    @dir
+    def test_download_local_file(self):
+        source = os.path.join(TEST_DIR, 'source')
+        with open(source, 'w') as f:
+            f.write('x')
+        self.download('file://{0}'.format(source), file=TEST_FILE,
+                      sha256=hashlib.sha256('x').hexdigest())
+        with open(TEST_FILE) as f:
+            self.assertEqual(f.read(), 'x')
+
+    @dir
+    @served
+    def test_download_file_from_cache(self, url):
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write('x')
+        self.download('{0}/file'.format(url), file=TEST_FILE)
+        self.download('{0}/file'.format(url), dir=TEST_DIR)
+        entries = cache.Handler().entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0][1]['url'], '{0}/file'.format(url))
+        # the downloads are copies of the cached file, so changing
+        # one of them doesn't change the cached file
+        with open(TEST_FILE, 'w') as f:
+            f.write('y')
+        self.download('{0}/file'.format(url), file=TEST_FILE)
+        with open(TEST_FILE) as f:
+            self.assertEqual(f.read(), 'x')
+        self.assertEqual(oct(os.stat(TEST_FILE).st_mode & 0o777), '0644')
+
+    @dir
+    @served
+    def test_download_counts_transferred_bytes(self, url):
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write('x' * 1000)
+        self.assertEqual(self.download('{0}/file'.format(url), dir=TEST_DIR),
+                         {'transferred': 1000, 'cached': False})
+        # the revalidated file is copied from the cache
+        self.assertEqual(self.download('{0}/file'.format(url), dir=TEST_DIR),
+                         {'transferred': 0, 'cached': True})
+
+    @dir
+    @served
+    def test_download_not_modified_file(self, url):
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write('x')
+        self.download('{0}/file'.format(url), dir=TEST_DIR)
+        self.rm(os.path.join(TEST_DIR, 'file'))
+        self.download('{0}/file'.format(url), dir=TEST_DIR)
+        self.assertEqual(LocalRequestHandler.sent, [200, 304])
+        with open(os.path.join(TEST_DIR, 'file')) as f:
+            self.assertEqual(f.read(), 'x')
+
+    @dir
+    @served
+    def test_download_modified_file(self, url):
+        served_file = os.path.join(TEST_SERVED_DIR, 'file')
+        with open(served_file, 'w') as served:
+            served.write('x')
+        self.download('{0}/file'.format(url), dir=TEST_DIR)
+        with open(served_file, 'w') as served:
+            served.write('y')
+        os.utime(served_file, (0, 0))
+        self.download('{0}/file'.format(url), dir=TEST_DIR)
+        self.assertEqual(LocalRequestHandler.sent, [200, 200])
+        with open(os.path.join(TEST_DIR, 'file')) as f:
+            self.assertEqual(f.read(), 'y')
+
+    @dir
+    @served
+    def test_download_resumes_partial_file(self, url):
+        served_file = os.path.join(TEST_SERVED_DIR, 'file')
+        with open(served_file, 'w') as served:
+            served.write('x' * 1000 + 'y' * 1000)
+        os.utime(served_file, (0, 0))
+        partial = cache.Handler().partial(cache.key(
+            '{0}/file'.format(url), last_modified=MOCK_LAST_MODIFIED))
+        with open(partial, 'w') as f:
+            f.write('x' * 1000)
+        self.download('{0}/file'.format(url), dir=TEST_DIR)
+        self.assertEqual(LocalRequestHandler.sent, [200, 206])
+        with open(os.path.join(TEST_DIR, 'file')) as f:
+            self.assertEqual(f.read(), 'x' * 1000 + 'y' * 1000)
+        self.assertEqual(
+            cache.Handler().entries()[0][1]['sha256'],
+            hashlib.sha256('x' * 1000 + 'y' * 1000).hexdigest())
+
+    @dir
+    @served
+    def test_download_cut_off_file(self, url):
+        served_file = os.path.join(TEST_SERVED_DIR, 'file')
+        with open(served_file, 'w') as served:
+            served.write('x' * 1000 + 'y' * 1000)
+        os.utime(served_file, (0, 0))
+        LocalRequestHandler.truncate = 1000
+        destination = os.path.join(TEST_DIR, 'file')
+        self.assertFalse(retr.download_file(
+            '{0}/file'.format(url), destination))
+        # the cut off file is neither cached nor revalidated later on
+        self.assertEqual(cache.Handler().entries(), [])
+        self.assertIsNone(cache.Handler().validators('{0}/file'.format(url)))
+        partial = cache.Handler().partial(cache.key(
+            '{0}/file'.format(url), last_modified=MOCK_LAST_MODIFIED))
+        self.assertEqual(os.path.getsize(partial), 1000)
+        self.assertTrue(retr.download_file(
+            '{0}/file'.format(url), destination))
+        self.assertEqual(LocalRequestHandler.sent, [200, 200, 206])
+        with open(destination) as f:
+            self.assertEqual(f.read(), 'x' * 1000 + 'y' * 1000)
+
+    @dir
+    @served
+    def test_download_cut_off_file_without_validators(self, url):
+        send_header = LocalRequestHandler.send_header
+        self.patch(LocalRequestHandler, 'send_header',
+                   lambda handler, name, value: name == 'Last-Modified' or
+                   send_header(handler, name, value))
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write('x' * 2000)
+        LocalRequestHandler.truncate = 1000
+        destination = os.path.join(TEST_DIR, 'file')
+        self.assertFalse(retr.download_file(
+            '{0}/file'.format(url), destination))
+        self.assertFalse(os.path.isfile(destination))
+
+    @dir
+    @served
+    def test_download_in_segments(self, url):
+        self.patch(retr, 'SEGMENTED_DOWNLOAD_MIN_SIZE', 1)
+        content = ''.join(str(i) for i in range(1000))
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write(content)
+        self.download('{0}/file'.format(url), dir=TEST_DIR)
+        self.assertEqual(LocalRequestHandler.sent, [200] + [206] * 4)
+        with open(os.path.join(TEST_DIR, 'file')) as f:
+            self.assertEqual(f.read(), content)
+
+    @dir
+    @served
+    def test_download_more_files_in_segments_than_host_slots(self, url):
+        self.patch(retr, 'SEGMENTED_DOWNLOAD_MIN_SIZE', 1)
+        content = ''.join(str(i) for i in range(1000))
+        files = ['file{0}'.format(i) for i in
+                 range(retr.DEFAULT_CONNECTIONS_PER_HOST + 2)]
+        for name in files:
+            with open(os.path.join(TEST_SERVED_DIR, name), 'w') as served:
+                served.write(content)
+        thread = threading.Thread(target=self.downloads, args=(
+            ['{0}/{1}'.format(url, name) for name in files],),
+            kwargs={'dir': TEST_DIR, 'workers': len(files)})
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive())
+        for name in files:
+            with open(os.path.join(TEST_DIR, name)) as f:
+                self.assertEqual(f.read(), content)
+
+    @dir
+    @served
+    def test_download_verified_file(self, url):
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write('x')
+        self.downloads([{'url': '{0}/file'.format(url),
+                         'sha256': hashlib.sha256('x').hexdigest()}],
+                       dir=TEST_DIR)
+        with open(os.path.join(TEST_DIR, 'file')) as f:
+            self.assertEqual(f.read(), 'x')
+
+    @dir
+    @served
+    def test_download_checksum_mismatch(self, url):
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write('x')
+        ex = self.assertRaises(
+            SystemExit, self.download, '{0}/file'.format(url),
+            dir=TEST_DIR, sha256=hashlib.sha256('y').hexdigest())
+        self.assertEqual(ex.message, codes.mapping['failed_to_download_file'])
+        self.assertFalse(os.path.isfile(os.path.join(TEST_DIR, 'file')))
+        self.assertEqual(cache.Handler().entries(), [])
+
+    @dir
+    @served
+    def test_download_verified_file_from_cache(self, url):
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write('x')
+        self.download('{0}/file'.format(url), file=TEST_FILE)
+        LocalRequestHandler.sent = []
+        # the same content is found by its checksum, even under another url
+        self.download('{0}/other'.format(url), dir=TEST_DIR,
+                      sha256=hashlib.sha256('x').hexdigest())
+        self.assertEqual(LocalRequestHandler.sent, [])
+        with open(os.path.join(TEST_DIR, 'other')) as f:
+            self.assertEqual(f.read(), 'x')
+
+    @dir
+    @served
+    def test_download_with_manifest(self, url):
+        with open(os.path.join(TEST_SERVED_DIR, 'file'), 'w') as served:
+            served.write('x')
+        with open(TEST_FILE, 'w') as f:
+            f.write('{0}  file\n'.format(hashlib.sha256('y').hexdigest()))
+        ex = self.assertRaises(
+            SystemExit, self.downloads, ['{0}/file'.format(url)],
+            dir=TEST_DIR, manifest=TEST_FILE)
+        self.assertEqual(ex.message, codes.mapping['failed_to_download_file'])
+
+    def test_download_missing_manifest(self):
+        ex = self.assertRaises(
+            SystemExit, self.downloads, ['http://x/file'],
+            dir=TEST_DIR, manifest=TEST_FILE)
+        self.assertEqual(
+            ex.message, codes.mapping['invalid_checksums_manifest'])
+
     def test_download_nonexistent_url(self):
         ex = self.assertRaises(
             SystemExit, self.download,
@@ -345,6 +1287,684 @@ class RetrieveHandlerTest(testtools.TestCase, retr.Handler, utils.Handler):
         self.assertEqual(ex.message, codes.mapping['failed_to_download_file'])
 
 
+class CacheHandlerTest(testtools.TestCase):
+
+    def setUp(self):
+        super(CacheHandlerTest, self).setUp()
+        self.cache = cache.Handler(TEST_CACHE_DIR, max_size=2)
+        self.addCleanup(self.cache.rmdir, TEST_CACHE_DIR)
+
+    def _store(self, key, content):
+        tmp = self.cache.partial(key)
+        with open(tmp, 'w') as f:
+            f.write(content)
+        self.cache.store(key, tmp, hashlib.sha256(content).hexdigest(),
+                         url=key)
+
+    @dir
+    def test_store_and_fetch(self):
+        self._store('a', 'x')
+        self.assertTrue(self.cache.fetch('a', TEST_FILE))
+        with open(TEST_FILE) as f:
+            self.assertEqual(f.read(), 'x')
+
+    @dir
+    def test_fetch_missing(self):
+        self.assertFalse(self.cache.fetch('a', TEST_FILE))
+        self.assertFalse(os.path.isfile(TEST_FILE))
+
+    def test_identical_files_stored_once(self):
+        self._store('a', 'x')
+        self._store('b', 'x')
+        self.assertEqual(len(self.cache.entries()), 2)
+        self.assertEqual(self.cache.size(), 1)
+
+    @dir
+    def test_prune_least_recently_used(self):
+        self._store('a', 'x')
+        self._store('b', 'y')
+        self._store('c', 'z')
+        self.cache.fetch('a', TEST_FILE)
+        self.assertEqual(self.cache.prune(), 1)
+        self.assertEqual(
+            [k for k, _ in self.cache.entries()], ['a', 'c'])
+        self.assertEqual(self.cache.prune(0), 2)
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_prune_stale_partials(self):
+        stale = self.cache.partial('a')
+        with open(stale, 'w') as f:
+            f.write('x')
+        old = time.time() - cache.PARTIAL_MAX_AGE - 1
+        os.utime(stale, (old, old))
+        recent = self.cache.partial('b')
+        with open(recent, 'w') as f:
+            f.write('y')
+        self.assertEqual(self.cache.prune(), 1)
+        self.assertFalse(os.path.isfile(stale))
+        self.assertTrue(os.path.isfile(recent))
+
+    def test_prune_partials_in_progress(self):
+        with open(self.cache.partial('a'), 'w') as f:
+            f.write('xyz')
+        with self.cache.lock('a'):
+            self.assertEqual(self.cache.prune(0), 0)
+        self.assertEqual(self.cache.prune(0), 1)
+        self.assertFalse(os.path.isfile(self.cache.partial('a')))
+
+
+class FakeAptGet():
+    """records apt-get runs instead of running apt-get. fails any run
+    which includes a package named `missing`.
+    """
+    runs = []
+
+    def __getattr__(self, action):
+        def run(*args, **kwargs):
+            FakeAptGet.runs.append((action,) + args)
+            if 'missing' in args:
+                raise sh.ErrorReturnCode_100(
+                    'apt-get', '', 'E: Unable to locate package missing')
+            if action == 'download':
+                return iter(MOCK_APT_PRINTED_URIS)
+            return iter([])
+        return run
+
+
+class FakeAptCache():
+    runs = []
+
+    def depends(self, *args):
+        FakeAptCache.runs.append(args)
+        if 'missing' in args:
+            raise sh.ErrorReturnCode_100(
+                'apt-cache', '', 'E: No packages found')
+        return iter(MOCK_APT_DEPENDS)
+
+
+class FakeSh():
+    ErrorReturnCode = sh.ErrorReturnCode
+    apt_get = FakeAptGet()
+    apt_cache = FakeAptCache()
+
+
+class AptHandlerTest(testtools.TestCase, apt.Handler):
+
+    def setUp(self):
+        super(AptHandlerTest, self).setUp()
+        self.patch(apt, 'sh', FakeSh)
+        self.patch(apt, '_mirror', {})
+        self.patch(apt, 'APT_LISTS_PATH', TEST_DIR)
+        self.patch(apt, 'DPKG_STATUS_PATH', TEST_FILE)
+        self.patch(cache, 'DEFAULT_CACHE_PATH', TEST_CACHE_DIR)
+        self.addCleanup(self.rmdir, TEST_CACHE_DIR)
+        FakeAptGet.runs = []
+        FakeAptCache.runs = []
+
+    def test_install_in_single_run(self):
+        self.install(['make', 'g++', 'curl'])
+        self.assertEqual(
+            FakeAptGet.runs, [('install', '-y', 'make', 'g++', 'curl')])
+
+    def test_install_nothing(self):
+        self.install([])
+        self.assertEqual(FakeAptGet.runs, [])
+
+    @dir
+    def test_installed_packages(self):
+        with open(TEST_FILE, 'w') as f:
+            f.write(MOCK_DPKG_STATUS)
+        self.assertEqual(self.installed_packages(), set([
+            'make', 'make:amd64', 'make=3.81-8.2ubuntu3']))
+        self.assertTrue(self.check_if_package_is_installed('make'))
+        self.assertFalse(self.check_if_package_is_installed('curl'))
+
+    @dir
+    def test_install_only_missing_packages(self):
+        with open(TEST_FILE, 'w') as f:
+            f.write(MOCK_DPKG_STATUS)
+        self.install(['make', 'curl'])
+        self.assertEqual(FakeAptGet.runs, [('install', '-y', 'curl')])
+        self.install(['make'])
+        self.assertEqual(len(FakeAptGet.runs), 1)
+
+    def test_install_finds_failed_package(self):
+        ex = self.assertRaises(
+            SystemExit, self.install, ['make', 'missing', 'curl'])
+        self.assertEqual(ex.message, codes.mapping['apt_get_failed'])
+        self.assertEqual(FakeAptGet.runs, [
+            ('install', '-y', 'make', 'missing', 'curl'),
+            ('install', '-y', 'make'),
+            ('install', '-y', 'missing'),
+            ('install', '-y', 'curl')])
+
+    def test_dependencies(self):
+        self.assertEqual(self.dependencies(['curl']),
+                         ['curl', 'libc6', 'libcurl3'])
+
+    def test_closure_is_cached(self):
+        closure = self.closure(['curl'])
+        self.assertEqual(closure[0], {
+            'url': 'http://archive.ubuntu.com/pool/main/c/curl/curl.deb',
+            'sha256': 'ab' * 32})
+        self.assertEqual(closure[1]['sha256'], None)
+        self.assertEqual(self.closure(['curl']), closure)
+        self.assertEqual(len(FakeAptCache.runs), 1)
+
+    def test_closure_missing_package(self):
+        ex = self.assertRaises(SystemExit, self.closure, ['curl', 'missing'])
+        self.assertEqual(ex.message, codes.mapping['apt_get_failed'])
+        self.assertEqual([run[-1] for run in FakeAptCache.runs],
+                         ['missing', 'curl', 'missing'])
+
+    def test_closure_missing_uri(self):
+        self.patch(self, 'dependencies', lambda reqs: ['curl', 'missing'])
+        ex = self.assertRaises(SystemExit, self.closure, ['curl'])
+        self.assertEqual(ex.message, codes.mapping['apt_get_failed'])
+
+    @dir
+    def test_add_src_repos(self):
+        sources_list_d = os.path.join(TEST_DIR, 'sources.list.d')
+        self.patch(apt, 'APT_SOURCES_LIST', TEST_FILE)
+        self.patch(apt, 'APT_SOURCES_LIST_D', sources_list_d)
+        with open(TEST_FILE, 'w') as f:
+            f.write('deb http://archive.ubuntu.com/ubuntu trusty main\n')
+        repos = ['deb http://archive.ubuntu.com/ubuntu  trusty main',
+                 'deb http://nginx.org/packages/ubuntu/ trusty nginx',
+                 'deb http://nginx.org/packages/ubuntu/ trusty nginx']
+        self.assertTrue(self.add_src_repos(repos, 'nginx'))
+        with open(os.path.join(sources_list_d, 'packman-nginx.list')) as f:
+            self.assertEqual(
+                f.read(), 'deb http://nginx.org/packages/ubuntu/ trusty '
+                          'nginx\n')
+        self.assertFalse(self.add_src_repos(repos, 'nginx'))
+        self.assertTrue(self.add_src_repos([], 'nginx'))
+        self.assertEqual(os.listdir(sources_list_d), [])
+
+    def test_purge_in_single_run(self):
+        self.purge(['make', 'curl'])
+        self.assertEqual(
+            FakeAptGet.runs, [('purge', '-y', 'make', 'curl')])
+
+    def _mirror(self):
+        path = os.path.join(TEST_DIR, 'mirror')
+        self.mkdir(path)
+        sh.touch(os.path.join(path, 'Packages'))
+        return path
+
+    @dir
+    def test_use_mirror(self):
+        self.patch(apt, 'APT_SOURCES_LIST', TEST_FILE)
+        self.patch(apt, 'APT_SOURCES_LIST_D',
+                   os.path.join(TEST_DIR, 'sources.list.d'))
+        self.patch(apt, 'APT_PREFERENCES_D',
+                   os.path.join(TEST_DIR, 'preferences.d'))
+        path = self._mirror()
+        self.assertTrue(self.use_mirror(path))
+        self.assertFalse(self.use_mirror(path))
+        with open(os.path.join(
+                TEST_DIR, 'sources.list.d', 'packman-mirror.list')) as f:
+            self.assertEqual(
+                f.read(), 'deb [trusted=yes] file:{0} ./\n'.format(path))
+        with open(os.path.join(
+                TEST_DIR, 'preferences.d', 'packman-mirror')) as f:
+            self.assertEqual(f.read(), apt.MIRROR_PREFERENCES)
+
+    @dir
+    def test_use_mirror_alone(self):
+        self.patch(apt, 'APT_SOURCES_LIST_D',
+                   os.path.join(TEST_DIR, 'sources.list.d'))
+        self.patch(apt, 'MIRROR_APT_PATH', os.path.join(TEST_DIR, 'apt'))
+        self.patch(os, 'environ', dict(os.environ))
+        path = self._mirror()
+        self.assertTrue(self.use_mirror(path, alone=True))
+        self.assertFalse(self.use_mirror(path, alone=True))
+        self.assertEqual(os.environ['APT_CONFIG'],
+                         os.path.join(TEST_DIR, 'apt', 'apt.conf'))
+        with open(os.environ['APT_CONFIG']) as f:
+            self.assertIn('Dir::Etc::SourceParts "{0}";'.format(
+                os.path.join(TEST_DIR, 'apt', 'sources.list.d')), f.read())
+        with open(os.path.join(TEST_DIR, 'apt', 'sources.list')) as f:
+            self.assertEqual(
+                f.read(), 'deb [trusted=yes] file:{0} ./\n'.format(path))
+        # the configured sources are left untouched
+        self.assertFalse(os.path.exists(
+            os.path.join(TEST_DIR, 'sources.list.d')))
+
+    @dir
+    def test_apt_get_runs_are_serialized(self):
+        self.patch(apt, 'APT_GET_LOCK', os.path.join(TEST_DIR, 'apt.lock'))
+        locked = []
+
+        def install(*args, **kwargs):
+            with utils.flock(apt.APT_GET_LOCK, blocking=False) as free:
+                locked.append(not free)
+            return iter([])
+        self.patch(FakeSh, 'apt_get', type(
+            'FakeLockedAptGet', (), {'install': staticmethod(install)}))
+        self.install(['make'])
+        self.assertEqual(locked, [True])
+
+
+class FakeYumOutput(list):
+    exit_code = 0
+
+
+class FakeYum():
+    """records yum runs instead of running yum. reports any package named
+    `missing` as unavailable.
+    """
+    runs = []
+
+    def install(self, *args, **kwargs):
+        FakeYum.runs.append(('install',) + args)
+        output = FakeYumOutput(
+            ['No package missing available.\n'] if 'missing' in args else [])
+        output.exit_code = 1 if output else 0
+        return output
+
+
+def fake_rpm(*args, **kwargs):
+    FakeYum.runs.append(('rpm',) + args)
+    if '-ivh' in args:
+        # every release rpm is already installed
+        output = FakeYumOutput()
+        output.exit_code = 1
+        return output
+    return ['make\n', 'make.x86_64\n', 'make-3.82-21.el7\n',
+            'make-3.82-21.el7.x86_64\n']
+
+
+def fake_repoquery(*args, **kwargs):
+    FakeYum.runs.append(('repoquery',) + args)
+    if '--location' in args:
+        return ['http://mirror.centos.org/{0}.rpm\n'.format(p)
+                for p in args[1:]]
+    if 'missing' in args:
+        return []
+    if '--requires' in args:
+        return ['glibc-2.17-55.el7.x86_64\n']
+    return ['{0}-1.0-1.el7.x86_64\n'.format(args[-1])]
+
+
+class FakeYumSh():
+    yum = FakeYum()
+    repoquery = staticmethod(fake_repoquery)
+    rpm = staticmethod(fake_rpm)
+
+
+class YumHandlerTest(testtools.TestCase, yum.Handler):
+
+    def setUp(self):
+        super(YumHandlerTest, self).setUp()
+        self.patch(yum, 'sh', FakeYumSh)
+        self.patch(yum, '_mirror', {})
+        self.patch(yum, 'YUM_CACHE_PATH', TEST_DIR)
+        self.patch(yum, 'RPM_DB_PATH', TEST_DIR)
+        self.patch(cache, 'DEFAULT_CACHE_PATH', TEST_CACHE_DIR)
+        self.addCleanup(self.rmdir, TEST_CACHE_DIR)
+        FakeYum.runs = []
+
+    def test_download_in_single_run(self):
+        self.download(['make', 'g++'], TEST_DIR)
+        self.assertEqual(FakeYum.runs, [
+            ('install', '-y', '--downloadonly', 'make', 'g++')])
+
+    @dir
+    def test_install_only_missing_packages(self):
+        sh.touch(os.path.join(TEST_DIR, 'Packages'))
+        self.install(['make', 'curl.x86_64'])
+        self.assertEqual(FakeYum.runs[1:], [('install', '-y', 'curl.x86_64')])
+
+    def test_closure(self):
+        self.assertEqual(self.closure(['make', 'curl']), [
+            {'url': 'http://mirror.centos.org/'
+                    'glibc-2.17-55.el7.x86_64.rpm'},
+            {'url': 'http://mirror.centos.org/make-1.0-1.el7.x86_64.rpm'},
+            {'url': 'http://mirror.centos.org/curl-1.0-1.el7.x86_64.rpm'}])
+
+    def test_closure_is_cached(self):
+        closure = self.closure(['make'])
+        runs = len(FakeYum.runs)
+        self.assertEqual(self.closure(['make']), closure)
+        self.assertEqual(len(FakeYum.runs), runs)
+
+    def test_closure_missing_package(self):
+        ex = self.assertRaises(SystemExit, self.closure, ['make', 'missing'])
+        self.assertEqual(ex.message, codes.mapping['yum_failed'])
+
+    def test_install_reports_missing_package(self):
+        ex = self.assertRaises(
+            SystemExit, self.install, ['make', 'missing', 'curl'])
+        self.assertEqual(ex.message, codes.mapping['yum_failed'])
+        self.assertEqual(FakeYum.runs, [
+            ('install', '-y', 'make', 'missing', 'curl')])
+
+    @dir
+    @served
+    def test_add_src_repos(self, url):
+        self.patch(yum, 'YUM_REPOS_PATH', TEST_DIR)
+        served_file = os.path.join(TEST_SERVED_DIR, 'nginx.repo')
+        with open(served_file, 'w') as f:
+            f.write('[nginx]\n')
+        repos = ['{0}/nginx.repo'.format(url), 'epel-release.rpm']
+        self.assertTrue(self.add_src_repos(repos, 'nginx'))
+        # neither the repo file nor the installed rpm changed
+        self.assertFalse(self.add_src_repos(repos, 'nginx'))
+        with open(served_file, 'w') as f:
+            f.write('[nginx-stable]\n')
+        os.utime(served_file, (0, 0))
+        self.assertTrue(self.add_src_repos(repos, 'nginx'))
+        with open(os.path.join(TEST_DIR, 'nginx.repo')) as f:
+            self.assertEqual(f.read(), '[nginx-stable]\n')
+        self.assertEqual(os.listdir(TEST_DIR), ['nginx.repo'])
+
+    @dir
+    def test_use_mirror_alone(self):
+        self.patch(yum, 'YUM_REPOS_PATH', TEST_DIR)
+        path = os.path.join(TEST_DIR, 'mirror')
+        self.mkdir(os.path.join(path, 'repodata'))
+        self.assertTrue(self.use_mirror(path, alone=True))
+        with open(os.path.join(TEST_DIR, 'packman-mirror.repo')) as f:
+            self.assertEqual(f.read(), yum.MIRROR_REPO.format(path))
+        self.download(['curl'], TEST_DIR)
+        self.assertEqual(FakeYum.runs[-1:], [
+            ('install', '-y', '--disablerepo=*',
+             '--enablerepo=packman-mirror', '--downloadonly', 'curl')])
+
+
+class MetadataHandlerTest(testtools.TestCase):
+
+    def setUp(self):
+        super(MetadataHandlerTest, self).setUp()
+        self.metadata = metadata.Handler(
+            'apt', [os.path.join(TEST_DIR, '*.list')],
+            path=os.path.join(TEST_DIR, 'state'))
+        self.updates = []
+
+    def update(self):
+        self.updates.append(time.time())
+
+    def failed_update(self):
+        raise sh.ErrorReturnCode_100('apt-get update', '', 'E: failed')
+
+    def _sources(self, content):
+        with open(os.path.join(TEST_DIR, 'sources.list'), 'w') as f:
+            f.write(content)
+
+    @dir
+    def test_refresh_once(self):
+        self._sources('deb http://archive.ubuntu.com/ubuntu trusty main')
+        self.assertTrue(self.metadata.refresh(self.update))
+        self.assertFalse(self.metadata.refresh(self.update))
+        self.assertEqual(len(self.updates), 1)
+
+    @dir
+    def test_refresh_on_changed_sources(self):
+        self._sources('deb http://archive.ubuntu.com/ubuntu trusty main')
+        self.metadata.refresh(self.update)
+        self._sources('deb http://nginx.org/packages/ubuntu trusty nginx')
+        self.assertTrue(self.metadata.refresh(self.update))
+        self.assertEqual(len(self.updates), 2)
+
+    @dir
+    def test_refresh_expired(self):
+        self.metadata.refresh(self.update)
+        self.assertTrue(self.metadata.refresh(self.update, ttl=0))
+        self.assertEqual(len(self.updates), 2)
+
+    @dir
+    def test_refresh_failed(self):
+        ex = self.assertRaises(
+            SystemExit, self.metadata.refresh, self.failed_update)
+        self.assertEqual(
+            ex.message, codes.mapping['failed_to_refresh_metadata'])
+        self.assertTrue(self.metadata.refresh(self.update))
+
+
+class FakeMirrorSh():
+    runs = []
+
+    @staticmethod
+    def dpkg_scanpackages(*args):
+        FakeMirrorSh.runs.append(('dpkg-scanpackages',) + args)
+        return 'Package: make\nFilename: ./make.deb\n'
+
+    @staticmethod
+    def createrepo(*args):
+        FakeMirrorSh.runs.append(('createrepo',) + args)
+        utils.Handler().mkdir(os.path.join(args[-1], 'repodata'))
+
+
+class MirrorHandlerTest(testtools.TestCase):
+
+    def setUp(self):
+        super(MirrorHandlerTest, self).setUp()
+        self.patch(mirror, 'sh', FakeMirrorSh)
+        self.mirror = mirror.Handler(os.path.join(TEST_DIR, 'mirror'))
+        self.archives = os.path.join(TEST_DIR, 'sources', 'archives')
+        FakeMirrorSh.runs = []
+
+    def _archives(self, *archives):
+        utils.Handler().mkdir(self.archives)
+        for name in archives:
+            with open(os.path.join(self.archives, name), 'w') as f:
+                f.write(name)
+
+    @dir
+    def test_add_archives(self):
+        self._archives('make.deb', 'curl.deb', 'lock')
+        sources = os.path.join(TEST_DIR, 'sources')
+        self.assertEqual(self.mirror.add(sources), ['curl.deb', 'make.deb'])
+        self.assertEqual(self.mirror.add(sources), [])
+        self.assertNotEqual(
+            os.stat(os.path.join(self.archives, 'make.deb')).st_ino,
+            os.stat(os.path.join(self.mirror.path, 'make.deb')).st_ino)
+
+    @dir
+    def test_index(self):
+        self._archives('make.deb', 'make.rpm')
+        self.mirror.add(os.path.join(TEST_DIR, 'sources'))
+        self.mirror.index()
+        self.mirror.index()
+        self.assertEqual(FakeMirrorSh.runs, [
+            ('dpkg-scanpackages', '.', '/dev/null'),
+            ('createrepo', self.mirror.path),
+            ('dpkg-scanpackages', '.', '/dev/null'),
+            ('createrepo', '--update', self.mirror.path)])
+        with open(os.path.join(self.mirror.path, 'Packages')) as f:
+            self.assertEqual(
+                f.read(), 'Package: make\nFilename: ./make.deb\n')
+        self.mirror.validate('Packages')
+
+    @dir
+    def test_validate_missing_mirror(self):
+        ex = self.assertRaises(SystemExit, self.mirror.validate, 'Packages')
+        self.assertEqual(ex.message, codes.mapping['mirror_not_found'])
+
+
+class FakePackager():
+    """creates an empty package instead of running fpm"""
+    calls = []
+
+    def __init__(self, name, input_type, output_type, source):
+        self.name = name
+
+    def execute(self, **kwargs):
+        FakePackager.calls.append(self.name)
+        sh.touch('{0}.tar'.format(self.name))
+        return True
+
+
+class FingerprintHandlerTest(testtools.TestCase):
+
+    def setUp(self):
+        super(FingerprintHandlerTest, self).setUp()
+        self.sources = os.path.join(TEST_DIR, 'sources')
+        self.packages = os.path.join(TEST_DIR, 'packages')
+        self.build = fingerprint.Handler(self.packages, 'test_package')
+        self.patch(fingerprint, 'INDEX_PATH', TEST_INDEX_DIR)
+        self.addCleanup(utils.Handler().rmdir, TEST_INDEX_DIR)
+        FakePackager.calls = []
+
+    def _sources(self, content):
+        utils.Handler().mkdir(self.sources)
+        with open(os.path.join(self.sources, 'file'), 'w') as f:
+            f.write(content)
+
+    def _package(self):
+        return {
+            'name': 'test_package',
+            'sources_path': self.sources,
+            'package_path': self.packages,
+            'destination_package_types': ['tar'],
+        }
+
+    @dir
+    def test_tree_hash_changes_with_content(self):
+        self._sources('x')
+        before = fingerprint.tree_hash(self.sources)
+        self.assertEqual(fingerprint.tree_hash(self.sources), before)
+        self._sources('y')
+        self.assertNotEqual(fingerprint.tree_hash(self.sources), before)
+
+    @dir
+    def test_tree_hash_only_rehashes_changed_files(self):
+        hashed = []
+
+        def file_hash(path):
+            hashed.append(os.path.basename(path))
+            with open(path) as f:
+                return hashlib.sha256(f.read()).hexdigest()
+
+        self.patch(fingerprint, 'file_hash', file_hash)
+        utils.Handler().mkdir(self.sources)
+        for name in ('a', 'b'):
+            path = os.path.join(self.sources, name)
+            with open(path, 'w') as f:
+                f.write(name)
+            os.utime(path, (0, 0))
+        before = fingerprint.tree_hash(self.sources)
+        self.assertEqual(fingerprint.tree_hash(self.sources), before)
+        self.assertEqual(hashed, ['a', 'b'])
+        with open(os.path.join(self.sources, 'b'), 'w') as f:
+            f.write('c')
+        os.utime(os.path.join(self.sources, 'b'), (1, 1))
+        self.assertNotEqual(fingerprint.tree_hash(self.sources), before)
+        self.assertEqual(hashed, ['a', 'b', 'b'])
+        self.assertEqual(fingerprint.tree_hash(self.sources),
+                         fingerprint.tree_hash(self.sources, index=False))
+
+    @dir
+    def test_fingerprint_changes_with_config(self):
+        self._sources('x')
+        package = self._package()
+        before = self.build.compute(package, self.sources)
+        package['version'] = '1.0'
+        self.assertNotEqual(self.build.compute(package, self.sources), before)
+
+    @dir
+    def test_matches_saved_fingerprint(self):
+        utils.Handler().mkdir(self.packages)
+        outputs = self.build.outputs()
+        sh.touch(os.path.join(self.packages, 'test_package.tar'))
+        self.build.save('x', outputs)
+        self.assertTrue(self.build.matches('x'))
+        self.assertFalse(self.build.matches('y'))
+        os.remove(os.path.join(self.packages, 'test_package.tar'))
+        self.assertFalse(self.build.matches('x'))
+
+    @dir
+    def test_pack_skips_unchanged_package(self):
+        self.patch(packman.fpm, 'Handler', FakePackager)
+        self._sources('x')
+        packman.pack(self._package())
+        packman.pack(self._package())
+        self.assertEqual(FakePackager.calls, ['test_package'])
+        self._sources('y')
+        packman.pack(self._package())
+        self.assertEqual(FakePackager.calls, ['test_package'] * 2)
+
+    @dir
+    def test_skipped_package_removes_sources(self):
+        self.patch(packman.fpm, 'Handler', FakePackager)
+        package = self._package()
+        package['keep_sources'] = False
+        self._sources('x')
+        packman.pack(package)
+        self.assertFalse(os.path.isdir(self.sources))
+        self._sources('x')
+        packman.pack(package)
+        self.assertEqual(FakePackager.calls, ['test_package'])
+        self.assertFalse(os.path.isdir(self.sources))
+
+
+class ArchiveHandlerTest(testtools.TestCase):
+
+    def setUp(self):
+        super(ArchiveHandlerTest, self).setUp()
+        self.sources = os.path.join(TEST_DIR, 'sources')
+        self.packages = os.path.join(TEST_DIR, 'packages')
+        self.script = os.path.join(TEST_DIR, 'bootstrap.sh')
+
+    def _sources(self):
+        utils.Handler().mkdir(os.path.join(self.sources, 'sub'))
+        with open(os.path.join(self.sources, 'sub', 'file'), 'w') as f:
+            f.write('x')
+        with open(self.script, 'w') as f:
+            f.write('echo')
+
+    @dir
+    def test_write_targz(self):
+        self._sources()
+        utils.Handler().mkdir(self.packages)
+        with utils.chdir(self.packages):
+            self.assertTrue(archive.Handler(
+                'test_package', 'dir', 'tar.gz', self.sources).execute(
+                after_install=self.script))
+            tar = tarfile.open('test_package.tar.gz')
+            names = tar.getnames()
+            # the package has the same layout as the one fpm creates
+            self.assertIn('.' + os.path.join(self.sources, 'sub', 'file'),
+                          names)
+            self.assertIn('./' + TEST_DIR.strip('/'), names)
+            self.assertEqual(tar.extractfile(
+                './.scripts/after_install').read(), 'echo')
+            tar.close()
+            self.assertEqual(os.listdir('.'), ['test_package.tar.gz'])
+
+    @dir
+    def test_write_existing_targz(self):
+        self._sources()
+        utils.Handler().mkdir(self.packages)
+        with utils.chdir(self.packages):
+            sh.touch('test_package.tar.gz')
+            packager = archive.Handler(
+                'test_package', 'dir', 'tar.gz', self.sources)
+            ex = self.assertRaises(SystemExit, packager.execute)
+            self.assertEqual(ex.message, codes.mapping['targz_exists'])
+            self.assertTrue(packager.execute(force=True))
+
+    @dir
+    def test_pack_tarballs_without_fpm(self):
+        self.patch(packman.fpm, 'Handler', FakePackager)
+        self.patch(fingerprint, 'INDEX_PATH', TEST_INDEX_DIR)
+        self.addCleanup(utils.Handler().rmdir, TEST_INDEX_DIR)
+        FakePackager.calls = []
+        self._sources()
+        packman.pack({
+            'name': 'test_package',
+            'sources_path': self.sources,
+            'package_path': self.packages,
+            'source_package_type': 'dir',
+            'destination_package_types': ['tar', 'tar.gz'],
+        })
+        self.assertEqual(FakePackager.calls, [])
+        for output in ('test_package.tar', 'test_package.tar.gz'):
+            self.assertTrue(tarfile.is_tarfile(
+                os.path.join(self.packages, output)))
+
+
 class TemplateHandlerTest(testtools.TestCase, templater.Handler,
                           utils.Handler):
 
@@ -3,13 +3,15 @@ import logging
 import logger
 import os
 import contextlib
-# import sh
+import fcntl
+import sh
 import shutil
 import time
 # import fabric.api as fab
 import errno
 import sys
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 import platform
 
 import codes
@@ -113,6 +115,76 @@ def chdir(dirname=None):
         os.chdir(curdir)
 
 
+@contextlib.contextmanager
+def flock(path, blocking=True):
+    """holds an exclusive lock on a file (which is created if required)
+
+    the lock is shared by all processes, so it serializes work done by
+    packages handled concurrently.
+
+    :param string path: path of the lock file
+    :param bool blocking: whether to wait for the lock. if not, the
+     context yields whether the lock was acquired.
+    """
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as ex:
+        # the directory might have been created by another lock
+        if not ex.errno == errno.EEXIST:
+            raise
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking
+                        else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def catch_exit(func):
+    """wraps a function so that it returns its exit code instead of exiting
+
+    functions run by pool workers must be wrapped, as a worker must never
+    die on sys.exit as that would hang the pool.
+
+    :rtype: function returning a (result, exit code) tuple
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs), 0
+        except SystemExit as ex:
+            return None, ex.code
+    return wrapper
+
+
+def concurrently(func, items, workers):
+    """calls a function for each item of a list in a pool of threads
+
+    if any of the calls exits, the pool exits (with the exit code of the
+    first of them) once all calls are done.
+
+    :param func: function to call with each item
+    :param list items: items to call `func` with
+    :param int workers: max number of concurrent calls
+    :rtype: `list` of the calls' results (in the order of `items`)
+    """
+    pool = ThreadPool(processes=max(1, min(workers, len(items))))
+    try:
+        results = pool.map(catch_exit(func), items)
+    finally:
+        pool.close()
+        pool.join()
+    failed = [code for _, code in results if code]
+    if failed:
+        sys.exit(failed[0])
+    return [result for result, _ in results]
+
+
 def retry(retries=4, delay_multiplier=3, backoff=2):
     """Retry calling the decorated function using an exponential backoff.
 
@@ -181,6 +253,9 @@ class Handler():
             try:
                 os.makedirs(dir)
             except OSError as ex:
+                # concurrent downloads might create the same directory
+                if ex.errno == errno.EEXIST and os.path.isdir(dir):
+                    return
                 lgr.error('Failed to create {0} ({1})'.format(dir, str(ex)))
                 sys.exit(codes.mapping['failed_to_mkdir'])
         else:
@@ -227,6 +302,29 @@ class Handler():
                 lgr.error('Copying failed. Error: {0}'.format(e))
                 return False
 
+    def link(self, source, destination, hardlink=True):
+        """links a file to a destination
+
+        the file is hardlinked if possible (and allowed), else it is copied
+        (reflinked, where the filesystem supports it). an existing
+        destination is replaced.
+
+        :param string source: file to link
+        :param string destination: path to link the file to
+        :param bool hardlink: whether the file may be hardlinked. files
+         which might be modified at their destination mustn't be.
+        """
+        if os.path.lexists(destination):
+            os.remove(destination)
+        if hardlink:
+            try:
+                os.link(source, destination)
+                return
+            except OSError:
+                # the source and the destination are on different filesystems
+                pass
+        sh.cp('--reflink=auto', source, destination)
+
     def mv(self, src, dst):
         """moves files or directories
 
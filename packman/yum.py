@@ -1,10 +1,70 @@
 import os
+import utils
 import retrieve
+import cache
+import metadata
+import mirror
 import logger
+import codes
+import filecmp
+import hashlib
+import platform
+import re
 import sh
+import shutil
+import sys
+import tempfile
+
+YUM_CACHE_PATH = '/var/cache/yum'
+RPM_DB_PATH = '/var/lib/rpm'
+# yum waits for (or, depending on its configuration, fails on) another
+# running yum, so the runs of packages handled concurrently are
+# serialized by this lock.
+YUM_LOCK = os.path.expanduser('~/.packman/locks/yum.lock')
+YUM_REPOS_PATH = '/etc/yum.repos.d'
+# yum prefers repos with a lower cost (the default cost is 1000)
+MIRROR_REPO = '''[packman-mirror]
+name=packman mirror
+baseurl=file://{0}
+enabled=1
+gpgcheck=0
+cost=1
+'''
+# files which determine which metadata yum retrieves
+YUM_SOURCES = [
+    '/etc/yum.conf',
+    os.path.join(YUM_REPOS_PATH, '*'),
+]
+# every installed package is listed by its name and by its
+# name.arch, name-version-release and name-version-release.arch
+INSTALLED_QUERY_FORMAT = '%{NAME}\\n%{NAME}.%{ARCH}\\n' \
+    '%{NAME}-%{VERSION}-%{RELEASE}\\n%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\\n'
+DEFAULT_RESOLVE_WORKERS = 4
 
 lgr = logger.init()
 
+# the installed packages, keyed by the state of the rpmdb
+# they were queried from
+_installed = {}
+
+# the mirror used in this run (see `Handler.use_mirror`)
+_mirror = {}
+
+# yum skips (or, depending on its configuration, fails on) packages it
+# can't find, and reports them with this message.
+MISSING_PACKAGE = re.compile(r'No package (\S+) available')
+
+
+def repo_args():
+    """returns the arguments which select the repos yum (and repoquery)
+    use in this run
+
+    :rtype: `tuple` of arguments
+    """
+    if _mirror.get('alone'):
+        return ('--disablerepo=*', '--enablerepo=packman-mirror')
+    return ()
+
 
 class Handler(retrieve.Handler):
     @staticmethod
@@ -12,7 +72,58 @@ class Handler(retrieve.Handler):
         """runs yum update
         """
         lgr.debug('Updating local yum repo')
-        return sh.yum.update()
+        with utils.flock(YUM_LOCK):
+            return sh.yum.update(*repo_args())
+
+    def refresh(self, ttl=None, changed=False):
+        """refreshes the repos' metadata cache (yum makecache) if the repo
+        sources changed since it was last refreshed or if it expired
+
+        :param int ttl: seconds after which the metadata expires
+        :param bool changed: whether the repo sources are known to
+         have changed
+        :rtype: `bool` representing whether the metadata was refreshed
+        """
+        if not _mirror:
+            return metadata.Handler('yum', YUM_SOURCES).refresh(
+                self.makecache, ttl, changed)
+        # the metadata is refreshed whenever the mirror is indexed
+        index = os.path.join(_mirror['path'], 'repodata', 'repomd.xml')
+        if _mirror['alone']:
+            return metadata.Handler('yum-mirror', [os.path.join(
+                YUM_REPOS_PATH, 'packman-mirror.repo'), index]).refresh(
+                    self.makecache, ttl, changed)
+        return metadata.Handler('yum', YUM_SOURCES + [index]).refresh(
+            self.makecache, ttl, changed)
+
+    def makecache(self):
+        """runs yum makecache
+        """
+        with utils.flock(YUM_LOCK):
+            return sh.yum.makecache(*repo_args())
+
+    def installed_packages(self):
+        """returns the installed packages
+
+        rpm is only queried again when the rpmdb changes (i.e. when
+        packages were installed or removed).
+
+        :rtype: `set` of package names (also in the forms name.arch,
+         name-version-release and name-version-release.arch)
+        """
+        try:
+            state = tuple(sorted(
+                (f, os.stat(os.path.join(RPM_DB_PATH, f)).st_mtime)
+                for f in os.listdir(RPM_DB_PATH)))
+        except OSError:
+            return set()
+        if state not in _installed:
+            lgr.debug('Querying installed packages...')
+            _installed.clear()
+            _installed[state] = set(
+                line.strip() for line in sh.rpm(
+                    '-qa', qf=INSTALLED_QUERY_FORMAT) if line.strip())
+        return _installed[state]
 
     def check_if_package_is_installed(self, package):
         """checks if a package is installed
@@ -20,61 +131,253 @@ class Handler(retrieve.Handler):
         :param string package: package name to check
         :rtype: `bool` representing whether package is installed or not
         """
-
         lgr.debug('Checking if {0} is installed'.format(package))
-        r = sh.grep(sh.rpm('-qa', _ok_code=[0, 1]), package)
-        if r.exit_code == 0:
+        if package in self.installed_packages():
             lgr.debug('{0} is installed'.format(package))
             return True
         else:
-            lgr.error('{0} is not installed'.format(package))
+            lgr.debug('{0} is not installed'.format(package))
             return False
 
-    def download(self, reqs, sources_path):
+    def missing_packages(self, packages):
+        """returns the packages which aren't installed
+
+        :param list packages: packages to check
+        :rtype: `list` of packages
+        """
+        installed = self.installed_packages()
+        missing = [p for p in packages if p not in installed]
+        if len(missing) < len(packages):
+            lgr.debug('Already installed: {0}'.format(', '.join(
+                p for p in packages if p in installed)))
+        return missing
+
+    def _install(self, packages, *args, **kwargs):
+        """runs a single yum install transaction on a list of packages
+
+        yum loads the repos' metadata and the rpmdb every time it runs, so
+        all packages are handled in one run. the packages yum couldn't find
+        are picked out of its output.
+
+        :param list packages: packages to install
+        :param args: additional yum arguments
+        :param kwargs: additional yum options
+        :rtype: `tuple` (yum's exit code, list of missing packages)
+        """
+        missing = []
+        with utils.flock(YUM_LOCK):
+            o = sh.yum.install('-y', *(list(repo_args()) + list(args) +
+                                       list(packages)),
+                               _iter=True, _ok_code=[0, 1], **kwargs)
+            for line in o:
+                lgr.debug(line.rstrip())
+                match = MISSING_PACKAGE.search(line)
+                if match:
+                    missing.append(match.group(1))
+        return o.exit_code, missing
+
+    def _repos_revision(self):
+        """returns a hash of the revisions of the local repos' metadata
+
+        the hash changes whenever the metadata of any repo is refreshed.
+        """
+        revision = hashlib.sha256()
+        for root, dirs, files in sorted(os.walk(YUM_CACHE_PATH)):
+            if 'repomd.xml' in files:
+                with open(os.path.join(root, 'repomd.xml')) as f:
+                    revision.update(root + '\n' + f.read())
+        return revision.hexdigest()
+
+    def dependencies(self, req):
+        """returns a package and all of its dependencies
+
+        the dependencies are resolved from the repos' metadata, regardless
+        of which packages are installed on the local machine.
+
+        :param string req: package to resolve
+        :rtype: `list` of package names (name-version-release.arch)
+        """
+        qf = '%{name}-%{version}-%{release}.%{arch}'
+        archlist = '{0},noarch'.format(platform.machine())
+        packages = set()
+        for args in (('--requires', '--recursive', '--resolve'), ()):
+            o = sh.repoquery(*(repo_args() + args + (req,)), qf=qf,
+                             archlist=archlist)
+            packages.update(line.strip() for line in o if line.strip())
+        return sorted(packages)
+
+    def resolve(self, req, revision):
+        """returns the sources of a package and all of its dependencies
+
+        the result is cached per distro, package and revision of the repos'
+        metadata.
+
+        :param string req: package to resolve
+        :param string revision: the repos' metadata revision
+        :rtype: `list` of dicts containing the `url` of each package
+        """
+        key = hashlib.sha256('\n'.join([
+            'yum', ' '.join(platform.dist()), platform.machine(),
+            revision, ' '.join(repo_args()), req])).hexdigest()
+        c = cache.Handler()
+        sources = c.closure(key)
+        if sources is not None:
+            lgr.debug('Using cached dependency closure of {0}'.format(req))
+            return sources
+        lgr.info('Resolving dependencies of {0}...'.format(req))
+        packages = self.dependencies(req)
+        if not packages:
+            lgr.error('Could not find package: {0}'.format(req))
+            sys.exit(codes.mapping['yum_failed'])
+        sources = [{'url': line.strip()} for line in sh.repoquery(
+            *(repo_args() + ('--location',) + tuple(packages)))
+            if line.strip()]
+        lgr.debug('{0} packages resolved for {1}.'.format(
+            len(sources), req))
+        c.set_closure(key, sources)
+        return sources
+
+    def closure(self, reqs):
+        """returns the sources of a list of packages and all of their
+        dependencies
+
+        the packages are resolved concurrently.
+
+        :param list reqs: packages to resolve
+        :rtype: `list` of dicts containing the `url` of each package
+        """
+        revision = self._repos_revision()
+        results = utils.concurrently(
+            lambda req: self.resolve(req, revision), reqs,
+            DEFAULT_RESOLVE_WORKERS)
+        sources = []
+        urls = set()
+        for closure in results:
+            for source in closure:
+                if source['url'] not in urls:
+                    urls.add(source['url'])
+                    sources.append(source)
+        return sources
+
+    def download(self, reqs, sources_path, resolve=False):
         """downloads component requirements
 
+        if `resolve` is set, the requirements and all of their dependencies
+        are downloaded (concurrently) whether or not they are installed on
+        the local machine. else, yum decides which dependencies are
+        missing and downloads them along with the requirements.
+
         :param list reqs: list of requirements to download
         :param sources_path: path to download requirements to
+        :param bool resolve: whether to download the full dependency closure
         """
-        for req in reqs:
-            # TODO: (TEST) run yum reinstall instead of yum install.
-            lgr.debug('Downloading {0} to {1}...'.format(req, sources_path))
-            # TODO: (FIX) yum download exits with an error even if the download
-            # TODO: (FIX) succeeded due to a non-zero error message.
-            # TODO: (FEAT) add yum enable-repo option
-            # TODO: (IMPRV) $(repoquery --requires --recursive --resolve pkg)
-            # TODO: (IMPRV) can be used to download deps.
-            # TODO: (IMPRV) test to see if it works.
-            # if self.check_if_package_is_installed(package):
-            # return do('sudo yum -y reinstall --downloadonly '
-            #           '--downloaddir={1}/archives {0}'.format(
-            #               package, dir), accepted_err_codes=[1])
-            o = sh.yum.install(
-                '-y', req, '--downloadonly', downloaddir=os.path.join(
-                    sources_path, 'archives'), _iter=True, _ok_code=[0, 1])
-            for line in o:
-                lgr.debug(line)
+        if reqs and resolve:
+            # rpms are downloaded into sources_path/archives
+            retrieve.Handler().downloads(self.closure(reqs), sources_path)
+            return
+        # TODO: (TEST) run yum reinstall instead of yum install.
+        # TODO: (FEAT) add yum enable-repo option
+        # if self.check_if_package_is_installed(package):
+        # return do('sudo yum -y reinstall --downloadonly '
+        #           '--downloaddir={1}/archives {0}'.format(
+        #               package, dir), accepted_err_codes=[1])
+        # yum doesn't download packages which are already installed
+        reqs = self.missing_packages(reqs)
+        if not reqs:
+            return
+        lgr.debug('Downloading {0} to {1}...'.format(
+            ', '.join(reqs), sources_path))
+        # yum download exits with an error even if the download
+        # succeeded, so only the missing packages are considered failures.
+        _, missing = self._install(
+            reqs, '--downloadonly', downloaddir=os.path.join(
+                sources_path, 'archives'))
+        if missing:
+            lgr.error('Could not find packages: {0}'.format(
+                ', '.join(missing)))
+            sys.exit(codes.mapping['yum_failed'])
 
     def install(self, packages):
         """yum installs a list of packages
 
         :param list package: packages to install
         """
-        for package in packages:
-            lgr.debug('Installing {0}'.format(package))
-            sh.yum.install('-y', package)
+        packages = self.missing_packages(packages)
+        if not packages:
+            return
+        lgr.debug('Installing {0}'.format(', '.join(packages)))
+        exit_code, missing = self._install(packages)
+        if missing:
+            lgr.error('Could not find packages: {0}'.format(
+                ', '.join(missing)))
+            sys.exit(codes.mapping['yum_failed'])
+        if exit_code:
+            lgr.error('Failed to install {0}'.format(', '.join(packages)))
+            sys.exit(codes.mapping['yum_failed'])
 
-    def add_src_repos(self, source_repos):
-        """adds a list of source repos to the apt repo
+    def add_src_repos(self, source_repos, name=None):
+        """adds a list of source repos to the yum repos
 
-        :param list source_repos: repos to add to sources list
+        :param list source_repos: repos (.repo files or release rpms) to add
+        :param string name: name of the package the repos are added for
+        :rtype: `bool` representing whether the repos changed
         """
+        changed = False
         for source_repo in source_repos:
             lgr.debug('Adding source repository {0}'.format(source_repo))
             if os.path.splitext(source_repo)[1] == '.rpm':
-                sh.rpm('-ivh', source_repo, _ok_code=[0, 1])
-            else:
-                self.download(source_repo, dir='/etc/yum.repos.d/')
+                # rpm exits with 1 if the release rpm is already installed
+                if sh.rpm('-ivh', source_repo, _ok_code=[0, 1]).exit_code:
+                    lgr.debug('Repo {0} already added.'.format(source_repo))
+                else:
+                    changed = True
+            elif self._add_repo_file(source_repo):
+                changed = True
+        return changed
+
+    def _add_repo_file(self, url):
+        # the .repo file only replaces the current one if its content changed
+        name = url.split('/')[-1]
+        repo_file = os.path.join(YUM_REPOS_PATH, name)
+        tmp = tempfile.mkdtemp()
+        try:
+            retrieve.Handler().download(url, dir=tmp)
+            downloaded = os.path.join(tmp, name)
+            if os.path.isfile(repo_file) and \
+                    filecmp.cmp(downloaded, repo_file, shallow=False):
+                lgr.debug('Repo {0} already added.'.format(url))
+                return False
+            shutil.move(downloaded, repo_file)
+            return True
+        finally:
+            self.rmdir(tmp)
+
+    def use_mirror(self, path, alone=False):
+        """uses a packman mirror (see `mirror.Handler`) in this run
+
+        the mirror is added to the yum repos (with a lower cost than other
+        repos, so that it's preferred over them). if `alone` is set, all
+        other repos are disabled in every yum (and repoquery) run, so
+        nothing is retrieved over the network.
+
+        :param string path: the mirror's path
+        :param bool alone: whether to use the mirror alone
+        :rtype: `bool` representing whether the repos changed
+        """
+        m = mirror.Handler(path)
+        m.validate('repodata')
+        _mirror.update({'path': m.path, 'alone': alone})
+        lgr.info('Using mirror {0}{1}'.format(
+            m.path, ' instead of the yum repos' if alone else ''))
+        repo_file = os.path.join(YUM_REPOS_PATH, 'packman-mirror.repo')
+        content = MIRROR_REPO.format(m.path)
+        if os.path.isfile(repo_file):
+            with open(repo_file) as f:
+                if f.read() == content:
+                    return False
+        with open(repo_file, 'w') as f:
+            f.write(content)
+        return True
 
     def add_key(self, key_file):
         """adds a list of keys to the local repo